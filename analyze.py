@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
 
-from mpl_toolkits.mplot3d import Axes3D
-from sklearn.cluster import KMeans
-from sklearn.decomposition import PCA, LatentDirichletAllocation
+from clustering import plot_clusters_3d, plot_sweep, sweep_cluster_counts
+from feature_store import DEFAULT_FEATURES_DIR, FeatureStore, database_fingerprint
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.decomposition import LatentDirichletAllocation
 from sklearn.feature_extraction.text import CountVectorizer
 from sklearn.feature_extraction.text import TfidfTransformer
-from sklearn.metrics import silhouette_score
+from sklearn.metrics import adjusted_rand_score
+from sklearn.preprocessing import normalize
+from scipy import sparse
 from wordcloud import WordCloud
-import matplotlib.pyplot as plt
+import argparse
+import math
+import numpy as np
+import os
 import pandas as pd
 import psycopg2
 
@@ -21,184 +27,645 @@ db_config = {
 }
 
 
-def load_data_from_db():
-    """Load word occurrences data from the PostgreSQL database."""
+# Occurrence tables a document-term matrix can be built from
+OCCURRENCE_TABLES = {
+    "subject": "subject_occurrences",
+    "body": "body_occurrences",
+}
+
+# Number of occurrence rows fetched from the server-side cursor at a time
+DEFAULT_CHUNK_SIZE = 100000
+
+# Number of emails per mini-batch in out-of-core clustering
+DEFAULT_EMAILS_PER_CHUNK = 5000
+
+# Where the IDF weighting of out-of-core clustering is persisted
+DEFAULT_IDF_PATH = "idf_{source}.npz"
+
+
+def load_sparse_dtm(
+    source="subject", chunk_size=DEFAULT_CHUNK_SIZE, min_df=1, max_df=1.0
+):
+    """Load the document-term matrix from the PostgreSQL database.
+
+    Integer (email_id, word_id, count) triples are streamed in chunks through
+    a server-side cursor and assembled into a sparse CSR matrix, so no dense
+    frame is ever built. Words outside the min_df/max_df document frequency
+    bounds are left out, see load_vocabulary.
+
+    Returns:
+    - dtm: scipy.sparse.csr_matrix
+        Emails x words matrix of occurrence counts.
+    - words: np.ndarray
+        The word of each column.
+    - email_ids: np.ndarray
+        The email id of each row.
+    """
     conn = psycopg2.connect(**db_config)
-    query = """
-        SELECT
-            e.id AS email_id,
-            w.word,
-            o.count
-        FROM
-            subject_occurrences o
-        JOIN
-            words w ON o.word_id = w.id
-        JOIN
-            emails e ON o.email_id = e.id;
+    vocabulary = (
+        load_vocabulary(conn, source, min_df, max_df)
+        if prunes_vocabulary(min_df, max_df)
+        else None
+    )
+    email_chunks, word_chunks, count_chunks = [], [], []
+    with conn.cursor(name="dtm") as cursor:
+        cursor.itersize = chunk_size
+        cursor.execute(
+            f"SELECT email_id, word_id, count FROM {OCCURRENCE_TABLES[source]};"
+        )
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            chunk = np.array(rows, dtype=np.int64)
+            if vocabulary is not None:
+                chunk = chunk[np.isin(chunk[:, 1], vocabulary)]
+            email_chunks.append(chunk[:, 0])
+            word_chunks.append(chunk[:, 1])
+            count_chunks.append(chunk[:, 2].astype(np.int32))
+
+    if not count_chunks:
+        conn.close()
+        return sparse.csr_matrix((0, 0), dtype=np.int32), np.array([]), np.array([])
+
+    # Map the database ids onto dense row and column indexes
+    email_ids, rows = np.unique(np.concatenate(email_chunks), return_inverse=True)
+    word_ids, cols = np.unique(np.concatenate(word_chunks), return_inverse=True)
+    counts = np.concatenate(count_chunks)
+    del email_chunks, word_chunks, count_chunks
+
+    dtm = sparse.csr_matrix(
+        (counts, (rows, cols)), shape=(len(email_ids), len(word_ids))
+    )
+
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT id, word FROM words WHERE id = ANY(%s);", (word_ids.tolist(),)
+        )
+        word_by_id = dict(cursor.fetchall())
+    conn.close()
+
+    words = np.array([word_by_id[word_id] for word_id in word_ids.tolist()])
+    return dtm, words, email_ids
+
+
+def load_stored_dtm(
+    source="subject",
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    min_df=1,
+    max_df=1.0,
+    features_dir=DEFAULT_FEATURES_DIR,
+    refresh=False,
+):
+    """Load the document-term matrix from the feature store.
+
+    It is only built with load_sparse_dtm, and stored, when the imported
+    emails changed since it was last stored. The arrays returned are
+    memory-mapped from the store.
     """
-    df = pd.read_sql(query, conn)
+    conn = psycopg2.connect(**db_config)
+    fingerprint = database_fingerprint(conn, source, min_df, max_df)
     conn.close()
-    return df
+    return FeatureStore(features_dir).cached(
+        f"dtm_{source}",
+        fingerprint,
+        lambda: load_sparse_dtm(source, chunk_size, min_df, max_df),
+        refresh=refresh,
+        source=source,
+        min_df=min_df,
+        max_df=max_df,
+    )
 
 
-# Elbow Method to determine optimal number of clusters
-def elbow_analysis(X):
-    wcss = []
-    for i in range(2, 15):
-        kmeans = KMeans(
-            n_clusters=i, init="k-means++", max_iter=300, n_init=10, random_state=42
+def load_words(conn, word_ids):
+    """Return the word of every word id, in the same order."""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT id, word FROM words WHERE id = ANY(%s);",
+            (list(map(int, word_ids)),),
         )
-        kmeans.fit(X)
-        wcss.append(kmeans.inertia_)
-    plt.plot(range(2, 15), wcss)
-    plt.title("Elbow Analysis")
-    plt.xlabel("Number of clusters")
-    plt.ylabel("WCSS")
-    plt.show()
+        word_by_id = dict(cursor.fetchall())
+    return np.array([word_by_id[int(word_id)] for word_id in word_ids])
 
 
-# Silhouette Score to evaluate clustering performance
-def silhouette_analysis(X):
-    silhouette_scores = []
-    for i in range(2, 15):
-        kmeans = KMeans(n_clusters=i, random_state=42)
-        kmeans.fit(X)
-        score = silhouette_score(X, kmeans.labels_)
-        silhouette_scores.append(score)
-
-    plt.plot(range(2, 15), silhouette_scores)
-    plt.title("Silhouette Score Analysis")
-    plt.xlabel("Number of clusters")
-    plt.ylabel("Silhouette Score")
-    plt.show()
-
-
-def plot_3d_pca(dtm, cluster_col="cluster", n_components=3, tfidf=True, cmap="viridis"):
+def iter_dtm_chunks(
+    conn, source, n_words, emails_per_chunk, chunk_size, after_email_id=0
+):
+    """Stream the document-term matrix as chunks of whole email rows.
+
+    Occurrences are read in email_id order through a server-side cursor, so
+    only one chunk of emails is ever held in memory. Columns are indexed by
+    word id, which keeps them consistent between chunks and passes. Only
+    emails with an id above after_email_id are read, e.g. the emails
+    imported since a model was fitted.
+
+    Yields (email_ids, chunk) pairs, where chunk is a sparse CSR matrix of
+    len(email_ids) x n_words occurrence counts.
     """
-    Plots a 3D PCA scatter plot of the document-term matrix (DTM).
-
-    Parameters:
-    - dtm: pd.DataFrame
-        Document-term matrix with a cluster column.
-    - cluster_col: str
-        The name of the column containing cluster labels.
-    - n_components: int
-        Number of PCA components to reduce to (default is 3).
-    - tfidf: bool
-        Whether to apply TF-IDF transformation before PCA (default is True).
-    - cmap: str
-        Colormap for the scatter plot (default is 'viridis').
+    pending = np.empty((0, 3), dtype=np.int64)
+    with conn.cursor(name=f"dtm_chunks_{source}") as cursor:
+        cursor.itersize = chunk_size
+        cursor.execute(
+            f"SELECT email_id, word_id, count FROM {OCCURRENCE_TABLES[source]} "
+            "WHERE email_id > %s ORDER BY email_id;",
+            (int(after_email_id),),
+        )
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if rows:
+                pending = np.concatenate([pending, np.array(rows, dtype=np.int64)])
+
+            # Cut on an email boundary once enough emails are pending. The
+            # last email may continue in the next fetch, so it is held back.
+            _, starts = np.unique(pending[:, 0], return_index=True)
+            while len(starts) > emails_per_chunk:
+                cut = starts[emails_per_chunk]
+                yield dtm_chunk(pending[:cut], n_words)
+                pending = pending[cut:]
+                starts = starts[emails_per_chunk:] - cut
+
+            if not rows:
+                break
+
+    if len(pending):
+        yield dtm_chunk(pending, n_words)
+
+
+def dtm_chunk(rows, n_words):
+    """Build a sparse chunk of the DTM from (email_id, word_id, count) rows."""
+    email_ids, row_indexes = np.unique(rows[:, 0], return_inverse=True)
+    chunk = sparse.csr_matrix(
+        (rows[:, 2], (row_indexes, rows[:, 1])), shape=(len(email_ids), n_words)
+    )
+    return email_ids, chunk
+
+
+def count_words_table(conn):
+    """Return the number of word id columns needed to index every word."""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM words;")
+        return cursor.fetchone()[0]
+
+
+def count_emails(conn, source):
+    """Return the number of emails with words in source, from the statistics.
+
+    Databases imported before the statistics existed have no corpus_stats
+    table, their count is 0 like that of a database never imported into.
+    """
+    with conn.cursor() as cursor:
+        try:
+            cursor.execute(f"SELECT {source}_emails FROM corpus_stats;")
+        except psycopg2.errors.UndefinedTable:
+            conn.rollback()
+            return 0
+        row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def load_document_frequencies(conn, source, n_words):
+    """Return the document frequency of every word id and the number of emails.
+
+    Both are read from the aggregates maintained at import, in one scan of
+    word_stats. Databases imported before those existed fall back to counting
+    the occurrence table, until `import.py rebuild-stats` is run.
+    """
+    df = np.zeros(n_words)
+    n_emails = count_emails(conn, source)
+    with conn.cursor() as cursor:
+        if n_emails:
+            cursor.execute(
+                f"SELECT word_id, {source}_df FROM word_stats WHERE {source}_df > 0;"
+            )
+        else:
+            print("No word statistics, run `import.py rebuild-stats` to add them")
+            table = OCCURRENCE_TABLES[source]
+            cursor.execute(f"SELECT COUNT(DISTINCT email_id) FROM {table};")
+            n_emails = cursor.fetchone()[0]
+            cursor.execute(f"SELECT word_id, COUNT(*) FROM {table} GROUP BY word_id;")
+        rows = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 2)
+    df[rows[:, 0]] = rows[:, 1]
+    return df, n_emails
+
+
+def prunes_vocabulary(min_df, max_df):
+    """Whether min_df and max_df can leave out any word."""
+    keeps_all = (
+        isinstance(min_df, int)
+        and min_df <= 1
+        and isinstance(max_df, float)
+        and max_df >= 1.0
+    )
+    return not keeps_all
+
+
+def load_vocabulary(conn, source, min_df=1, max_df=1.0):
+    """Return the ids of the words within the document frequency bounds.
+
+    Like CountVectorizer's, integer bounds are numbers of emails and float
+    bounds proportions of the emails. Served by an index-only scan of the
+    word_stats document frequency index.
+    """
+    n_emails = count_emails(conn, source)
+    if not n_emails:
+        raise RuntimeError(
+            "No word statistics, run `import.py rebuild-stats` to add them"
+        )
+    with conn.cursor() as cursor:
+        low = min_df if isinstance(min_df, int) else math.ceil(min_df * n_emails)
+        high = max_df if isinstance(max_df, int) else math.floor(max_df * n_emails)
+        cursor.execute(
+            f"SELECT word_id FROM word_stats WHERE {source}_df BETWEEN %s AND %s "
+            "ORDER BY word_id;",
+            (max(low, 1), high),
+        )
+        return np.array([word_id for (word_id,) in cursor.fetchall()], dtype=np.int64)
+
+
+def vocabulary_mask(conn, source, n_words, min_df=1, max_df=1.0):
+    """Return a 0/1 weight per word id keeping the vocabulary, None for all."""
+    if not prunes_vocabulary(min_df, max_df):
+        return None
+    mask = np.zeros(n_words)
+    mask[load_vocabulary(conn, source, min_df, max_df)] = 1
+    return mask
+
+
+def load_idf(conn, source, n_words, idf_path=None, refresh=False):
+    """Load the persisted IDF weighting, computing it from the database once.
+
+    The weighting matches TfidfTransformer(smooth_idf=True) and is indexed by
+    word id. It is extended with the default weight for words added since it
+    was persisted.
+    """
+    idf_path = idf_path or DEFAULT_IDF_PATH.format(source=source)
+    if os.path.exists(idf_path) and not refresh:
+        with np.load(idf_path) as data:
+            idf, n_emails = data["idf"], int(data["n_emails"])
+        if len(idf) < n_words:
+            default = np.log(1 + n_emails) + 1
+            idf = np.concatenate([idf, np.full(n_words - len(idf), default)])
+        return idf[:n_words]
+
+    df, n_emails = load_document_frequencies(conn, source, n_words)
+    idf = np.log((1 + n_emails) / (1 + df)) + 1
+    np.savez(idf_path, idf=idf, n_emails=n_emails)
+    return idf
+
+
+def weight_chunk(chunk, idf):
+    """Apply the IDF weighting and L2 row normalization to a DTM chunk."""
+    return normalize(sparse.csr_matrix(chunk.multiply(idf)), norm="l2")
+
+
+def prune_chunk(chunk, mask):
+    """Drop the columns of the words left out of the vocabulary."""
+    if mask is None:
+        return chunk
+    pruned = sparse.csr_matrix(chunk.multiply(mask))
+    pruned.eliminate_zeros()
+    return pruned
+
+
+def cluster_out_of_core(
+    source="subject",
+    n_clusters=6,
+    emails_per_chunk=DEFAULT_EMAILS_PER_CHUNK,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    epochs=1,
+    idf_path=None,
+    refresh_idf=False,
+    min_df=1,
+    max_df=1.0,
+):
+    """Cluster emails with MiniBatchKMeans without loading the whole DTM.
+
+    A first streaming pass (repeated for every epoch) fits the model with
+    partial_fit on IDF-weighted chunks. A second streaming pass assigns the
+    labels and accumulates the word counts of every cluster. Memory stays
+    bounded by the chunk size plus one label per email.
 
     Returns:
-    - None
+    - email_ids: np.ndarray
+        The email id of every clustered email.
+    - labels: np.ndarray
+        The cluster label of every email.
+    - word_sums: scipy.sparse.csr_matrix
+        Clusters x word ids matrix of summed occurrence counts.
     """
-    # Separate the cluster labels
-    clusters = dtm[cluster_col]
-    dtm_no_cluster = dtm.drop(columns=[cluster_col])
+    conn = psycopg2.connect(**db_config)
+    n_words = count_words_table(conn)
+    idf = load_idf(conn, source, n_words, idf_path, refresh_idf)
+    mask = vocabulary_mask(conn, source, n_words, min_df, max_df)
+
+    def chunks():
+        for email_ids, chunk in iter_dtm_chunks(
+            conn, source, n_words, emails_per_chunk, chunk_size
+        ):
+            yield email_ids, prune_chunk(chunk, mask)
+
+    kmeans = MiniBatchKMeans(
+        n_clusters=n_clusters, batch_size=emails_per_chunk, random_state=42
+    )
+    for epoch in range(epochs):
+        for _, chunk in chunks():
+            # Each partial_fit needs at least one email per cluster
+            if chunk.shape[0] >= n_clusters:
+                kmeans.partial_fit(weight_chunk(chunk, idf))
+        print(f"Finished epoch {epoch + 1} of {epochs}")
+
+    email_ids, labels = [], []
+    word_sums = sparse.csr_matrix((n_clusters, n_words))
+    for chunk_email_ids, chunk in chunks():
+        chunk_labels = kmeans.predict(weight_chunk(chunk, idf))
+        email_ids.append(chunk_email_ids)
+        labels.append(chunk_labels)
+        word_sums = word_sums + cluster_word_sums(chunk, chunk_labels, n_clusters)
+    conn.close()
+
+    return np.concatenate(email_ids), np.concatenate(labels), word_sums
+
+
+# Elbow Method to determine optimal number of clusters
+def elbow_analysis(X, path="elbow.png"):
+    results = sweep_cluster_counts(X, range(2, 15))
+    plot_sweep(results, "inertia", path, "Elbow Analysis", "WCSS")
+    print(f"Saved elbow analysis to {path}")
+
+
+# Silhouette Score to evaluate clustering performance
+def silhouette_analysis(X, path="silhouette.png"):
+    results = sweep_cluster_counts(X, range(2, 15))
+    plot_sweep(
+        results, "silhouette", path, "Silhouette Score Analysis", "Silhouette Score"
+    )
+    print(f"Saved silhouette analysis to {path}")
+
+
+def plot_3d_svd(dtm, clusters, tfidf=True, path="clusters_3d.png"):
+    """Render a 3D plot of the clustered emails of the DTM to an image file.
 
-    # Apply TF-IDF transformation if specified
+    The DTM is projected with sparse truncated SVD (see plot_clusters_3d),
+    after a TF-IDF transformation if tfidf is set.
+    """
     if tfidf:
         tfidf_transformer = TfidfTransformer(norm=None, use_idf=True, smooth_idf=True)
-        dtm_transformed = tfidf_transformer.fit_transform(dtm_no_cluster)
-    else:
-        dtm_transformed = dtm_no_cluster
-
-    # Perform PCA to reduce the dimensionality
-    pca = PCA(n_components=n_components)
-    pca_result = pca.fit_transform(dtm_transformed.toarray())
-
-    # Convert the PCA result to a DataFrame for easier plotting
-    pca_df = pd.DataFrame(pca_result, columns=[f"PC{i+1}" for i in range(n_components)])
-    pca_df[cluster_col] = clusters.values
-
-    # Plot the 3D PCA plot
-    fig = plt.figure(figsize=(10, 8))
-    ax = fig.add_subplot(111, projection="3d")
-
-    # Scatter plot, color-coded by cluster
-    scatter = ax.scatter(
-        pca_df["PC1"],
-        pca_df["PC2"],
-        pca_df["PC3"],
-        c=pca_df[cluster_col],
-        cmap=cmap,
-        marker="o",
-    )
-
-    # Set labels
-    ax.set_xlabel("Principal Component 1")
-    ax.set_ylabel("Principal Component 2")
-    ax.set_zlabel("Principal Component 3")
-    ax.set_title("3D PCA of Email Data")
-
-    # Add a color bar
-    cbar = plt.colorbar(scatter, ax=ax)
-    cbar.set_label("Cluster")
-
-    plt.show()
-
-
-data = load_data_from_db()
-print(data.head())
-
-# Pivot the data to create a document-term matrix (DTM)
-dtm = data.pivot_table(index="email_id", columns="word", values="count", fill_value=0)
-print(dtm.head())
-
-# elbow_analysis(dtm)  # definitely 6
-# silhouette_analysis(dtm)  # definitely 4, maybe 13
-# exit(0)
-
-# Number of clusters
-n_clusters = 6
-
-# Apply KMeans
-kmeans = KMeans(n_clusters=n_clusters, random_state=42)
-labels = kmeans.fit_predict(dtm)
-
-# Add the cluster labels to the original dataframe
-dtm["cluster"] = labels
-
-plot_3d_pca(dtm, cluster_col="cluster", n_components=3, tfidf=True, cmap="viridis")
-
-# Calculate word frequencies per cluster
-word_freq_per_cluster = dtm.groupby("cluster").sum()
-
-# Normalize by cluster size
-cluster_sizes = dtm["cluster"].value_counts().sort_index()
-word_freq_per_cluster_normalized = word_freq_per_cluster.div(cluster_sizes, axis=0)
-
-# Calculate a "characteristic score" using TF-IDF
-tfidf_transformer = TfidfTransformer(norm=None, use_idf=True, smooth_idf=True)
-tfidf_matrix = tfidf_transformer.fit_transform(word_freq_per_cluster_normalized)
-
-# Convert TF-IDF matrix back to a DataFrame for easier analysis
-tfidf_df = pd.DataFrame(
-    tfidf_matrix.toarray(),
-    index=word_freq_per_cluster.index,
-    columns=word_freq_per_cluster.columns,
-)
-
-tfidf_df = tfidf_df.sub(tfidf_df.mean(axis=0), axis=1)
-
-# Generate WordClouds for each cluster based on the characteristic words
-for cluster_num in range(tfidf_df.shape[0]):
-    # Get the TF-IDF scores for the cluster
-    characteristic_words = tfidf_df.iloc[cluster_num].sort_values(ascending=False)
-    print(f"Cluster {cluster_num}:")
-    # print top 10
-    for word, score in characteristic_words.head(10).items():
-        print(f"  {word}: {score:.4f}")
-    print("\n")
-
-    # Generate the word cloud
-    # wordcloud = WordCloud(
-    # width=800, height=400, background_color="white"
-    # ).generate_from_frequencies(characteristic_words)
-
-    # Display the word cloud
-    # plt.figure(figsize=(10, 5))
-    # plt.imshow(wordcloud, interpolation="bilinear")
-    # plt.title(f"WordCloud for Cluster {cluster_num}")
-    # plt.axis("off")
-    # plt.show()
+        dtm = tfidf_transformer.fit_transform(dtm)
+    plot_clusters_3d(dtm, clusters, path, "3D SVD of Email Data")
+    print(f"Saved 3D cluster plot to {path}")
+
+
+def cluster_word_sums(dtm, labels, n_clusters):
+    """Sum the word counts of every cluster."""
+    # Sparse cluster x email indicator matrix
+    indicator = sparse.csr_matrix(
+        (np.ones(len(labels)), (labels, np.arange(len(labels)))),
+        shape=(n_clusters, len(labels)),
+    )
+    return sparse.csr_matrix(indicator @ dtm)
+
+
+def normalize_cluster_sums(word_sums, labels, n_clusters):
+    """Divide the word counts of every cluster by the cluster size."""
+    cluster_sizes = np.bincount(labels, minlength=n_clusters)
+    return sparse.diags(1 / np.maximum(cluster_sizes, 1)) @ word_sums
+
+
+def cluster_word_frequencies(dtm, labels, n_clusters):
+    """Sum the word counts of every cluster, normalized by cluster size."""
+    word_sums = cluster_word_sums(dtm, labels, n_clusters)
+    return normalize_cluster_sums(word_sums, labels, n_clusters)
+
+
+def print_characteristic_words(word_freq_per_cluster_normalized, words):
+    """Print the most characteristic words of every cluster."""
+    n_clusters = word_freq_per_cluster_normalized.shape[0]
+
+    # Calculate a "characteristic score" using TF-IDF
+    tfidf_transformer = TfidfTransformer(norm=None, use_idf=True, smooth_idf=True)
+    tfidf_matrix = tfidf_transformer.fit_transform(word_freq_per_cluster_normalized)
+
+    # Convert TF-IDF matrix back to a DataFrame for easier analysis
+    tfidf_df = pd.DataFrame(
+        tfidf_matrix.toarray(),
+        index=range(n_clusters),
+        columns=words,
+    )
+
+    tfidf_df = tfidf_df.sub(tfidf_df.mean(axis=0), axis=1)
+
+    # Generate WordClouds for each cluster based on the characteristic words
+    for cluster_num in range(tfidf_df.shape[0]):
+        # Get the TF-IDF scores for the cluster
+        characteristic_words = tfidf_df.iloc[cluster_num].sort_values(ascending=False)
+        print(f"Cluster {cluster_num}:")
+        # print top 10
+        for word, score in characteristic_words.head(10).items():
+            print(f"  {word}: {score:.4f}")
+        print("\n")
+
+        # Generate the word cloud
+        # wordcloud = WordCloud(
+        # width=800, height=400, background_color="white"
+        # ).generate_from_frequencies(characteristic_words)
+
+        # Display the word cloud
+        # plt.figure(figsize=(10, 5))
+        # plt.imshow(wordcloud, interpolation="bilinear")
+        # plt.title(f"WordCloud for Cluster {cluster_num}")
+        # plt.axis("off")
+        # plt.show()
+
+
+def compare_full_batch(args, n_clusters, labels):
+    """Score out-of-core labels against full-batch KMeans runs.
+
+    Returns two adjusted Rand indexes. The first is against KMeans on the
+    same IDF-weighted, L2-normalized rows, so it only measures the mini-batch
+    approximation. The second is against KMeans on raw counts, like the
+    default path, so it also covers the weighting; emails left without words
+    by the vocabulary bounds are left out of it, as the default path leaves
+    them out of its DTM.
+
+    The whole DTM is loaded for this, so it is only viable on corpora that
+    fit in memory.
+    """
+    conn = psycopg2.connect(**db_config)
+    n_words = count_words_table(conn)
+    idf = load_idf(conn, args.source, n_words, args.idf_path)
+    mask = vocabulary_mask(conn, args.source, n_words, args.min_df, args.max_df)
+    chunks = iter_dtm_chunks(
+        conn, args.source, n_words, args.emails_per_chunk, args.chunk_size
+    )
+    dtm = sparse.vstack([prune_chunk(chunk, mask) for _, chunk in chunks], format="csr")
+    conn.close()
+
+    kmeans = KMeans(n_clusters=n_clusters, random_state=42)
+    weighted_labels = kmeans.fit_predict(weight_chunk(dtm, idf))
+    rows = dtm.getnnz(axis=1) > 0
+    raw_labels = kmeans.fit_predict(dtm[rows])
+    return (
+        adjusted_rand_score(weighted_labels, labels),
+        adjusted_rand_score(raw_labels, labels[rows]),
+    )
+
+
+def run_out_of_core(args, n_clusters):
+    """Cluster with out-of-core MiniBatchKMeans and report the clusters."""
+    email_ids, labels, word_sums = cluster_out_of_core(
+        args.source,
+        n_clusters,
+        args.emails_per_chunk,
+        args.chunk_size,
+        args.epochs,
+        args.idf_path,
+        args.refresh_idf,
+        args.min_df,
+        args.max_df,
+    )
+    print(f"Clustered {len(email_ids)} emails out of core")
+    print(f"Cluster sizes: {np.bincount(labels, minlength=n_clusters).tolist()}")
+
+    if args.labels_out:
+        pd.DataFrame({"email_id": email_ids, "cluster": labels}).to_csv(
+            args.labels_out, index=False
+        )
+
+    if args.compare:
+        weighted, raw = compare_full_batch(args, n_clusters, labels)
+        print(
+            f"Adjusted Rand index vs. full-batch KMeans, same weighting: {weighted:.4f}"
+        )
+        print(f"Adjusted Rand index vs. full-batch KMeans, raw counts: {raw:.4f}")
+
+    # Only keep the words that occur in any cluster
+    word_ids = np.unique(word_sums.indices)
+    conn = psycopg2.connect(**db_config)
+    words = load_words(conn, word_ids)
+    conn.close()
+    print_characteristic_words(
+        normalize_cluster_sums(word_sums[:, word_ids], labels, n_clusters), words
+    )
+
+
+def document_frequency(value):
+    """Parse a min_df/max_df bound: an integer count or a float proportion."""
+    return int(value) if value.isdigit() else float(value)
+
+
+def parse_args():
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(description="Cluster the imported emails.")
+    parser.add_argument(
+        "--source",
+        choices=sorted(OCCURRENCE_TABLES),
+        default="subject",
+        help="which word occurrences to build the document-term matrix from",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help="occurrence rows fetched from the database at a time",
+    )
+    parser.add_argument(
+        "--min-df",
+        type=document_frequency,
+        default=1,
+        help="leave out words in fewer emails, a count or a proportion",
+    )
+    parser.add_argument(
+        "--max-df",
+        type=document_frequency,
+        default=1.0,
+        help="leave out words in more emails, a count or a proportion",
+    )
+    parser.add_argument(
+        "--features-dir",
+        default=DEFAULT_FEATURES_DIR,
+        help="where document-term matrices are stored between runs",
+    )
+    parser.add_argument(
+        "--refresh-features",
+        action="store_true",
+        help="rebuild the stored document-term matrix from the database",
+    )
+    parser.add_argument(
+        "--sweep",
+        action="store_true",
+        help="render the elbow and silhouette analyses to PNG and exit",
+    )
+    parser.add_argument(
+        "--out-of-core",
+        action="store_true",
+        help="stream the DTM and cluster it with MiniBatchKMeans",
+    )
+    parser.add_argument(
+        "--emails-per-chunk",
+        type=int,
+        default=DEFAULT_EMAILS_PER_CHUNK,
+        help="emails per mini-batch in out-of-core mode",
+    )
+    parser.add_argument(
+        "--epochs",
+        type=int,
+        default=1,
+        help="streaming passes used to fit the out-of-core model",
+    )
+    parser.add_argument(
+        "--idf-path", help="where the out-of-core IDF weighting is persisted"
+    )
+    parser.add_argument(
+        "--refresh-idf",
+        action="store_true",
+        help="recompute the persisted IDF weighting from the database",
+    )
+    parser.add_argument(
+        "--labels-out", help="write the out-of-core email labels to this CSV"
+    )
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        help="compare out-of-core labels with full-batch KMeans runs",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    # Number of clusters
+    n_clusters = 6
+
+    if args.out_of_core:
+        run_out_of_core(args, n_clusters)
+        return
+
+    # Build the sparse document-term matrix (DTM)
+    dtm, words, email_ids = load_stored_dtm(
+        args.source,
+        args.chunk_size,
+        args.min_df,
+        args.max_df,
+        args.features_dir,
+        args.refresh_features,
+    )
+    print(f"Loaded {dtm.shape[0]} emails x {dtm.shape[1]} words, {dtm.nnz} entries")
+
+    if args.sweep:
+        elbow_analysis(dtm)  # definitely 6
+        silhouette_analysis(dtm)  # definitely 4, maybe 13
+        return
+
+    # Apply KMeans
+    kmeans = KMeans(n_clusters=n_clusters, random_state=42)
+    labels = kmeans.fit_predict(dtm)
+
+    plot_3d_svd(dtm, labels, tfidf=True)
+
+    # Calculate word frequencies per cluster, normalized by cluster size
+    print_characteristic_words(cluster_word_frequencies(dtm, labels, n_clusters), words)
+
+
+if __name__ == "__main__":
+    main()
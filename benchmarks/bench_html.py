@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""Compare the single pass HTML extractor with the former regex chain.
+
+HTML parts are taken from the given email directories or mbox files, or
+synthesized as large newsletters when no path is given:
+
+    python benchmarks/bench_html.py datasets/maildir --limit 5000
+"""
+from common import iter_corpus
+from html_text import DEFAULT_MAX_TEXT_LENGTH, html_to_text
+from mime_parser import iter_text_parts
+import argparse
+import re
+import time
+
+# Regexes of the former EmailProcessor.clean_html
+REGEX_HTML_SCRIPTS = re.compile(r"(?is)<(script|style).*?>.*?</\1>")
+REGEX_HTML_TAGS = re.compile(r"<[^>]+>")
+REGEX_HTML_ENTITY = re.compile(r"&[a-zA-Z]+[0-9]*;")
+
+
+def clean_html_regex(html_content):
+    """The former three pass regex chain."""
+    html_content = re.sub(REGEX_HTML_SCRIPTS, " ", html_content)
+    html_content = re.sub(REGEX_HTML_TAGS, " ", html_content)
+    return re.sub(REGEX_HTML_ENTITY, " ", html_content)
+
+
+def synthetic_newsletter(size):
+    """Build a script and style heavy marketing email of about size bytes."""
+    block = (
+        '<style type="text/css">.promo td { padding: 4px; color: #333; }</style>'
+        '<table class="promo"><tr><td><a href="https://example.com/deal?id=1">'
+        "Save 50% on everything &mdash; today only&nbsp;&amp; free shipping"
+        '</a></td><td><img src="https://example.com/pixel.gif" alt=""/></td></tr>'
+        "</table><script>window.dataLayer = window.dataLayer || [];"
+        " if (a < b && b > c) { track('open'); }</script>"
+        "<p>Unsubscribe &copy; Example Inc, 1 Main St.</p>\n"
+    )
+    return "<html><body>" + block * (size // len(block)) + "</body></html>"
+
+
+def load_html_parts(paths, limit):
+    """Collect the decoded text/html parts of a corpus."""
+    return [
+        text
+        for raw in iter_corpus(paths, limit)
+        for content_type, text in iter_text_parts(raw)
+        if content_type == "text/html"
+    ]
+
+
+def time_cleaner(cleaner, documents, repeat):
+    """Return the best total time, in seconds, over the repeats."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for document in documents:
+            cleaner(document)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="*", help="email directories or mbox files")
+    parser.add_argument("--limit", type=int, default=10000, help="emails to load")
+    parser.add_argument("--repeat", type=int, default=3, help="timed repeats")
+    parser.add_argument(
+        "--size", type=int, default=500000, help="bytes of a synthetic newsletter"
+    )
+    parser.add_argument(
+        "--count", type=int, default=20, help="synthetic newsletters to clean"
+    )
+    parser.add_argument(
+        "--max-text",
+        type=int,
+        default=DEFAULT_MAX_TEXT_LENGTH,
+        help="text length cap of the single pass extractor",
+    )
+    args = parser.parse_args()
+
+    if args.paths:
+        documents = load_html_parts(args.paths, args.limit)
+        if not documents:
+            parser.error("no HTML parts found")
+    else:
+        documents = [synthetic_newsletter(args.size)] * args.count
+    total = sum(len(document) for document in documents)
+    print(f"{len(documents)} HTML parts, {total / 1e6:.1f} MB")
+
+    regex_time = time_cleaner(clean_html_regex, documents, args.repeat)
+    stream_time = time_cleaner(
+        lambda document: html_to_text(document, args.max_text),
+        documents,
+        args.repeat,
+    )
+    for name, elapsed in (("regex", regex_time), ("single pass", stream_time)):
+        print(f"{name:>12}: {elapsed:8.3f} s, {total / elapsed / 1e6:8.1f} MB/s")
+    print(f"{'speedup':>12}: {regex_time / stream_time:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""Compare the default and lazy MIME parsing paths of import.py.
+
+Example, on the Enron maildir and a Gmail Takeout export:
+
+    python benchmarks/bench_parse.py datasets/maildir "datasets/All mail.mbox"
+"""
+from common import iter_corpus, load_import_module
+import argparse
+import statistics
+import time
+
+
+def time_parsing(processor, messages, repeat):
+    """Return the best per-message parse time, in seconds, over the repeats."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for raw in messages:
+            processor.parse_email_bytes("", raw)
+        timings.append((time.perf_counter() - start) / len(messages))
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="+", help="email directories or mbox files")
+    parser.add_argument("--limit", type=int, default=10000, help="emails to load")
+    parser.add_argument("--repeat", type=int, default=3, help="timed repeats")
+    parser.add_argument(
+        "--normalize",
+        action="store_true",
+        help="include NLTK normalization in the timings instead of a plain split",
+    )
+    args = parser.parse_args()
+
+    module = load_import_module()
+    messages = list(iter_corpus(args.paths, args.limit))
+    if not messages:
+        parser.error("no emails found")
+    sizes = [len(raw) for raw in messages]
+    print(
+        f"{len(messages)} emails, median size {statistics.median(sizes):.0f} bytes, "
+        f"max size {max(sizes)} bytes"
+    )
+
+    results = {}
+    for name, lazy_parsing in (("default", False), ("lazy", True)):
+        processor = module.EmailProcessor(None, lazy_parsing=lazy_parsing)
+        if not args.normalize:
+            # Isolate the cost of MIME parsing from the cost of normalization
+            processor.normalize_content = lambda content: content.lower().split()
+        results[name] = time_parsing(processor, messages, args.repeat)
+        print(f"{name:>8}: {results[name] * 1e6:10.1f} us/email")
+
+    print(f" speedup: {results['default'] / results['lazy']:10.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+"""Measure throughput and peak memory of every ingest and analysis stage.
+
+A deterministic synthetic corpus is generated (see corpus.py), each stage is
+timed on it and the results are written to JSON. A previous result file can
+be passed to flag regressions:
+
+    python benchmarks/bench_suite.py --output before.json
+    python benchmarks/bench_suite.py --output after.json --compare before.json
+
+Database stages only run with --db, against the Postgres service of
+docker-compose.yaml (`docker compose up -d postgres`). They use a separate
+database, sieve_bench by default, whose tables are dropped between runs.
+"""
+from common import REPO_ROOT, load_import_module
+from corpus import DEFAULT_ATTACHMENT_SIZE, write_corpus
+from email import policy
+from email.parser import BytesParser
+import argparse
+import datetime
+import gc
+import json
+import logging
+import os
+import platform
+import psycopg2
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Relative throughput drop, or peak memory growth, reported as a regression
+DEFAULT_THRESHOLD = 0.10
+
+# Database the database stages run against, next to the real one
+DEFAULT_BENCH_DATABASE = "sieve_bench"
+
+# Registered stages, in the order they run: name -> (function, needs_db)
+STAGES = {}
+
+
+def stage(name, needs_db=False):
+    """Register a stage.
+
+    A stage function receives the BenchmarkContext, does its untimed setup
+    and returns (run, items, size): the callable to time, the number of
+    emails it handles and the number of bytes (or characters) it reads.
+    """
+
+    def register(function):
+        STAGES[name] = (function, needs_db)
+        return function
+
+    return register
+
+
+class BenchmarkContext:
+    """Corpus and configuration shared by the stages."""
+
+    def __init__(self, corpus, work_dir, args):
+        self.corpus = corpus
+        self.work_dir = work_dir
+        self.workers = args.workers
+        self.bulk_batch_size = args.batch_size
+        self.db_config = None
+        self.module = load_import_module()
+        self.eml_paths = sorted(
+            os.path.join(corpus["eml_dir"], name)
+            for name in os.listdir(corpus["eml_dir"])
+        )
+        self._messages = None
+        self._bodies = None
+
+    def processor(self, db=False, **kwargs):
+        """Create an EmailProcessor, with a storage directory of its own."""
+        storage_dir = tempfile.mkdtemp(dir=self.work_dir)
+        return self.module.EmailProcessor(
+            self.db_config if db else None,
+            storage_dir=storage_dir,
+            max_workers=self.workers,
+            bulk_batch_size=self.bulk_batch_size,
+            **kwargs,
+        )
+
+    def messages(self):
+        """Parsed messages of the corpus, built once."""
+        if self._messages is None:
+            parser = BytesParser(policy=policy.default)
+            self._messages = []
+            for path in self.eml_paths:
+                with open(path, "rb") as file:
+                    self._messages.append(parser.parse(file))
+        return self._messages
+
+    def bodies(self):
+        """Extracted bodies of the corpus, built once."""
+        if self._bodies is None:
+            processor = self.processor()
+            self._bodies = [processor.extract_body(msg) for msg in self.messages()]
+        return self._bodies
+
+    def reset_database(self):
+        """Drop and recreate the tables of the benchmark database."""
+        processor = self.processor(db=True)
+        try:
+            processor.drop_tables()
+            processor.create_tables()
+        finally:
+            processor.close()
+
+
+@stage("store_mbox_file")
+def bench_store_mbox_file(context):
+    # store_mbox_file deletes its input, so it works on a copy
+    mbox_path = os.path.join(tempfile.mkdtemp(dir=context.work_dir), "dirty.mbox")
+    shutil.copyfile(context.corpus["mbox_path"], mbox_path)
+    processor = context.processor()
+    size = os.path.getsize(mbox_path)
+    return (
+        lambda: processor.store_mbox_file(mbox_path),
+        context.corpus["count"],
+        size,
+    )
+
+
+@stage("extract_body")
+def bench_extract_body(context):
+    messages = context.messages()
+    processor = context.processor()
+    size = sum(os.path.getsize(path) for path in context.eml_paths)
+
+    def run():
+        for msg in messages:
+            processor.extract_body(msg)
+
+    return run, len(messages), size
+
+
+@stage("normalize_content")
+def bench_normalize_content(context):
+    bodies = context.bodies()
+    # A new processor starts with a cold token cache
+    processor = context.processor()
+    processor.normalizer.preload()
+
+    def run():
+        for body in bodies:
+            processor.normalize_content(body)
+
+    return run, len(bodies), sum(len(body) for body in bodies)
+
+
+@stage("process_email", needs_db=True)
+def bench_process_email(context):
+    context.reset_database()
+    processor = context.processor(db=True)
+    processor.normalizer.preload()
+    paths = context.eml_paths
+    size = sum(os.path.getsize(path) for path in paths)
+
+    def run():
+        try:
+            failed = [path for path in paths if not processor.process_email(path)]
+        finally:
+            processor.close()
+        if failed:
+            raise RuntimeError(f"{len(failed)} emails failed to process")
+
+    return run, len(paths), size
+
+
+@stage("submit_email_parts", needs_db=True)
+def bench_submit_email_parts(context):
+    context.reset_database()
+    processor = context.processor(db=True)
+    emails = []
+    for path in context.eml_paths:
+        sha_hash, addresses, subject_counts, body_counts = processor.parse_email(path)
+        emails.append(
+            (
+                sha_hash,
+                addresses,
+                [word for word, count in subject_counts.items() for _ in range(count)],
+                [word for word, count in body_counts.items() for _ in range(count)],
+            )
+        )
+
+    def run():
+        try:
+            for email in emails:
+                processor.submit_email_parts(*email)
+        finally:
+            processor.close()
+
+    return run, len(emails), 0
+
+
+@stage("analyze", needs_db=True)
+def bench_analyze(context):
+    # Clusters whatever the database stages imported, importing first if needed
+    with psycopg2.connect(**context.db_config) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT to_regclass('emails') IS NOT NULL;")
+            imported = cursor.fetchone()[0]
+            if imported:
+                cursor.execute("SELECT count(*) FROM emails;")
+                imported = cursor.fetchone()[0] == context.corpus["count"]
+    conn.close()
+    if not imported:
+        run, _, _ = bench_process_email(context)
+        run()
+
+    # Imported here so the other stages do not need the analysis dependencies
+    import analyze
+    from sklearn.cluster import KMeans
+
+    analyze.db_config = context.db_config
+
+    def run():
+        dtm, words, email_ids = analyze.load_sparse_dtm("body")
+        KMeans(n_clusters=min(6, dtm.shape[0]), random_state=42).fit(dtm)
+
+    return run, context.corpus["count"], 0
+
+
+def measure(function, context, repeat):
+    """Time a stage, keeping the best of the repeats, then trace its memory.
+
+    Memory is traced in a run of its own, since tracemalloc slows Python
+    allocations down. Setup is redone before every run and never measured.
+    """
+    timings = []
+    for _ in range(repeat):
+        run, items, size = function(context)
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+
+    run, items, size = function(context)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    seconds = min(timings)
+    return {
+        "items": items,
+        "bytes": size,
+        "seconds": seconds,
+        "timings": timings,
+        "items_per_second": items / seconds,
+        "mb_per_second": size / seconds / 1e6 if size else None,
+        "peak_memory_mb": peak / 1e6,
+    }
+
+
+def bench_database(db_config, name):
+    """Return the benchmark database config, creating the database if needed."""
+    conn = psycopg2.connect(**db_config)
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_database WHERE datname = %s;", (name,))
+        if cursor.fetchone() is None:
+            cursor.execute(f'CREATE DATABASE "{name}";')
+    conn.close()
+    return dict(db_config, dbname=name)
+
+
+def error_summary(error):
+    """Return the first meaningful line of an error message."""
+    for line in str(error).splitlines():
+        if line.strip("* "):
+            return line.strip()
+    return ""
+
+
+def git_commit():
+    """Return the commit the benchmarked tree is at, if known."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=REPO_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """Return the regressions of results against a baseline result file.
+
+    A stage regresses when its throughput drops, or its peak memory grows, by
+    more than threshold (relative).
+    """
+    regressions = []
+    for name, current in results["stages"].items():
+        previous = baseline["stages"].get(name)
+        if not previous or "error" in current or "error" in previous:
+            continue
+        throughput = current["items_per_second"] / previous["items_per_second"] - 1
+        memory = current["peak_memory_mb"] / max(previous["peak_memory_mb"], 1e-6) - 1
+        print(f"{name:>20}: throughput {throughput:+7.1%}, peak memory {memory:+7.1%}")
+        if throughput < -threshold:
+            regressions.append(f"{name}: throughput {throughput:+.1%}")
+        if memory > threshold:
+            regressions.append(f"{name}: peak memory {memory:+.1%}")
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=500, help="emails in the corpus")
+    parser.add_argument("--seed", type=int, default=0, help="corpus random seed")
+    parser.add_argument(
+        "--attachment-size",
+        type=int,
+        default=DEFAULT_ATTACHMENT_SIZE,
+        help="bytes of each binary attachment",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage")
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=list(STAGES),
+        default=list(STAGES),
+        help="stages to run",
+    )
+    parser.add_argument("--workers", type=int, default=8, help="processor threads")
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=None,
+        help="emails per bulk transaction, default submits emails one by one",
+    )
+    parser.add_argument(
+        "--db", action="store_true", help="also run the database stages"
+    )
+    parser.add_argument(
+        "--db-name",
+        default=DEFAULT_BENCH_DATABASE,
+        help="database the database stages run against",
+    )
+    parser.add_argument(
+        "--work-dir", help="where the corpus and storage go, a temporary directory"
+    )
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--compare", help="JSON results to compare against")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="relative change reported as a regression",
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="keep the per-email logging"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="sieve-bench-")
+    os.makedirs(work_dir, exist_ok=True)
+
+    corpus = write_corpus(
+        os.path.join(work_dir, "corpus"),
+        args.count,
+        args.seed,
+        attachment_size=args.attachment_size,
+    )
+    print(f"Corpus: {corpus['count']} emails, {corpus['bytes'] / 1e6:.1f} MB")
+
+    context = BenchmarkContext(corpus, work_dir, args)
+    if not args.verbose:
+        # Per-email log lines would dominate the timings of the fast stages
+        logging.getLogger(context.module.__name__).setLevel(logging.WARNING)
+    if args.db:
+        try:
+            context.db_config = bench_database(context.module.db_config, args.db_name)
+        except psycopg2.OperationalError as e:
+            sys.exit(f"{e}\nStart the database with `docker compose up -d postgres`.")
+
+    results = {
+        "metadata": {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "count": args.count,
+            "seed": args.seed,
+            "attachment_size": args.attachment_size,
+            "corpus_bytes": corpus["bytes"],
+            "kinds": corpus["kinds"],
+            "repeat": args.repeat,
+            "workers": args.workers,
+            "batch_size": args.batch_size,
+        },
+        "stages": {},
+    }
+
+    try:
+        for name in args.stages:
+            function, needs_db = STAGES[name]
+            if needs_db and not args.db:
+                continue
+            try:
+                result = measure(function, context, args.repeat)
+            except Exception as e:
+                # Missing NLTK data for instance, keep measuring the other stages
+                error = f"{type(e).__name__}: {error_summary(e)}"
+                print(f"{name:>20}: failed, {error}")
+                results["stages"][name] = {"error": error}
+                continue
+            results["stages"][name] = result
+            print(
+                f"{name:>20}: {result['items_per_second']:10.1f} emails/s, "
+                f"peak {result['peak_memory_mb']:8.1f} MB"
+            )
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r") as file:
+            baseline = json.load(file)
+        regressions = compare_results(results, baseline, args.threshold)
+        if regressions:
+            print("Regressions:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import importlib.util
+import os
+import sys
+
+# Root of the repository, where the scripts under benchmark live
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+
+def load_import_module():
+    """Load import.py, whose name cannot be used in an import statement."""
+    spec = importlib.util.spec_from_file_location(
+        "sieve_import", os.path.join(REPO_ROOT, "import.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def iter_corpus(paths, limit=None):
+    """Yield the raw bytes of the emails found in directories or mbox files.
+
+    Directories are walked recursively and every regular file is read as one
+    email (maildir, Enron and storage layouts); other paths are read as mbox
+    files (Gmail Takeout exports).
+    """
+    from mbox_reader import MboxReader
+
+    count = 0
+    for path in paths:
+        if os.path.isdir(path):
+            messages = iter_directory(path)
+        else:
+            messages = iter_mbox(MboxReader, path)
+        for raw in messages:
+            if limit is not None and count >= limit:
+                return
+            yield raw
+            count += 1
+
+
+def iter_directory(path):
+    """Yield the bytes of every file under a directory."""
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            with open(os.path.join(root, name), "rb") as file:
+                yield file.read()
+
+
+def iter_mbox(reader_class, path):
+    """Yield the bytes of every message of an mbox file."""
+    with reader_class(path) as mbox:
+        for raw in mbox:
+            yield bytes(raw)
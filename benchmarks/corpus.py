@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""Generate a deterministic synthetic email corpus, as .eml files and an mbox.
+
+The same seed and count always produce byte-identical files, so benchmark
+runs on different machines or commits work on the same input:
+
+    python benchmarks/corpus.py /tmp/corpus --count 1000 --seed 0
+"""
+from email.message import EmailMessage
+from email.utils import format_datetime
+import argparse
+import datetime
+import os
+import random
+
+# English words the bodies are made of, so that normalization keeps most of them
+VOCABULARY = (
+    "account action address agreement analysis answer application approval "
+    "balance bank benefit board budget business calendar call capital change "
+    "client company computer conference contract cost credit customer data "
+    "deadline decision delivery department design development discount "
+    "document energy estimate event exchange experience family feedback "
+    "finance forecast friend future garden government group growth health "
+    "holiday house income information insurance interest invoice issue "
+    "journey kitchen knowledge language legal letter library market meeting "
+    "member message money morning network notice number office option order "
+    "package partner payment people period picture planning policy power "
+    "price problem process product project property purchase quality "
+    "question receipt record report request research resource result review "
+    "river sale schedule school security service shipping software statement "
+    "station strategy student subscription summary support system team "
+    "technology ticket training transfer travel update value vendor weather "
+    "window winter work"
+).split()
+
+# Domains of the generated addresses
+DOMAINS = ("example.com", "example.org", "example.net", "mail.example.com")
+
+# Relative weight of each kind of email in a corpus
+DEFAULT_MIX = {"multipart": 4, "html": 3, "recipients": 2, "attachment": 1}
+
+# Size of the binary attachments of "attachment" emails
+DEFAULT_ATTACHMENT_SIZE = 2 * 1024 * 1024
+
+# Date of the first email, later ones are spread over the following year
+START_DATE = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def random_address(rng):
+    """Return a random address, sometimes with a plus part."""
+    user = f"{rng.choice(VOCABULARY)}.{rng.choice(VOCABULARY)}{rng.randrange(100)}"
+    if rng.random() < 0.1:
+        user += f"+{rng.choice(VOCABULARY)}"
+    return f"{user}@{rng.choice(DOMAINS)}"
+
+
+def random_sentence(rng, min_words=6, max_words=16):
+    """Return a random capitalized sentence."""
+    words = rng.choices(VOCABULARY, k=rng.randint(min_words, max_words))
+    return " ".join(words).capitalize() + "."
+
+
+def random_text(rng, paragraphs):
+    """Return paragraphs of random sentences."""
+    return "\n\n".join(
+        " ".join(random_sentence(rng) for _ in range(rng.randint(2, 6)))
+        for _ in range(paragraphs)
+    )
+
+
+def random_html(rng, blocks):
+    """Return a newsletter-like HTML document, heavy on markup and entities."""
+    parts = [
+        "<html><head><style>td { padding: 4px; } .promo { color: #c00; }</style>",
+        "<script>window.dataLayer = window.dataLayer || [];</script></head><body>",
+    ]
+    for _ in range(blocks):
+        word = rng.choice(VOCABULARY)
+        parts.append(
+            '<table class="promo"><tr><td>'
+            f'<a href="https://{rng.choice(DOMAINS)}/{word}?id={rng.randrange(10**6)}">'
+            f"{random_sentence(rng)}</a> &mdash; {random_sentence(rng)}&nbsp;&amp; "
+            f'{word}</td><td><img src="https://{rng.choice(DOMAINS)}/p.gif" '
+            'alt=""/></td></tr></table>'
+            f"<script>track('{word}', {rng.randrange(1000)});</script>"
+        )
+    parts.append("<p>Unsubscribe &copy; Example Inc.</p></body></html>")
+    return "\n".join(parts)
+
+
+def new_message(rng, index, recipients=1):
+    """Return a message with the common headers set."""
+    msg = EmailMessage()
+    msg["From"] = random_address(rng)
+    msg["To"] = ", ".join(random_address(rng) for _ in range(recipients))
+    msg["Subject"] = random_sentence(rng, 3, 8)
+    msg["Date"] = format_datetime(
+        START_DATE + datetime.timedelta(seconds=rng.randrange(365 * 24 * 3600))
+    )
+    msg["Message-ID"] = f"<{index}.{rng.randrange(10**9)}@example.com>"
+    return msg
+
+
+def multipart_email(rng, index, attachment_size):
+    """Plain text and HTML alternatives of the same short text."""
+    msg = new_message(rng, index)
+    text = random_text(rng, rng.randint(2, 8))
+    msg.set_content(text)
+    paragraphs = "".join(f"<p>{paragraph}</p>" for paragraph in text.split("\n\n"))
+    msg.add_alternative(f"<html><body>{paragraphs}</body></html>", subtype="html")
+    return msg
+
+
+def html_email(rng, index, attachment_size):
+    """Large HTML-only newsletter."""
+    msg = new_message(rng, index)
+    msg.set_content(random_html(rng, rng.randint(200, 1200)), subtype="html")
+    return msg
+
+
+def recipients_email(rng, index, attachment_size):
+    """Plain text sent to many recipients, some of them in copy."""
+    msg = new_message(rng, index, recipients=rng.randint(50, 300))
+    msg["Cc"] = ", ".join(random_address(rng) for _ in range(rng.randint(10, 100)))
+    msg.set_content(random_text(rng, rng.randint(1, 4)))
+    return msg
+
+
+def attachment_email(rng, index, attachment_size):
+    """Short plain text with a large binary attachment."""
+    msg = new_message(rng, index)
+    msg.set_content(random_text(rng, rng.randint(1, 3)))
+    msg.add_attachment(
+        rng.randbytes(attachment_size),
+        maintype="application",
+        subtype="pdf",
+        filename=f"{rng.choice(VOCABULARY)}.pdf",
+    )
+    return msg
+
+
+# Generator of each kind of email
+EMAIL_KINDS = {
+    "multipart": multipart_email,
+    "html": html_email,
+    "recipients": recipients_email,
+    "attachment": attachment_email,
+}
+
+
+def generate_emails(count, seed=0, mix=None, attachment_size=DEFAULT_ATTACHMENT_SIZE):
+    """Yield (kind, raw bytes) for count emails, deterministically from seed."""
+    mix = mix or DEFAULT_MIX
+    kinds = sorted(mix)
+    weights = [mix[kind] for kind in kinds]
+    rng = random.Random(seed)
+    for index in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        msg = EMAIL_KINDS[kind](rng, index, attachment_size)
+        # The email package draws boundaries from the global random state
+        for part_index, part in enumerate(msg.walk()):
+            if part.is_multipart():
+                part.set_boundary(f"=_{index}_{part_index}_{rng.randrange(10**9)}")
+        yield kind, msg.as_bytes()
+
+
+def mbox_entry(raw):
+    """Return the bytes of a message as an mbox entry, with a fixed From_ line."""
+    lines = raw.split(b"\n")
+    # Escape body lines that would be mistaken for a message separator
+    lines = [b">" + line if line.startswith(b"From ") else line for line in lines]
+    body = b"\n".join(lines)
+    if not body.endswith(b"\n"):
+        body += b"\n"
+    return b"From MAILER-DAEMON Wed Jan  1 00:00:00 2020\n" + body + b"\n"
+
+
+def write_corpus(
+    output_dir,
+    count,
+    seed=0,
+    mix=None,
+    attachment_size=DEFAULT_ATTACHMENT_SIZE,
+    mbox_name="corpus.mbox",
+):
+    """Write the corpus as output_dir/eml/*.eml and output_dir/<mbox_name>.
+
+    Returns a dict describing the corpus: paths, number of emails per kind and
+    total size.
+    """
+    eml_dir = os.path.join(output_dir, "eml")
+    os.makedirs(eml_dir, exist_ok=True)
+    mbox_path = os.path.join(output_dir, mbox_name) if mbox_name else None
+
+    kinds = {}
+    total_bytes = 0
+    mbox = open(mbox_path, "wb") if mbox_path else None
+    try:
+        for index, (kind, raw) in enumerate(
+            generate_emails(count, seed, mix, attachment_size)
+        ):
+            with open(os.path.join(eml_dir, f"{index:06d}.eml"), "wb") as file:
+                file.write(raw)
+            if mbox:
+                mbox.write(mbox_entry(raw))
+            kinds[kind] = kinds.get(kind, 0) + 1
+            total_bytes += len(raw)
+    finally:
+        if mbox:
+            mbox.close()
+
+    return {
+        "eml_dir": eml_dir,
+        "mbox_path": mbox_path,
+        "count": count,
+        "seed": seed,
+        "kinds": kinds,
+        "bytes": total_bytes,
+    }
+
+
+def parse_mix(value):
+    """Parse a kind=weight,... mix specification."""
+    mix = {}
+    for item in value.split(","):
+        kind, _, weight = item.partition("=")
+        if kind not in EMAIL_KINDS:
+            raise argparse.ArgumentTypeError(f"unknown email kind: {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("output_dir", help="directory to write the corpus to")
+    parser.add_argument("--count", type=int, default=1000, help="number of emails")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default=DEFAULT_MIX,
+        help="relative weight of each kind of email, e.g. multipart=4,html=3",
+    )
+    parser.add_argument(
+        "--attachment-size",
+        type=int,
+        default=DEFAULT_ATTACHMENT_SIZE,
+        help="bytes of each binary attachment",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    corpus = write_corpus(
+        args.output_dir, args.count, args.seed, args.mix, args.attachment_size
+    )
+    print(
+        f"Wrote {corpus['count']} emails ({corpus['bytes'] / 1e6:.1f} MB) to "
+        f"{corpus['eml_dir']} and {corpus['mbox_path']}: {corpus['kinds']}"
+    )
@@ -0,0 +1,189 @@
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from scipy import sparse
+from sklearn.cluster import KMeans
+from sklearn.decomposition import TruncatedSVD
+from sklearn.metrics import silhouette_score
+from threadpoolctl import threadpool_limits
+import hashlib
+import json
+import numpy as np
+import os
+
+# Where sweep results are cached, keyed by a fingerprint of the input matrix
+DEFAULT_CACHE_DIR = os.path.join(".cache", "sweeps")
+
+# Number of rows the silhouette score is computed on
+DEFAULT_SAMPLE_SIZE = 10000
+
+# Number of rows shown in a 3D cluster plot
+DEFAULT_PLOT_SAMPLE_SIZE = 20000
+
+# KMeans parameters used for every k of a sweep
+DEFAULT_KMEANS_PARAMS = {
+    "init": "k-means++",
+    "max_iter": 300,
+    "n_init": 10,
+    "random_state": 42,
+}
+
+# Matrix being swept, sent once to each worker process
+sweep_matrix = None
+
+
+def matrix_fingerprint(X, *extra):
+    """Hash the contents of a dense or sparse matrix, plus any extra values."""
+    digest = hashlib.sha256()
+    digest.update(repr((X.shape, extra)).encode("utf-8"))
+    if sparse.issparse(X):
+        X = sparse.csr_matrix(X)
+        X.sort_indices()
+        arrays = (X.data, X.indices, X.indptr)
+    else:
+        arrays = (np.asarray(X),)
+    for array in arrays:
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def stratified_sample(labels, sample_size, random_state=42):
+    """Pick up to sample_size row indexes, proportionally from every label.
+
+    Every label keeps at least one row, so small clusters still count.
+    """
+    if len(labels) <= sample_size:
+        return np.arange(len(labels))
+
+    rng = np.random.default_rng(random_state)
+    indexes = []
+    for label in np.unique(labels):
+        members = np.flatnonzero(labels == label)
+        count = max(1, round(len(members) * sample_size / len(labels)))
+        indexes.append(
+            rng.choice(members, size=min(count, len(members)), replace=False)
+        )
+    return np.sort(np.concatenate(indexes))
+
+
+def init_sweep_worker(X):
+    """Receive the swept matrix once and keep KMeans single-threaded."""
+    global sweep_matrix
+    sweep_matrix = X
+    # Parallelism comes from the process pool, avoid oversubscription
+    threadpool_limits(1)
+
+
+def fit_cluster_count(k, sample_size, kmeans_params):
+    """Fit KMeans for one k and score it on a stratified sample."""
+    X = sweep_matrix
+    kmeans = KMeans(n_clusters=k, **kmeans_params).fit(X)
+    result = {"inertia": float(kmeans.inertia_), "silhouette": None}
+
+    if 2 <= k < X.shape[0]:
+        indexes = stratified_sample(kmeans.labels_, sample_size)
+        labels = kmeans.labels_[indexes]
+        if len(np.unique(labels)) > 1:
+            result["silhouette"] = float(silhouette_score(X[indexes], labels))
+    return result
+
+
+def sweep_cluster_counts(
+    X,
+    k_values,
+    n_jobs=None,
+    sample_size=DEFAULT_SAMPLE_SIZE,
+    cache_dir=DEFAULT_CACHE_DIR,
+    kmeans_params=None,
+):
+    """Fit KMeans for every k in parallel and report inertia and silhouette.
+
+    Results are cached per input matrix, so only k values that were never
+    fitted on this exact matrix (with these parameters) are computed.
+
+    Returns a {k: {"inertia": float, "silhouette": float or None}} dict.
+    """
+    kmeans_params = kmeans_params or DEFAULT_KMEANS_PARAMS
+    fingerprint = matrix_fingerprint(X, sample_size, sorted(kmeans_params.items()))
+    cache_path = os.path.join(cache_dir, f"{fingerprint}.json")
+
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, "r") as file:
+            cache = json.load(file)
+
+    missing = [k for k in k_values if str(k) not in cache]
+    if missing:
+        with ProcessPoolExecutor(
+            max_workers=n_jobs, initializer=init_sweep_worker, initargs=(X,)
+        ) as executor:
+            results = executor.map(
+                fit_cluster_count,
+                missing,
+                [sample_size] * len(missing),
+                [kmeans_params] * len(missing),
+            )
+            for k, result in zip(missing, results):
+                cache[str(k)] = result
+
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_path, "w") as file:
+            json.dump(cache, file, indent=2, sort_keys=True)
+
+    return {k: cache[str(k)] for k in k_values}
+
+
+def plot_sweep(results, metric, path, title, ylabel):
+    """Render one metric of a sweep to an image file, without a display."""
+    k_values = [k for k in results if results[k][metric] is not None]
+
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.plot(k_values, [results[k][metric] for k in k_values])
+    ax.set_title(title)
+    ax.set_xlabel("Number of clusters")
+    ax.set_ylabel(ylabel)
+    fig.savefig(path)
+    return path
+
+
+def project_3d(X, random_state=42):
+    """Project the rows of a dense or sparse matrix onto three components.
+
+    Randomized truncated SVD works on sparse matrices directly, so unlike
+    PCA it never densifies them, only the rows x 3 result is dense. Rows are
+    not centered, so the first component mostly follows the mean row.
+    """
+    svd = TruncatedSVD(
+        n_components=3, algorithm="randomized", random_state=random_state
+    )
+    return svd.fit_transform(X)
+
+
+def plot_clusters_3d(X, labels, path, title, sample_size=DEFAULT_PLOT_SAMPLE_SIZE):
+    """Render a 3D scatter plot of clustered rows to an image file.
+
+    Only a stratified sample of sample_size rows is projected and plotted,
+    with every cluster keeping its share of the points.
+    """
+    labels = np.asarray(labels)
+    indexes = stratified_sample(labels, sample_size)
+    points = project_3d(X[indexes])
+    labels = labels[indexes]
+
+    fig = Figure(figsize=(12, 8))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111, projection="3d")
+    for label in np.unique(labels):
+        cluster = points[labels == label]
+        ax.scatter(
+            cluster[:, 0], cluster[:, 1], cluster[:, 2], label=f"Cluster {label}"
+        )
+    ax.set_title(title)
+    ax.set_xlabel("Component 1")
+    ax.set_ylabel("Component 2")
+    ax.set_zlabel("Component 3")
+    ax.legend()
+    fig.savefig(path)
+    return path
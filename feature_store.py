@@ -0,0 +1,214 @@
+from datetime import datetime, timezone
+from scipy import sparse
+import hashlib
+import json
+import numpy as np
+import os
+import shutil
+
+# Where feature sets are stored, one directory per name and fingerprint
+DEFAULT_FEATURES_DIR = os.path.join(".cache", "features")
+
+# Bumped whenever the stored layout changes, so older feature sets are
+# rebuilt instead of misread
+FORMAT_VERSION = 1
+
+# Most recently used versions of a feature set kept on disk
+DEFAULT_KEEP_VERSIONS = 3
+
+# Arrays of a feature set, memory-mapped from .npy files on load
+ARRAYS = ("data", "indices", "indptr", "vocabulary", "row_ids")
+
+
+def fingerprint(*values):
+    """Hash the values a feature set is built from."""
+    return hashlib.sha256(repr((FORMAT_VERSION,) + values).encode("utf-8")).hexdigest()
+
+
+def database_fingerprint(conn, *extra):
+    """Fingerprint the imported emails, plus any extra values.
+
+    Every import upserts its emails with a new last_updated, and new words
+    get new ids, so any import changes the fingerprint without scanning the
+    occurrence tables.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT MAX(last_updated), COUNT(*), (SELECT MAX(id) FROM words) "
+            "FROM emails;"
+        )
+        state = tuple(map(str, cursor.fetchone()))
+    return fingerprint("database", state, *extra)
+
+
+def directory_fingerprint(path, *extra):
+    """Fingerprint the files of a directory tree or a single file.
+
+    Files are identified by their path, size and modification time, so
+    fingerprinting never reads them.
+    """
+    files = []
+    if os.path.isdir(path):
+        for directory, subdirectories, filenames in os.walk(path):
+            subdirectories.sort()
+            for filename in sorted(filenames):
+                file_path = os.path.join(directory, filename)
+                stat = os.stat(file_path)
+                files.append(
+                    (os.path.relpath(file_path, path), stat.st_size, stat.st_mtime_ns)
+                )
+    else:
+        stat = os.stat(path)
+        files.append((os.path.basename(path), stat.st_size, stat.st_mtime_ns))
+    return fingerprint("files", files, *extra)
+
+
+def write_arrays(path, arrays):
+    """Write every array of a feature set to its own .npy file."""
+    for name in ARRAYS:
+        np.save(os.path.join(path, f"{name}.npy"), arrays[name])
+
+
+class FeatureStore:
+    """Versioned on-disk store of sparse feature matrices.
+
+    A feature set is a CSR matrix, the vocabulary of its columns and the id
+    of each of its rows, stored under a name and the fingerprint of whatever
+    it was built from. Each version is kept as a compressed .npz archive and
+    expanded to .npy files, which are memory-mapped on load, so loading a
+    stored feature set costs next to nothing whatever its size.
+
+    A version can also hold named attachments, e.g. the state of the
+    vectorizer that built it, each a dict of arrays in its own .npz archive.
+    """
+
+    def __init__(self, directory=DEFAULT_FEATURES_DIR, keep=DEFAULT_KEEP_VERSIONS):
+        self.directory = directory
+        self.keep = keep
+
+    def path(self, name, fingerprint):
+        return os.path.join(self.directory, name, fingerprint)
+
+    def load(self, name, fingerprint):
+        """Return the (matrix, vocabulary, row_ids) of a version, None if absent.
+
+        The arrays are read-only memory maps.
+        """
+        path = self.path(name, fingerprint)
+        if not os.path.exists(os.path.join(path, "manifest.json")):
+            return None
+        with open(os.path.join(path, "manifest.json"), "r") as file:
+            manifest = json.load(file)
+        if manifest["format"] != FORMAT_VERSION:
+            return None
+
+        # The .npy files may be missing, e.g. when only archives were copied
+        if not all(os.path.exists(os.path.join(path, f"{a}.npy")) for a in ARRAYS):
+            with np.load(os.path.join(path, "features.npz")) as archive:
+                write_arrays(path, archive)
+
+        arrays = {
+            array: np.load(os.path.join(path, f"{array}.npy"), mmap_mode="r")
+            for array in ARRAYS
+        }
+        matrix = sparse.csr_matrix(
+            (arrays["data"], arrays["indices"], arrays["indptr"]),
+            shape=tuple(manifest["shape"]),
+            copy=False,
+        )
+        # Mark the version as recently used, so pruning keeps it
+        os.utime(path)
+        return matrix, arrays["vocabulary"], arrays["row_ids"]
+
+    def load_attachment(self, name, fingerprint, attachment):
+        """Return the arrays attached to a version, None if absent."""
+        path = os.path.join(self.path(name, fingerprint), f"{attachment}.npz")
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as archive:
+            return {array: archive[array] for array in archive.files}
+
+    def save(
+        self,
+        name,
+        fingerprint,
+        matrix,
+        vocabulary,
+        row_ids,
+        attachments=None,
+        **metadata,
+    ):
+        """Store a version of a feature set and prune the oldest versions.
+
+        attachments maps attachment names to dicts of arrays, see
+        load_attachment. The version is written to a temporary directory
+        first and renamed into place, so readers never see a partial one.
+        """
+        matrix = sparse.csr_matrix(matrix)
+        matrix.sort_indices()
+        arrays = {
+            "data": matrix.data,
+            "indices": matrix.indices,
+            "indptr": matrix.indptr,
+            # Fixed-width strings rather than objects, so they can be mapped
+            "vocabulary": np.asarray(vocabulary, dtype=str),
+            "row_ids": np.asarray(row_ids),
+        }
+        manifest = {
+            "format": FORMAT_VERSION,
+            "name": name,
+            "fingerprint": fingerprint,
+            "shape": list(matrix.shape),
+            "nnz": int(matrix.nnz),
+            "created": datetime.now(timezone.utc).isoformat(),
+            **metadata,
+        }
+
+        path = self.path(name, fingerprint)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(temp_path, exist_ok=True)
+        np.savez_compressed(os.path.join(temp_path, "features.npz"), **arrays)
+        write_arrays(temp_path, arrays)
+        for attachment, attachment_arrays in (attachments or {}).items():
+            np.savez_compressed(
+                os.path.join(temp_path, f"{attachment}.npz"), **attachment_arrays
+            )
+        with open(os.path.join(temp_path, "manifest.json"), "w") as file:
+            json.dump(manifest, file, indent=2, sort_keys=True)
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(temp_path, path)
+        self.prune(name)
+
+    def cached(self, name, fingerprint, build, refresh=False, **metadata):
+        """Load a version of a feature set, building and storing it if absent.
+
+        build is called without arguments and returns the (matrix,
+        vocabulary, row_ids) to store, optionally followed by the attachments
+        of the version.
+        """
+        if not refresh:
+            stored = self.load(name, fingerprint)
+            if stored is not None:
+                return stored
+        self.save(name, fingerprint, *build(), **metadata)
+        return self.load(name, fingerprint)
+
+    def versions(self, name):
+        """Return the stored versions of a feature set, most recently used first."""
+        directory = os.path.join(self.directory, name)
+        if not os.path.isdir(directory):
+            return []
+        paths = [
+            os.path.join(directory, entry)
+            for entry in os.listdir(directory)
+            if not entry.endswith(".tmp")
+        ]
+        paths.sort(key=os.path.getmtime, reverse=True)
+        return [os.path.basename(path) for path in paths]
+
+    def prune(self, name):
+        """Remove all but the most recently used versions of a feature set."""
+        for version in self.versions(name)[self.keep :]:
+            shutil.rmtree(self.path(name, version), ignore_errors=True)
@@ -0,0 +1,43 @@
+from html import unescape
+import re
+
+# Regex matching every piece of markup in one pass: script and style elements
+# with their content (an unclosed one swallows the rest of the document, like
+# in a browser, instead of being rescanned for every later match), comments and
+# any other tag.
+REGEX_HTML_MARKUP = re.compile(
+    r"<(script|style)\b[^>]*>(?:.*?</\1\s*>|.*)|<!--.*?(?:-->|$)|<[^>]*>",
+    re.IGNORECASE | re.DOTALL,
+)
+
+# Characters of text extracted from one HTML part at most
+DEFAULT_MAX_TEXT_LENGTH = 100000
+
+
+def html_to_text(html_content, max_length=DEFAULT_MAX_TEXT_LENGTH):
+    """Extract the visible text of an HTML document in a single pass.
+
+    Markup is replaced by spaces, script and style contents are dropped and
+    character references are decoded. Scanning stops as soon as max_length
+    characters of text were collected.
+    """
+    if len(html_content) <= max_length:
+        # The text cannot outgrow the cap, let the regex engine do all the work
+        return unescape(REGEX_HTML_MARKUP.sub(" ", html_content))
+
+    parts = []
+    length = 0
+    position = 0
+    for match in REGEX_HTML_MARKUP.finditer(html_content):
+        start = match.start()
+        if start > position:
+            parts.append(html_content[position:start])
+            length += start - position
+            if length >= max_length:
+                break
+        parts.append(" ")
+        position = match.end()
+    else:
+        parts.append(html_content[position:])
+
+    return unescape("".join(parts))[:max_length]
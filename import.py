@@ -1,65 +1,579 @@
 #!/usr/bin/env python3
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 from datetime import datetime
 from datetime import datetime, timezone
 from email import message_from_file
 from email import policy
 from email.parser import BytesParser
 from email.utils import getaddresses, parseaddr
-from nltk.corpus import stopwords
-from nltk.corpus import wordnet
-from nltk.stem import PorterStemmer
-from nltk.tokenize import word_tokenize
+from html_text import DEFAULT_MAX_TEXT_LENGTH, html_to_text
+from mbox_reader import MboxReader
+from metrics import (
+    DEFAULT_PROGRESS_INTERVAL,
+    Metrics,
+    ProgressReporter,
+    start_queue_logging,
+    stop_queue_logging,
+    timed,
+)
+from mime_parser import decode_header_value, iter_text_parts, parse_headers
+from normalizer import Normalizer
+from pipeline import DEFAULT_QUEUE_SIZE, Pipeline, Stage
+from psycopg2.errors import DeadlockDetected
 from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from sources import DEFAULT_SOURCE_READERS, iter_source, iter_sources, source_kind
+from storage import (
+    COMPRESSIONS,
+    DEFAULT_BLOOM_THRESHOLD,
+    LAYOUTS,
+    HashIndex,
+    open_storage,
+)
 from queue import Queue
-from threading import Thread
+from threading import BoundedSemaphore, Lock, Thread, local
+import argparse
 import email
+import functools
 import hashlib
+import io
 import logging
-import mailbox
 import nltk
 import os
-import psycopg2
 import re
+import shutil
+import time
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(filename="sieve.log", encoding="utf-8", level=logging.DEBUG)
 logger.addHandler(logging.StreamHandler())
 
-# Regex to remove script and style tags along with their content
-REGEX_HTML_SCRIPTS = re.compile(r"(?is)<(script|style).*?>.*?</\1>")
-
-# Regex to remove HTML tags
-REGEX_HTML_TAGS = re.compile(r"<[^>]+>")
+# Regex to remove the plus address part in an email address
+REGEX_EMAIL_ADDRESS_PLUS = re.compile(r"(\+[^@]+)(?=@)")
 
-# Regex to remove HTML entities
-# https://en.wikipedia.org/wiki/List_of_XML_and_HTML_character_entity_references#Character_entity_references_in_HTML
-REGEX_HTML_ENTITY = re.compile(r"&[a-zA-Z]+[0-9]*;")
+# Default number of emails gathered per transaction in bulk ingest mode
+DEFAULT_BULK_BATCH_SIZE = 500
+
+# Times an email is written again after losing a deadlock to another worker
+DEADLOCK_RETRIES = 3
+
+# Bytes read at a time when hashing a file
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Number of .eml files handed to a parse process per work unit
+DEFAULT_PARSE_CHUNK_SIZE = 64
+
+# Staging tables that bulk batches are COPY'd into before being merged, and
+# that the merge collects aggregate increments into. They are session-local
+# and emptied at the end of every transaction.
+STAGING_TABLES = {
+    "staging_emails": ("sha_hash",),
+    "staging_addresses": ("sha_hash", "address"),
+    "staging_subject_words": ("sha_hash", "word", "count"),
+    "staging_body_words": ("sha_hash", "word", "count"),
+    "staging_new_emails": ("sha_hash",),
+    "staging_new_conversations": ("address_id",),
+    "staging_word_stats": (
+        "word_id",
+        "subject_df",
+        "subject_count",
+        "body_df",
+        "body_count",
+    ),
+}
 
-# Regex to remove non-alphabet characters
-REGEX_NON_WORDS = re.compile(r"[^a-zA-Z]+")
+# Occurrence table of each part of an email
+OCCURRENCE_TABLES = {"subject": "subject_occurrences", "body": "body_occurrences"}
+
+# Merge the staged batch into the real tables. Rows are de-duplicated and
+# ordered so concurrent writers lock rows in the same order. Rows inserted
+# rather than updated (xmax = 0) are new, only those add to the document
+# frequency and message count aggregates.
+BULK_MERGE_QUERIES = (
+    """
+    WITH merged AS (
+        INSERT INTO emails (sha_hash, last_updated)
+        SELECT DISTINCT sha_hash, now() FROM staging_emails ORDER BY sha_hash
+        ON CONFLICT (sha_hash)
+        DO UPDATE
+        SET last_updated = EXCLUDED.last_updated
+        RETURNING sha_hash, xmax = 0 AS inserted
+    )
+    INSERT INTO staging_new_emails (sha_hash)
+    SELECT sha_hash FROM merged WHERE inserted;
+    """,
+    """
+    INSERT INTO addresses (address)
+    SELECT DISTINCT address FROM staging_addresses ORDER BY address
+    ON CONFLICT (address) DO NOTHING;
+    """,
+    """
+    WITH merged AS (
+        INSERT INTO conversations (email_id, address_id)
+        SELECT DISTINCT e.id, a.id
+        FROM staging_addresses s
+        JOIN emails e ON e.sha_hash = s.sha_hash
+        JOIN addresses a ON a.address = s.address
+        ORDER BY e.id, a.id
+        ON CONFLICT (email_id, address_id) DO NOTHING
+        RETURNING address_id
+    )
+    INSERT INTO staging_new_conversations (address_id)
+    SELECT address_id FROM merged;
+    """,
+    """
+    INSERT INTO words (word)
+    SELECT word FROM staging_subject_words
+    UNION
+    SELECT word FROM staging_body_words
+    ORDER BY word
+    ON CONFLICT (word) DO NOTHING;
+    """,
+    """
+    WITH grouped AS (
+        SELECT e.id AS email_id, w.id AS word_id, SUM(s.count) AS count
+        FROM staging_subject_words s
+        JOIN emails e ON e.sha_hash = s.sha_hash
+        JOIN words w ON w.word = s.word
+        GROUP BY e.id, w.id
+    ),
+    merged AS (
+        INSERT INTO subject_occurrences (email_id, word_id, count)
+        SELECT email_id, word_id, count FROM grouped ORDER BY email_id, word_id
+        ON CONFLICT (email_id, word_id) DO UPDATE
+        SET count = subject_occurrences.count + EXCLUDED.count
+        RETURNING word_id, xmax = 0 AS inserted
+    )
+    INSERT INTO staging_word_stats
+    SELECT word_id, COUNT(*) FILTER (WHERE inserted), 0, 0, 0
+    FROM merged GROUP BY word_id
+    UNION ALL
+    SELECT word_id, 0, SUM(count), 0, 0 FROM grouped GROUP BY word_id;
+    """,
+    """
+    WITH grouped AS (
+        SELECT e.id AS email_id, w.id AS word_id, SUM(s.count) AS count
+        FROM staging_body_words s
+        JOIN emails e ON e.sha_hash = s.sha_hash
+        JOIN words w ON w.word = s.word
+        GROUP BY e.id, w.id
+    ),
+    merged AS (
+        INSERT INTO body_occurrences (email_id, word_id, count)
+        SELECT email_id, word_id, count FROM grouped ORDER BY email_id, word_id
+        ON CONFLICT (email_id, word_id) DO UPDATE
+        SET count = body_occurrences.count + EXCLUDED.count
+        RETURNING word_id, xmax = 0 AS inserted
+    )
+    INSERT INTO staging_word_stats
+    SELECT word_id, 0, 0, COUNT(*) FILTER (WHERE inserted), 0
+    FROM merged GROUP BY word_id
+    UNION ALL
+    SELECT word_id, 0, 0, 0, SUM(count) FROM grouped GROUP BY word_id;
+    """,
+    # Aggregates are updated last, one statement per table and in the same
+    # table and row order as EmailProcessor.flush_stats, as every transaction
+    # contends for their rows.
+    """
+    INSERT INTO address_stats (address_id, message_count)
+    SELECT address_id, COUNT(*) FROM staging_new_conversations
+    GROUP BY address_id
+    ORDER BY address_id
+    ON CONFLICT (address_id) DO UPDATE
+    SET message_count = address_stats.message_count + EXCLUDED.message_count;
+    """,
+    """
+    INSERT INTO word_stats (word_id, subject_df, subject_count, body_df, body_count)
+    SELECT
+        word_id,
+        SUM(subject_df),
+        SUM(subject_count),
+        SUM(body_df),
+        SUM(body_count)
+    FROM staging_word_stats
+    GROUP BY word_id
+    ORDER BY word_id
+    ON CONFLICT (word_id) DO UPDATE
+    SET subject_df = word_stats.subject_df + EXCLUDED.subject_df,
+        subject_count = word_stats.subject_count + EXCLUDED.subject_count,
+        body_df = word_stats.body_df + EXCLUDED.body_df,
+        body_count = word_stats.body_count + EXCLUDED.body_count;
+    """,
+    """
+    UPDATE corpus_stats
+    SET emails = emails + (SELECT COUNT(*) FROM staging_new_emails),
+        subject_emails = subject_emails + (
+            SELECT COUNT(DISTINCT sha_hash) FROM staging_subject_words
+            WHERE sha_hash IN (SELECT sha_hash FROM staging_new_emails)
+        ),
+        body_emails = body_emails + (
+            SELECT COUNT(DISTINCT sha_hash) FROM staging_body_words
+            WHERE sha_hash IN (SELECT sha_hash FROM staging_new_emails)
+        );
+    """,
+)
+
+# Rebuild the aggregate tables from scratch, e.g. for a database imported
+# before they existed
+REBUILD_STATS_QUERIES = (
+    "LOCK TABLE word_stats, address_stats, corpus_stats IN EXCLUSIVE MODE;",
+    "TRUNCATE word_stats, address_stats;",
+    """
+    INSERT INTO word_stats (word_id, subject_df, subject_count, body_df, body_count)
+    SELECT
+        word_id,
+        SUM(subject_df),
+        SUM(subject_count),
+        SUM(body_df),
+        SUM(body_count)
+    FROM (
+        SELECT word_id, COUNT(*) AS subject_df, SUM(count) AS subject_count,
+            0 AS body_df, 0 AS body_count
+        FROM subject_occurrences GROUP BY word_id
+        UNION ALL
+        SELECT word_id, 0, 0, COUNT(*), SUM(count)
+        FROM body_occurrences GROUP BY word_id
+    ) occurrences
+    GROUP BY word_id;
+    """,
+    """
+    INSERT INTO address_stats (address_id, message_count)
+    SELECT address_id, COUNT(*) FROM conversations GROUP BY address_id;
+    """,
+    """
+    UPDATE corpus_stats
+    SET emails = (SELECT COUNT(*) FROM emails),
+        subject_emails = (SELECT COUNT(DISTINCT email_id) FROM subject_occurrences),
+        body_emails = (SELECT COUNT(DISTINCT email_id) FROM body_occurrences);
+    """,
+)
+
+# Aggregate tables maintained at import, missing from databases imported
+# before they existed
+STATS_TABLES = ("word_stats", "address_stats", "corpus_stats")
+
+# Secondary indexes for lookups by word and by address, the primary and unique
+# keys only serve lookups by email: index name -> (table, column)
+SECONDARY_INDEXES = {
+    "subject_occurrences_word_id_idx": ("subject_occurrences", "word_id"),
+    "body_occurrences_word_id_idx": ("body_occurrences", "word_id"),
+    "conversations_address_id_idx": ("conversations", "address_id"),
+}
 
-# Regex to remove extra whitespace
-REGEX_EXTRA_WHITESPACE = re.compile(r"\s{2,}")
 
-# Regex to remove the plus address part in an email address
-REGEX_EMAIL_ADDRESS_PLUS = re.compile(r"(\+[^@]+)(?=@)")
+def copy_escape(value):
+    """Escape a value for Postgres' COPY text format."""
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+class ConnectionPool:
+    """Thread-safe Postgres connection pool that records wait statistics.
+
+    Unlike ThreadedConnectionPool on its own, getconn blocks until a
+    connection is free instead of raising when the pool is exhausted.
+    """
+
+    def __init__(self, db_config, size, metrics=None):
+        self.size = size
+        self.metrics = metrics
+        self.pool = ThreadedConnectionPool(1, size, **db_config)
+        self.available = BoundedSemaphore(size)
+        self.lock = Lock()
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.acquisitions = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def getconn(self):
+        """Take a connection from the pool, waiting for one if necessary."""
+        start = time.perf_counter()
+        self.available.acquire()
+        waited = time.perf_counter() - start
+        if self.metrics is not None:
+            self.metrics.observe("db_connection_wait", waited)
+        try:
+            conn = self.pool.getconn()
+        except Exception:
+            self.available.release()
+            raise
+
+        with self.lock:
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.acquisitions += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        return conn
+
+    def putconn(self, conn):
+        """Return a connection to the pool."""
+        self.pool.putconn(conn)
+        with self.lock:
+            self.in_use -= 1
+        self.available.release()
+
+    def stats(self):
+        """Return a snapshot of the pool statistics."""
+        with self.lock:
+            return {
+                "size": self.size,
+                "in_use": self.in_use,
+                "peak_in_use": self.peak_in_use,
+                "acquisitions": self.acquisitions,
+                "total_wait_seconds": self.total_wait,
+                "max_wait_seconds": self.max_wait,
+            }
+
+    def closeall(self):
+        """Close every connection in the pool."""
+        self.pool.closeall()
 
 
 class EmailProcessor:
     def __init__(
-        self, db_config, dirty_dir="dirty", storage_dir="storage", max_workers=8
+        self,
+        db_config,
+        dirty_dir="dirty",
+        storage_dir="storage",
+        max_workers=8,
+        bulk_batch_size=None,
+        commit_every=1,
+        lazy_parsing=False,
+        max_html_text=DEFAULT_MAX_TEXT_LENGTH,
+        progress_interval=DEFAULT_PROGRESS_INTERVAL,
+        storage_layout=None,
+        storage_compression=None,
+        bloom_threshold=DEFAULT_BLOOM_THRESHOLD,
     ):
-        self.conn = psycopg2.connect(**db_config)
+        # Counters and latency histograms of every stage of the pipeline
+        self.metrics = Metrics()
+        # Seconds between two progress lines, 0 to disable them
+        self.progress_interval = progress_interval
+        # Every worker thread holds its own connection from the pool, plus one
+        # for the thread driving the processor. Parse-only processors (e.g. in
+        # worker processes) have no database.
+        self.pool = (
+            ConnectionPool(db_config, max_workers + 1, self.metrics)
+            if db_config
+            else None
+        )
+        self.local = local()
+        # Number of emails each connection submits per transaction
+        self.commit_every = commit_every
         self.dirty_dir = dirty_dir
         self.storage_dir = storage_dir
+        # Layout and compression only apply when the storage is created
+        self.storage_layout = storage_layout
+        self.storage_compression = storage_compression
+        self._storage = None
+        # Hashes already stored, loaded on first store to skip duplicates
+        self.bloom_threshold = bloom_threshold
+        self._stored_hashes = None
+        self.stored_hashes_lock = Lock()
         self.max_workers = max_workers
-        self.stemmer = PorterStemmer()
-        self.stop_words = None
+        # When set, emails are gathered into batches of this many messages and
+        # submitted through COPY + merge in one transaction per batch.
+        self.bulk_batch_size = bulk_batch_size
+        self.bulk_batch = []
+        self.bulk_batch_lock = Lock()
+        self.import_stats_lock = Lock()
+        self.start_import(0)
+        self.normalizer = Normalizer()
+        self.lazy_parsing = lazy_parsing
+        self.max_html_text = max_html_text
         # self.preload_nltk_data()
         # self.drop_tables()
         # self.create_tables()
+        if self.pool is not None:
+            if self.missing_stats_tables():
+                logger.warning(
+                    "The database has no word statistics, run "
+                    "`import.py migrate-database` before importing"
+                )
+            if self.missing_indexes():
+                logger.warning(
+                    "The database misses secondary indexes, run "
+                    "`import.py migrate-database` to build them"
+                )
+
+    @property
+    def storage(self):
+        """The email storage backend, opened on first use."""
+        if self._storage is None:
+            self._storage = open_storage(
+                self.storage_dir, self.storage_layout, self.storage_compression
+            )
+        return self._storage
+
+    @property
+    def stored_hashes(self):
+        """Index of the stored hashes, loaded from the storage on first use."""
+        with self.stored_hashes_lock:
+            if self._stored_hashes is None:
+                with self.metrics.timer("load_stored_hashes"):
+                    self._stored_hashes = HashIndex(self.storage, self.bloom_threshold)
+                kind = "set" if self._stored_hashes.exact else "Bloom filter"
+                logger.info(f"Loaded the stored email hashes in a {kind}")
+            return self._stored_hashes
+
+    @property
+    def conn(self):
+        """The calling thread's database connection, taken from the pool."""
+        conn = getattr(self.local, "conn", None)
+        if conn is None and self.pool is not None:
+            conn = self.local.conn = self.pool.getconn()
+            self.local.pending = 0
+            # Hashes of the emails of the transaction, counted once committed
+            self.local.uncommitted = []
+            self.reset_pending_stats()
+        return conn
+
+    def release_connection(self):
+        """Commit pending work and return the thread's connection to the pool."""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            return
+        self.commit_group()
+        self.pool.putconn(conn)
+        self.local.conn = None
+
+    def pool_stats(self):
+        """Return connection pool statistics (wait time, connections in use)."""
+        return self.pool.stats() if self.pool is not None else {}
+
+    @contextmanager
+    def email_transaction(self, sha_hash):
+        """Group the statements of one email into the thread's transaction.
+
+        The transaction is committed once every commit_every emails. When
+        emails are grouped, each one runs in a savepoint so a failing email
+        does not roll back the others in its group. The email is only counted
+        as imported once its transaction commits, see commit.
+        """
+        conn = self.conn
+        grouped = self.commit_every > 1
+        if grouped:
+            with conn.cursor() as cursor:
+                cursor.execute("SAVEPOINT email;")
+        try:
+            yield
+        except Exception:
+            if grouped:
+                with conn.cursor() as cursor:
+                    cursor.execute("ROLLBACK TO SAVEPOINT email;")
+            else:
+                conn.rollback()
+            raise
+
+        if grouped:
+            with conn.cursor() as cursor:
+                cursor.execute("RELEASE SAVEPOINT email;")
+        self.local.uncommitted.append(sha_hash)
+        self.local.pending += 1
+        if self.local.pending >= self.commit_every:
+            self.commit_group()
+
+    def commit(self):
+        """Apply the pending aggregate increments and commit the transaction.
+
+        The emails of the transaction are counted as imported once it is
+        committed, or all of them as failed if it is rolled back.
+        """
+        uncommitted, self.local.uncommitted = self.local.uncommitted, []
+        try:
+            self.flush_stats()
+            self.conn.commit()
+        except Exception:
+            # The increments belong to the emails being rolled back
+            self.conn.rollback()
+            self.reset_pending_stats()
+            self.record_failed(len(uncommitted))
+            raise
+        self.record_imported(uncommitted)
+
+    def commit_group(self):
+        """Commit the thread's group of emails, logging a failed commit.
+
+        Its emails are already counted as failed by commit, so the error is
+        not raised to whichever email happened to complete the group.
+        """
+        self.local.pending = 0
+        try:
+            with self.metrics.timer("db_commit"):
+                self.commit()
+        except Exception as e:
+            logger.error(f"Error committing a group of emails, rolled back: {e}")
+
+    def reset_pending_stats(self):
+        # Aggregate increments of the emails of the thread's transaction:
+        # address_id -> emails, word_id -> [subject_df, subject_count,
+        # body_df, body_count] and [emails, subject_emails, body_emails].
+        self.local.address_stats = {}
+        self.local.word_stats = {}
+        self.local.corpus_stats = [0, 0, 0]
+
+    def add_pending_stats(
+        self, new_email, new_address_ids, subject_occurrences, body_occurrences
+    ):
+        """Record the aggregate increments of an email submitted one by one.
+
+        new_address_ids and the ids in the occurrence lists are those of
+        conversations and occurrences the email inserted rather than updated.
+        Each occurrence list is a (occurrences, new word ids) pair.
+        """
+        for address_id in new_address_ids:
+            self.local.address_stats[address_id] = (
+                self.local.address_stats.get(address_id, 0) + 1
+            )
+        for column, (occurrences, new_ids) in (
+            (0, subject_occurrences),
+            (2, body_occurrences),
+        ):
+            for _, word_id, count in occurrences:
+                row = self.local.word_stats.setdefault(word_id, [0, 0, 0, 0])
+                row[column] += word_id in new_ids
+                row[column + 1] += count
+        if new_email:
+            corpus_stats = self.local.corpus_stats
+            corpus_stats[0] += 1
+            corpus_stats[1] += bool(subject_occurrences[0])
+            corpus_stats[2] += bool(body_occurrences[0])
+
+    def flush_stats(self):
+        """Write the pending aggregate increments of the thread's transaction.
+
+        They are written once per transaction rather than per email, with the
+        rows of each table in sorted order, so that concurrent transactions
+        lock the contended aggregate rows in the same order.
+        """
+        if getattr(self.local, "word_stats", None) is None:
+            return
+        if self.local.address_stats:
+            self.update_address_stats(sorted(self.local.address_stats.items()))
+        if self.local.word_stats:
+            self.update_word_stats(
+                sorted(
+                    (word_id, *row) for word_id, row in self.local.word_stats.items()
+                )
+            )
+        if any(self.local.corpus_stats):
+            self.update_corpus_stats(*self.local.corpus_stats)
+        self.reset_pending_stats()
 
     def preload_nltk_data(self):
         """Preload NLTK data to avoid concurrency issues."""
@@ -69,9 +583,8 @@ class EmailProcessor:
         nltk.download("wordnet")
 
         # Force loading other NLTK resources
-        self.stop_words = set(stopwords.words("english"))
         _ = nltk.word_tokenize("Test sentence to trigger loading.")
-        _ = list(nltk.corpus.wordnet.all_synsets())
+        self.normalizer.preload()
         logger.info("NLTK data preloaded")
 
     def drop_tables(self):
@@ -83,10 +596,18 @@ class EmailProcessor:
             cursor.execute("DROP TABLE IF EXISTS words CASCADE;")
             cursor.execute("DROP TABLE IF EXISTS subject_occurrences CASCADE;")
             cursor.execute("DROP TABLE IF EXISTS body_occurrences CASCADE;")
+            cursor.execute("DROP TABLE IF EXISTS word_stats CASCADE;")
+            cursor.execute("DROP TABLE IF EXISTS address_stats CASCADE;")
+            cursor.execute("DROP TABLE IF EXISTS corpus_stats CASCADE;")
             self.conn.commit()
 
-    def create_tables(self):
-        """Create necessary tables in the database."""
+    def create_tables(self, secondary_indexes=True):
+        """Create necessary tables in the database.
+
+        The secondary indexes are built in the transaction, blocking writes
+        to their tables; leave them out to build them with
+        add_missing_indexes instead.
+        """
         with self.conn.cursor() as cursor:
             cursor.execute(
                 """
@@ -144,10 +665,142 @@ class EmailProcessor:
                 );
             """
             )
+            for name, (table, column) in SECONDARY_INDEXES.items():
+                if secondary_indexes:
+                    cursor.execute(
+                        f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({column});"
+                    )
+            # Aggregates maintained at import, so analysis does not have to
+            # scan the occurrence and conversation tables: the document
+            # frequency (number of emails) and total count of every word,
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS word_stats (
+                    word_id INTEGER PRIMARY KEY REFERENCES words(id) ON DELETE CASCADE,
+                    subject_df INTEGER NOT NULL DEFAULT 0,
+                    subject_count BIGINT NOT NULL DEFAULT 0,
+                    body_df INTEGER NOT NULL DEFAULT 0,
+                    body_count BIGINT NOT NULL DEFAULT 0
+                );
+            """
+            )
+            # the number of emails of every address,
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS address_stats (
+                    address_id INTEGER PRIMARY KEY
+                        REFERENCES addresses(id) ON DELETE CASCADE,
+                    message_count INTEGER NOT NULL DEFAULT 0
+                );
+            """
+            )
+            # and the number of emails, overall and with subject or body words.
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS corpus_stats (
+                    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+                    emails BIGINT NOT NULL DEFAULT 0,
+                    subject_emails BIGINT NOT NULL DEFAULT 0,
+                    body_emails BIGINT NOT NULL DEFAULT 0
+                );
+            """
+            )
+            cursor.execute(
+                "INSERT INTO corpus_stats DEFAULT VALUES ON CONFLICT DO NOTHING;"
+            )
+            # Vocabulary pruning selects words by document frequency, these
+            # serve it with index-only scans.
+            for source in OCCURRENCE_TABLES:
+                cursor.execute(
+                    f"""
+                    CREATE INDEX IF NOT EXISTS word_stats_{source}_df_idx
+                    ON word_stats ({source}_df) INCLUDE (word_id);
+                """
+                )
             self.conn.commit()
 
+    def missing_stats_tables(self):
+        """Return the aggregate tables missing from the database."""
+        with self.conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT name FROM unnest(%s::text[]) AS name "
+                "WHERE to_regclass(name) IS NULL;",
+                (list(STATS_TABLES),),
+            )
+            missing = [name for (name,) in cursor.fetchall()]
+        self.conn.rollback()
+        return missing
+
+    def require_stats(self):
+        """Refuse to import into a database without the aggregate tables."""
+        if self.missing_stats_tables():
+            raise RuntimeError(
+                "The database has no word statistics, "
+                "run `import.py migrate-database` to add them"
+            )
+
+    def migrate_database(self):
+        """Add the tables missing from a database created by an older version.
+
+        Imports update the aggregates incrementally, so aggregate tables are
+        filled from the occurrence tables once, when they are added. This
+        scans the whole occurrence tables and blocks writes meanwhile.
+        Secondary indexes are built without blocking writes.
+        """
+        missing_stats = self.missing_stats_tables()
+        self.create_tables(secondary_indexes=False)
+        self.add_missing_indexes()
+        if missing_stats:
+            logger.info("No word statistics in the database, adding them")
+            self.rebuild_stats()
+
+    def missing_indexes(self):
+        """Return the secondary indexes missing from the database, or invalid."""
+        with self.conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT name FROM unnest(%s::text[]) AS name "
+                "WHERE NOT EXISTS (SELECT 1 FROM pg_index "
+                "WHERE indexrelid = to_regclass(name) AND indisvalid);",
+                (list(SECONDARY_INDEXES),),
+            )
+            missing = [name for (name,) in cursor.fetchall()]
+        self.conn.rollback()
+        return missing
+
+    def add_missing_indexes(self):
+        """Build the secondary indexes missing from an existing database.
+
+        Databases created before an index was added only get it here. The
+        indexes are built with CREATE INDEX CONCURRENTLY, which does not block
+        writes but cannot run in a transaction, so the connection autocommits
+        meanwhile. An index left invalid by an interrupted build is rebuilt.
+        """
+        conn = self.conn
+        conn.rollback()
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cursor:
+                for name in self.missing_indexes():
+                    table, column = SECONDARY_INDEXES[name]
+                    logger.info(f"Building the missing index {name}")
+                    cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+                    cursor.execute(
+                        f"CREATE INDEX CONCURRENTLY {name} ON {table} ({column});"
+                    )
+        finally:
+            conn.autocommit = False
+
+    def rebuild_stats(self):
+        """Recompute the aggregate tables from the occurrence tables."""
+        with self.metrics.timer("db_rebuild_stats"), self.conn.cursor() as cursor:
+            for query in REBUILD_STATS_QUERIES:
+                cursor.execute(query)
+        self.conn.commit()
+        logger.info("Rebuilt the word, address and corpus statistics")
+
+    @timed("db_insert_email")
     def insert_email(self, sha_hash):
-        """Insert an email into the database."""
+        """Insert an email into the database, returning its id and if it is new."""
         with self.conn.cursor() as cursor:
             cursor.execute(
                 """
@@ -156,42 +809,47 @@ class EmailProcessor:
                 ON CONFLICT (sha_hash)
                 DO UPDATE
                 SET last_updated = EXCLUDED.last_updated
-                RETURNING id;
+                RETURNING id, xmax = 0;
             """,
                 (sha_hash, datetime.now(timezone.utc).isoformat()),
             )
-            self.conn.commit()
-            return cursor.fetchone()[0]
+            return cursor.fetchone()
 
+    @timed("db_insert_address")
     def insert_address(self, address):
-        """Insert a address into the addresses table and return the address_id."""
+        """Insert a address into the addresses table and return the address_id.
+
+        Existing addresses are selected rather than updated, so their rows
+        are not locked until the transaction commits.
+        """
         with self.conn.cursor() as cursor:
             cursor.execute(
                 """
                 INSERT INTO addresses (address)
                 VALUES (%s)
-                ON CONFLICT (address) DO UPDATE
-                SET address = EXCLUDED.address
-                RETURNING id;
+                ON CONFLICT (address) DO NOTHING;
             """,
                 (address,),
             )
-            self.conn.commit()
+            cursor.execute("SELECT id FROM addresses WHERE address = %s", (address,))
             return cursor.fetchone()[0]
 
+    @timed("db_insert_conversation")
     def insert_conversation(self, email_id, address_id):
-        """Insert a conversation into the conversations table."""
+        """Insert a conversation, returning whether it is new."""
         with self.conn.cursor() as cursor:
             cursor.execute(
                 """
                 INSERT INTO conversations (email_id, address_id)
                 VALUES (%s, %s)
-                ON CONFLICT (email_id, address_id) DO NOTHING;
+                ON CONFLICT (email_id, address_id) DO NOTHING
+                RETURNING address_id;
             """,
                 (email_id, address_id),
             )
-            self.conn.commit()
+            return cursor.fetchone() is not None
 
+    @timed("db_insert_word")
     def insert_word(self, word):
         """Insert a word into the words table and return the word_id."""
         with self.conn.cursor() as cursor:
@@ -203,10 +861,10 @@ class EmailProcessor:
             """,
                 (word,),
             )
-            self.conn.commit()
             cursor.execute("SELECT id FROM words WHERE word = %s", (word,))
             return cursor.fetchone()[0]
 
+    @timed("db_insert_words_batch")
     def insert_words_batch(self, words):
         """Insert a batch of words into the words table and return their IDs."""
         with self.conn.cursor() as cursor:
@@ -218,7 +876,6 @@ class EmailProcessor:
             """
             word_tuples = [(word,) for word in words]
             execute_values(cursor, insert_query, word_tuples)
-            self.conn.commit()
 
             # Step 2: Select the IDs for all words (whether they were inserted or already existed)
             select_query = "SELECT id, word FROM words WHERE word = ANY(%s);"
@@ -227,18 +884,21 @@ class EmailProcessor:
 
             return word_id_map
 
+    @timed("db_insert_subject_occurrences_batch")
     def insert_subject_occurrences_batch(self, occurrences):
-        """Batch insert subject word occurrences."""
+        """Batch insert subject word occurrences, returning the ids of new words."""
         with self.conn.cursor() as cursor:
             insert_query = """
                 INSERT INTO subject_occurrences (email_id, word_id, count)
                 VALUES %s
                 ON CONFLICT (email_id, word_id) DO UPDATE
-                SET count = subject_occurrences.count + EXCLUDED.count;
+                SET count = subject_occurrences.count + EXCLUDED.count
+                RETURNING word_id, xmax = 0;
             """
-            execute_values(cursor, insert_query, occurrences)
-            self.conn.commit()
+            rows = execute_values(cursor, insert_query, occurrences, fetch=True)
+            return {word_id for word_id, inserted in rows if inserted}
 
+    @timed("db_insert_subject_occurrence")
     def insert_subject_occurrence(self, email_id, word_id, count):
         """Insert a word occurrence into the occurrences table."""
         with self.conn.cursor() as cursor:
@@ -251,20 +911,22 @@ class EmailProcessor:
             """,
                 (email_id, word_id, count),
             )
-            self.conn.commit()
 
+    @timed("db_insert_body_occurrences_batch")
     def insert_body_occurrences_batch(self, occurrences):
-        """Batch insert body word occurrences."""
+        """Batch insert body word occurrences, returning the ids of new words."""
         with self.conn.cursor() as cursor:
             insert_query = """
                 INSERT INTO body_occurrences (email_id, word_id, count)
                 VALUES %s
                 ON CONFLICT (email_id, word_id) DO UPDATE
-                SET count = body_occurrences.count + EXCLUDED.count;
+                SET count = body_occurrences.count + EXCLUDED.count
+                RETURNING word_id, xmax = 0;
             """
-            execute_values(cursor, insert_query, occurrences)
-            self.conn.commit()
+            rows = execute_values(cursor, insert_query, occurrences, fetch=True)
+            return {word_id for word_id, inserted in rows if inserted}
 
+    @timed("db_insert_body_occurrence")
     def insert_body_occurrence(self, email_id, word_id, count):
         """Insert a word occurrence into the occurrences table."""
         with self.conn.cursor() as cursor:
@@ -277,110 +939,517 @@ class EmailProcessor:
             """,
                 (email_id, word_id, count),
             )
-            self.conn.commit()
 
-    def get_email_object_by_id(self, email_id):
+    @timed("db_update_word_stats")
+    def update_word_stats(self, rows):
+        """Add (word_id, subject_df, subject_count, body_df, body_count) rows."""
+        with self.conn.cursor() as cursor:
+            insert_query = """
+                INSERT INTO word_stats
+                    (word_id, subject_df, subject_count, body_df, body_count)
+                VALUES %s
+                ON CONFLICT (word_id) DO UPDATE
+                SET subject_df = word_stats.subject_df + EXCLUDED.subject_df,
+                    subject_count = word_stats.subject_count + EXCLUDED.subject_count,
+                    body_df = word_stats.body_df + EXCLUDED.body_df,
+                    body_count = word_stats.body_count + EXCLUDED.body_count;
+            """
+            execute_values(cursor, insert_query, rows)
+
+    @timed("db_update_address_stats")
+    def update_address_stats(self, rows):
+        """Add (address_id, message_count) rows."""
+        with self.conn.cursor() as cursor:
+            insert_query = """
+                INSERT INTO address_stats (address_id, message_count)
+                VALUES %s
+                ON CONFLICT (address_id) DO UPDATE
+                SET message_count = address_stats.message_count
+                    + EXCLUDED.message_count;
+            """
+            execute_values(cursor, insert_query, rows)
+
+    @timed("db_update_corpus_stats")
+    def update_corpus_stats(self, emails, subject_emails, body_emails):
+        """Add to the number of emails, overall and with subject or body words."""
         with self.conn.cursor() as cursor:
             cursor.execute(
-                f"""
+                """
+                UPDATE corpus_stats
+                SET emails = emails + %s,
+                    subject_emails = subject_emails + %s,
+                    body_emails = body_emails + %s;
+            """,
+                (emails, subject_emails, body_emails),
+            )
+
+    def create_staging_tables(self, cursor):
+        """Create the session-local staging tables used by bulk ingest."""
+        columns = {"sha_hash": "TEXT", "address": "TEXT", "word": "TEXT"}
+        for table, table_columns in STAGING_TABLES.items():
+            definition = ", ".join(
+                f"{column} {columns.get(column, 'INTEGER')} NOT NULL"
+                for column in table_columns
+            )
+            cursor.execute(
+                f"CREATE TEMP TABLE IF NOT EXISTS {table} ({definition}) "
+                "ON COMMIT DELETE ROWS;"
+            )
+
+    @timed("db_copy")
+    def copy_rows(self, cursor, table, rows):
+        """Stream rows into a staging table with COPY."""
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write("\t".join(copy_escape(value) for value in row))
+            buffer.write("\n")
+        buffer.seek(0)
+        cursor.copy_from(buffer, table, columns=STAGING_TABLES[table])
+
+    def submit_email_batch(self, batch):
+        """Submit a batch of emails in a single transaction.
+
+        Each entry is a (sha_hash, addresses, subject_word_counts,
+        body_word_counts) tuple. Rows are COPY'd into staging tables and then
+        merged into the real tables with a handful of set-based statements.
+        """
+        if not batch:
+            return
+
+        # Each thread submits through its own pooled connection, so batches
+        # of different threads do not need to be serialized.
+        conn = self.conn
+        with conn.cursor() as cursor:
+            try:
+                self.create_staging_tables(cursor)
+                self.copy_rows(
+                    cursor, "staging_emails", ((sha_hash,) for sha_hash, *_ in batch)
+                )
+                self.copy_rows(
+                    cursor,
+                    "staging_addresses",
+                    (
+                        (sha_hash, address)
+                        for sha_hash, addresses, _, _ in batch
+                        for address in addresses
+                    ),
+                )
+                self.copy_rows(
+                    cursor,
+                    "staging_subject_words",
+                    (
+                        (sha_hash, word, count)
+                        for sha_hash, _, subject_word_counts, _ in batch
+                        for word, count in subject_word_counts.items()
+                    ),
+                )
+                self.copy_rows(
+                    cursor,
+                    "staging_body_words",
+                    (
+                        (sha_hash, word, count)
+                        for sha_hash, _, _, body_word_counts in batch
+                        for word, count in body_word_counts.items()
+                    ),
+                )
+
+                with self.metrics.timer("db_merge"):
+                    for query in BULK_MERGE_QUERIES:
+                        cursor.execute(query)
+                with self.metrics.timer("db_commit"):
+                    self.commit()
+                self.local.pending = 0
+            except Exception:
+                conn.rollback()
+                raise
+
+        self.metrics.increment("batches_submitted")
+        logger.info(f"Submitted batch of {len(batch)} emails")
+
+    def queue_bulk_email(self, sha_hash, n_addresses, subject_counts, body_counts):
+        """Add an email to the pending bulk batch, submitting it once full.
+
+        Emails are counted as imported, or failed, when their batch is.
+        """
+        with self.bulk_batch_lock:
+            self.bulk_batch.append((sha_hash, n_addresses, subject_counts, body_counts))
+            if len(self.bulk_batch) < self.bulk_batch_size:
+                return
+            batch, self.bulk_batch = self.bulk_batch, []
+
+        self.submit_parsed_batch(batch)
+
+    def flush(self):
+        """Submit any emails still waiting in the bulk batch."""
+        with self.bulk_batch_lock:
+            batch, self.bulk_batch = self.bulk_batch, []
+
+        self.submit_parsed_batch(batch)
+
+    def get_email_object_by_id(self, email_id):
+        """Fetch a single email as the rows of
+        (email_id, sha_hash, last_updated, addresses, subject_words, body_words),
+        see get_emails to fetch many emails at once."""
+        with self.conn.cursor() as cursor:
+            self.select_emails(cursor, [int(email_id)])
+            rows = cursor.fetchall()
+        self.conn.commit()
+        return rows
+
+    def get_emails(self, email_ids):
+        """Fetch many emails, with their addresses and words, in one query.
+
+        Returns a list of dicts ordered by email id, unknown ids are skipped.
+        """
+        email_ids = [int(email_id) for email_id in email_ids]
+        if not email_ids:
+            return []
+
+        with self.conn.cursor() as cursor:
+            self.select_emails(cursor, email_ids)
+            columns = [column[0] for column in cursor.description]
+            emails = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        self.conn.commit()
+        return emails
+
+    def select_emails(self, cursor, email_ids):
+        """Select emails with their addresses and words on a cursor.
+
+        Each child table is aggregated on its own before being joined to the
+        emails, so no cartesian product of addresses and words is built, and
+        each aggregate is an index range scan on email_id.
+        """
+        cursor.execute(
+            """
+                WITH
+                    email_addresses AS (
+                        SELECT
+                            c.email_id,
+                            json_agg(a.address ORDER BY a.address) AS addresses
+                        FROM conversations c
+                        JOIN addresses a ON a.id = c.address_id
+                        WHERE c.email_id = ANY(%(ids)s)
+                        GROUP BY c.email_id
+                    ),
+                    email_subject_words AS (
+                        SELECT
+                            so.email_id,
+                            json_agg(
+                                json_build_object('word', w.word, 'count', so.count)
+                                ORDER BY w.word
+                            ) AS words
+                        FROM subject_occurrences so
+                        JOIN words w ON w.id = so.word_id
+                        WHERE so.email_id = ANY(%(ids)s)
+                        GROUP BY so.email_id
+                    ),
+                    email_body_words AS (
+                        SELECT
+                            bo.email_id,
+                            json_agg(
+                                json_build_object('word', w.word, 'count', bo.count)
+                                ORDER BY w.word
+                            ) AS words
+                        FROM body_occurrences bo
+                        JOIN words w ON w.id = bo.word_id
+                        WHERE bo.email_id = ANY(%(ids)s)
+                        GROUP BY bo.email_id
+                    )
                 SELECT
                     e.id AS email_id,
-                    e.sha_hash AS sha_hash,
-                    e.last_updated AS last_updated,
-                    -- Addresses
-                    json_agg(DISTINCT a.address) AS addresses,
-                    -- Subject words and counts
-                    json_agg(DISTINCT jsonb_build_object('word', sw.word, 'count', so.count)) AS subject_words,
-                    -- Body words and counts
-                    json_agg(DISTINCT jsonb_build_object('word', bw.word, 'count', bo.count)) AS body_words
-                FROM
-                    emails e
-                    -- Join conversations to get email addresses
-                    LEFT JOIN conversations c ON e.id = c.email_id
-                    LEFT JOIN addresses a ON c.address_id = a.id
-                    -- Join subject occurrences and words
-                    LEFT JOIN subject_occurrences so ON e.id = so.email_id
-                    LEFT JOIN words sw ON so.word_id = sw.id
-                    -- Join body occurrences and words
-                    LEFT JOIN body_occurrences bo ON e.id = bo.email_id
-                    LEFT JOIN words bw ON bo.word_id = bw.id
-                WHERE
-                    e.id = {email_id} -- Replace with the email ID you want to query
-                GROUP BY
-                    e.id
-            """
+                    e.sha_hash,
+                    e.last_updated,
+                    COALESCE(ea.addresses, '[]'::json) AS addresses,
+                    COALESCE(esw.words, '[]'::json) AS subject_words,
+                    COALESCE(ebw.words, '[]'::json) AS body_words
+                FROM emails e
+                LEFT JOIN email_addresses ea ON ea.email_id = e.id
+                LEFT JOIN email_subject_words esw ON esw.email_id = e.id
+                LEFT JOIN email_body_words ebw ON ebw.email_id = e.id
+                WHERE e.id = ANY(%(ids)s)
+                ORDER BY e.id;
+            """,
+            {"ids": email_ids},
+        )
+
+    def emails_containing(self, word, sources=("subject", "body"), limit=None):
+        """Return the ids of the emails whose subject and/or body contain a word.
+
+        The word is looked up as stored in the words table, i.e. normalized and
+        stemmed. Backed by the word_id indexes of the occurrence tables.
+        """
+        queries = [
+            f"SELECT email_id FROM {OCCURRENCE_TABLES[source]} WHERE word_id = w.id"
+            for source in sources
+        ]
+        with self.conn.cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT o.email_id
+                FROM words w
+                CROSS JOIN LATERAL ({" UNION ".join(queries)}) o
+                WHERE w.word = %s
+                ORDER BY o.email_id
+                LIMIT %s;
+            """,
+                (word, limit),
             )
-            self.conn.commit()
-            return cursor.fetchall()
+            email_ids = [email_id for (email_id,) in cursor.fetchall()]
+        self.conn.commit()
+        return email_ids
+
+    def emails_from(self, address, limit=None):
+        """Return the ids of the emails an address took part in.
+
+        Conversations do not record the role of an address, so this matches
+        senders and recipients alike. Backed by the address_id index of the
+        conversations table.
+        """
+        with self.conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT c.email_id
+                FROM addresses a
+                JOIN conversations c ON c.address_id = a.id
+                WHERE a.address = %s
+                ORDER BY c.email_id
+                LIMIT %s;
+            """,
+                (self.normalize_address(address), limit),
+            )
+            email_ids = [email_id for (email_id,) in cursor.fetchall()]
+        self.conn.commit()
+        return email_ids
+
+    def top_addresses(self, limit=20):
+        """Return the (address, message count) of the most frequent addresses.
+
+        Read from the address_stats aggregate rather than counted over the
+        conversations table.
+        """
+        with self.conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT a.address, s.message_count
+                FROM address_stats s
+                JOIN addresses a ON a.id = s.address_id
+                ORDER BY s.message_count DESC, a.address
+                LIMIT %s;
+            """,
+                (limit,),
+            )
+            rows = cursor.fetchall()
+        self.conn.commit()
+        return rows
 
     # TODO: Convert this to thread + queue model
     def process_dirty(self):
-        """Process .eml and .mbox files in the dirty directory."""
-        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+        """Store the emails of every source in the dirty directory.
+
+        Plain .eml and .mbox files take dedicated fast paths; archives,
+        compressed files and Maildir trees are streamed message by message.
+        """
+        progress = self.progress(None, ("emails_stored", "emails_duplicate"))
+        with progress, ThreadPoolExecutor(max_workers=self.max_workers) as executor:
             futures = []
-            for filename in os.listdir(self.dirty_dir):
-                file_path = os.path.join(self.dirty_dir, filename)
-                if filename.endswith(".eml"):
+            for file_path in self.dirty_paths():
+                if file_path.endswith(".eml"):
                     futures.append(executor.submit(self.store_eml_file, file_path))
-                elif filename.endswith(".mbox"):
+                elif file_path.endswith(".mbox"):
                     futures.append(executor.submit(self.store_mbox_file, file_path))
+                else:
+                    futures.append(executor.submit(self.store_source, file_path))
 
             for future in as_completed(futures):
                 future.result()  # This will raise an exception if the thread raised one
 
-    def store_eml_file(self, file_path):
-        """Process a single .eml file."""
-        with open(file_path, "r") as file:
-            email_content = file.read()
+    def dirty_paths(self):
+        """List the email sources of the dirty directory, see sources.py."""
+        return [
+            os.path.join(self.dirty_dir, filename)
+            for filename in sorted(os.listdir(self.dirty_dir))
+            if not filename.startswith(".")
+            and source_kind(os.path.join(self.dirty_dir, filename))
+        ]
 
-        sha_hash = self.hash_email_content(email_content)
-        storage_path = os.path.join(self.storage_dir, f"{sha_hash}.eml")
+    def remove_source(self, path):
+        """Remove a dirty source once its emails are stored."""
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
 
-        if not os.path.exists(storage_path):
-            with open(storage_path, "w") as file:
-                file.write(email_content)
+    def store_eml_file(self, file_path):
+        """Process a single .eml file, moving it into the storage as is."""
+        sha_hash = self.hash_email_file(file_path)
+        self.store_unless_known(sha_hash, self.storage.put_file, file_path)
 
-        # Remove the original dirty file
+        # Remove the original dirty file, file storages hold a link to it
         os.remove(file_path)
+        return sha_hash
 
     def store_mbox_file(self, file_path):
-        """Process an .mbox file, splitting it into individual .eml files."""
-        mbox = mailbox.mbox(file_path)
-        for message in mbox:
-            email_content = message.as_string()
-            sha_hash = self.hash_email_content(email_content)
-            storage_path = os.path.join(self.storage_dir, f"{sha_hash}.eml")
-
-            if not os.path.exists(storage_path):
-                with open(storage_path, "w") as file:
-                    file.write(email_content)
+        """Process an .mbox file, splitting it into individual .eml files.
+
+        The mbox is memory-mapped and split into byte ranges on message
+        boundaries, which are stored in parallel. Each message is written
+        with its original bytes rather than being parsed and re-serialized.
+        """
+        with MboxReader(file_path) as mbox:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [
+                    executor.submit(self.store_mbox_range, mbox, start, end)
+                    for start, end in mbox.split(self.max_workers)
+                ]
+                for future in as_completed(futures):
+                    future.result()
 
         # Remove the original dirty file
         os.remove(file_path)
 
+    def store_source(self, path):
+        """Store every email of an archive, compressed file or Maildir tree."""
+        for email_content in iter_source(path):
+            self.store_email_content(email_content)
+
+        # Remove the original dirty source
+        self.remove_source(path)
+
+    def store_mbox_range(self, mbox, start, end):
+        """Store every message of an mbox starting within a byte range."""
+        for email_content in mbox.iter_messages(start, end):
+            self.store_email_content(email_content)
+
+    def store_email_content(self, email_content):
+        """Store raw email bytes under their hash, unless already stored."""
+        sha_hash = self.hash_email_content(email_content)
+        self.store_unless_known(sha_hash, self.storage.put, email_content)
+        return sha_hash
+
+    def store_unless_known(self, sha_hash, put, source):
+        """Store an email with put(sha_hash, source) unless already stored.
+
+        Known duplicates are skipped from the in-memory hash index, without
+        touching the storage.
+        """
+        if sha_hash in self.stored_hashes:
+            self.metrics.increment("emails_duplicate")
+            return False
+        stored = put(sha_hash, source)
+        self.stored_hashes.add(sha_hash)
+        self.metrics.increment("emails_stored" if stored else "emails_duplicate")
+        return stored
+
     def worker(self, queue):
         """Worker function that processes emails from the queue."""
         while True:
-            file_path = queue.get()
-            if file_path is None:
+            with self.metrics.timer("queue_wait"):
+                sha_hash = queue.get()
+            if sha_hash is None:
+                self.release_connection()
                 break  # Exit the worker when None is received
             try:
-                processor.process_email(file_path)
+                # Submitted emails are counted once committed
+                if not self.process_stored_email(sha_hash):
+                    self.record_failed()
             finally:
                 queue.task_done()
 
-    def process_storage(self):
-        """Process .eml files in the storage directory."""
+    def storage_hash(self, file_path):
+        """Return the sha hash of a stored email from its file name."""
+        return os.path.basename(file_path).replace(".eml", "")
+
+    def known_hashes(self, manifest_path=None):
+        """Return the hashes of emails that were already imported.
+
+        They are read from the manifest when one is given, otherwise from the
+        emails table.
+        """
+        if manifest_path:
+            if not os.path.exists(manifest_path):
+                return set()
+            with open(manifest_path, "r") as file:
+                return set(file.read().split())
+
+        with self.metrics.timer("db_known_hashes"), self.conn.cursor(
+            name="known_hashes"
+        ) as cursor:
+            cursor.itersize = 10000
+            cursor.execute("SELECT sha_hash FROM emails;")
+            hashes = {sha_hash for (sha_hash,) in cursor}
+        self.conn.commit()
+        return hashes
+
+    def pending_stored_hashes(self, force=False, manifest_path=None):
+        """List the hashes of stored emails that were not imported yet.
+
+        Returns the hashes to import and the number of emails skipped.
+        With force, every stored email is returned.
+        """
+        known = set() if force else self.known_hashes(manifest_path)
+        sha_hashes = []
+        skipped = 0
+        for sha_hash in self.storage:
+            if sha_hash in known:
+                skipped += 1
+            else:
+                sha_hashes.append(sha_hash)
+        return sha_hashes, skipped
+
+    def start_import(self, skipped):
+        """Reset the counters of an import run."""
+        self.import_stats = {"new": 0, "skipped": skipped, "failed": 0}
+        self.imported_hashes = []
+        self.metrics.increment("emails_skipped", skipped)
+
+    def record_imported(self, sha_hashes):
+        """Count emails that were imported successfully."""
+        with self.import_stats_lock:
+            self.import_stats["new"] += len(sha_hashes)
+            self.imported_hashes.extend(sha_hashes)
+        self.metrics.increment("emails_imported", len(sha_hashes))
+
+    def record_skipped(self, count=1):
+        """Count emails that were already imported."""
+        with self.import_stats_lock:
+            self.import_stats["skipped"] += count
+        self.metrics.increment("emails_skipped", count)
+
+    def record_failed(self, count=1):
+        """Count emails that could not be imported."""
+        with self.import_stats_lock:
+            self.import_stats["failed"] += count
+        self.metrics.increment("emails_failed", count)
+
+    def finish_import(self, manifest_path=None):
+        """Append the newly imported hashes to the manifest and report counts."""
+        if manifest_path and self.imported_hashes:
+            with open(manifest_path, "a") as file:
+                file.writelines(f"{sha_hash}\n" for sha_hash in self.imported_hashes)
+        self.imported_hashes = []
+        logger.info(
+            f"Imported {self.import_stats['new']} new emails, skipped "
+            f"{self.import_stats['skipped']}, {self.import_stats['failed']} failed"
+        )
+        return self.import_stats
+
+    def process_storage(self, force=False, manifest_path=None):
+        """Process the emails of the storage directory.
+
+        Emails that were already imported are skipped unless force is set.
+        Returns the number of new, skipped and failed emails.
+        """
+        self.require_stats()
         queue = Queue()
         workers = []
 
         # Enqueue tasks
         logger.info(f"Filling queue ...")
-        for filename in os.listdir(self.storage_dir):
-            file_path = os.path.join(self.storage_dir, filename)
-            if filename.endswith(".eml"):
-                queue.put(file_path)
-        logger.info(f"Queue filled with {queue.qsize()} tasks")
+        sha_hashes, skipped = self.pending_stored_hashes(force, manifest_path)
+        self.start_import(skipped)
+        for sha_hash in sha_hashes:
+            queue.put(sha_hash)
+        logger.info(f"Queue filled with {queue.qsize()} tasks, skipped {skipped}")
 
         # Start worker threads
         logger.info(f"Starting {self.max_workers} workers ...")
@@ -393,7 +1462,9 @@ class EmailProcessor:
             workers.append(thread)
 
         # Wait for all tasks to be completed
-        queue.join()
+        with self.progress(len(sha_hashes)):
+            queue.join()
+            self.flush()
         logger.info(f"All jobs complete")
 
         # Stop workers
@@ -401,52 +1472,366 @@ class EmailProcessor:
             queue.put(None)
         for worker in workers:
             worker.join()
+        logger.info(f"Connection pool stats: {self.pool_stats()}")
+        return self.finish_import(manifest_path)
+
+    def process_storage_parallel(
+        self,
+        processes=None,
+        chunk_size=DEFAULT_PARSE_CHUNK_SIZE,
+        force=False,
+        manifest_path=None,
+    ):
+        """Process the emails of the storage directory with a process pool.
+
+        Parsing and normalization run in worker processes, which send back
+        compact word-count payloads. This process is the single database
+        writer and submits the payloads in bulk batches.
+        """
+        self.require_stats()
+        processes = processes or os.cpu_count()
+        batch_size = self.bulk_batch_size or DEFAULT_BULK_BATCH_SIZE
+
+        sha_hashes, skipped = self.pending_stored_hashes(force, manifest_path)
+        self.start_import(skipped)
+        chunks = [
+            sha_hashes[i : i + chunk_size]
+            for i in range(0, len(sha_hashes), chunk_size)
+        ]
+        logger.info(
+            f"Parsing {len(sha_hashes)} emails in {len(chunks)} chunks "
+            f"with {processes} processes, skipped {skipped} ..."
+        )
+
+        batch = []
+        pending = set()
+        with self.progress(len(sha_hashes)), ProcessPoolExecutor(
+            max_workers=processes,
+            initializer=init_parse_worker,
+            initargs=(self.storage_dir, self.lazy_parsing, self.max_html_text),
+        ) as executor:
+            # Keep a bounded number of chunks in flight so parsed payloads
+            # cannot pile up faster than they are written.
+            for chunk in chunks:
+                pending.add(executor.submit(parse_email_chunk, chunk))
+                if len(pending) < processes * 2:
+                    continue
+
+                with self.metrics.timer("parse_wait"):
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch.extend(self.collect_parsed_chunk(future))
+                while len(batch) >= batch_size:
+                    self.submit_parsed_batch(batch[:batch_size])
+                    batch = batch[batch_size:]
+
+            for future in as_completed(pending):
+                batch.extend(self.collect_parsed_chunk(future))
+
+            for i in range(0, len(batch), batch_size):
+                self.submit_parsed_batch(batch[i : i + batch_size])
+        logger.info(f"All jobs complete")
+        return self.finish_import(manifest_path)
+
+    def collect_parsed_chunk(self, future):
+        """Return the payloads of a parsed chunk, counting its failures."""
+        payloads, failed, metrics = future.result()
+        self.metrics.merge(metrics)
+        self.record_failed(failed)
+        return payloads
+
+    def submit_parsed_batch(self, batch):
+        """Submit a batch of parsed payloads, counting it as failed on error."""
+        if not batch:
+            return
+        try:
+            self.submit_email_batch(batch)
+        except Exception as e:
+            logger.error(f"Error submitting batch of {len(batch)} emails: {e}")
+            self.record_failed(len(batch))
+        else:
+            self.record_imported([sha_hash for sha_hash, *_ in batch])
+
+    def process_stream(
+        self,
+        paths=None,
+        archive=True,
+        force=False,
+        manifest_path=None,
+        parse_workers=None,
+        submit_workers=1,
+        parse_processes=None,
+        queue_size=DEFAULT_QUEUE_SIZE,
+        source_readers=DEFAULT_SOURCE_READERS,
+    ):
+        """Import email sources, by default the dirty directory, in one pass.
+
+        Emails flow from the sources (see sources.py) through hash, parse and
+        submit stages connected by bounded queues, instead of being written
+        to the storage by process_dirty and read back by process_storage.
+        Sources are read and decompressed by source_readers threads. With
+        archive the raw emails are stored on the way, and dirty sources
+        removed at the end; other sources are always left in place. Parsing
+        runs in parse_processes worker processes when set, with
+        parse_workers threads keeping them busy.
+        """
+        self.require_stats()
+        remove_sources = archive and paths is None
+        paths = self.dirty_paths() if paths is None else paths
+        # Hashes to skip: already imported, or seen earlier in this run
+        seen = set() if force else self.known_hashes(manifest_path)
+        self.start_import(0)
+        self.archive_failures = 0
+        self.failed_sources = set()
+
+        executor = (
+            ProcessPoolExecutor(
+                max_workers=parse_processes,
+                initializer=init_parse_worker,
+                initargs=(self.storage_dir, self.lazy_parsing, self.max_html_text),
+            )
+            if parse_processes
+            else None
+        )
+        pipeline = Pipeline(
+            [
+                Stage("hash", functools.partial(self.stream_hash, seen, archive)),
+                Stage(
+                    "parse",
+                    functools.partial(self.stream_parse, executor),
+                    parse_workers or parse_processes or self.max_workers,
+                ),
+                Stage(
+                    "submit",
+                    self.stream_submit,
+                    submit_workers,
+                    on_exit=self.release_connection,
+                ),
+            ],
+            self.metrics,
+            queue_size,
+        )
+        logger.info(f"Streaming {len(paths)} sources ...")
+        try:
+            with self.progress(None):
+                pipeline.run(
+                    iter_sources(
+                        paths, source_readers, queue_size, on_error=self.source_failed
+                    )
+                )
+                self.flush()
+        finally:
+            if executor:
+                executor.shutdown()
+        logger.info(f"All jobs complete")
+
+        # A source is only removed once all its emails are in the storage
+        if remove_sources and self.archive_failures:
+            logger.warning(
+                f"{self.archive_failures} emails could not be stored, "
+                "leaving the dirty sources in place"
+            )
+        elif remove_sources:
+            for path in paths:
+                # Sources that could not be read whole stay in place
+                if path not in self.failed_sources:
+                    self.remove_source(path)
+        return self.finish_import(manifest_path)
+
+    def source_failed(self, path, error):
+        """Log a source that could not be read, and skip the rest of it."""
+        logger.error(f"Error reading {path}, skipping the rest of it: {error}")
+        self.metrics.increment("sources_failed")
+        with self.import_stats_lock:
+            self.failed_sources.add(path)
+
+    def stream_hash(self, seen, archive, raw):
+        """Hash stage: archive an email and drop it if it was already seen."""
+        sha_hash = self.hash_email_content(raw)
+        if archive:
+            try:
+                self.store_unless_known(sha_hash, self.storage.put, raw)
+            except Exception as e:
+                logger.error(f"Error storing {sha_hash}, skipping it: {e}")
+                with self.import_stats_lock:
+                    self.archive_failures += 1
+                self.record_failed()
+                return None
+        with self.import_stats_lock:
+            duplicate = sha_hash in seen
+            seen.add(sha_hash)
+        if duplicate:
+            self.record_skipped()
+            return None
+        return sha_hash, raw
+
+    def stream_parse(self, executor, item):
+        """Parse stage: parse an email, in a worker process if there is a pool."""
+        sha_hash, raw = item
+        try:
+            if executor is None:
+                return self.parse_email_bytes(sha_hash, raw)
+            payload, metrics = executor.submit(parse_raw_email, sha_hash, raw).result()
+            self.metrics.merge(metrics)
+            return payload
+        except Exception as e:
+            logger.error(f"Error processing {sha_hash}, skipping it: {e}")
+            self.record_failed()
+            return None
+
+    def stream_submit(self, payload):
+        """Submit stage: write a parsed email to the database.
+
+        The email is counted as imported once its transaction or bulk batch
+        is committed.
+        """
+        try:
+            self.submit_email_counts(*payload)
+        except Exception as e:
+            logger.error(f"Error submitting {payload[0]}, skipping it: {e}")
+            self.record_failed()
+
+    def progress(self, total, counters=("emails_imported", "emails_failed")):
+        """Return a reporter logging the progress of counters while in use."""
+        return ProgressReporter(
+            self.metrics, counters, total, logger, self.progress_interval
+        )
+
+    def migrate_storage(self, target_dir, layout, compression=None, move=False):
+        """Copy every stored email into a new storage directory.
+
+        Emails already in the target are skipped, so an interrupted migration
+        can be resumed. With move, emails are removed from the current storage
+        once copied; between file layouts they are simply renamed.
+        """
+        source = self.storage
+        if move and source.layout == "pack":
+            raise ValueError("pack storage is append-only, copy it instead of moving")
+
+        total = len(source)
+        with open_storage(target_dir, layout, compression) as target, self.progress(
+            total, ("emails_migrated",)
+        ):
+            for sha_hash in source:
+                source_path = source.path(sha_hash)
+                target_path = target.path(sha_hash)
+                if sha_hash in target:
+                    if move:
+                        source.delete(sha_hash)
+                elif move and source_path and target_path:
+                    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                    os.replace(source_path, target_path)
+                else:
+                    target.put(sha_hash, source.get(sha_hash))
+                    if move:
+                        source.delete(sha_hash)
+                self.metrics.increment("emails_migrated")
+        logger.info(f"Migrated {total} emails to {target_dir} ({layout} layout)")
+        return total
 
     def hash_email_content(self, content):
         """Generate a SHA256 hash of the email content."""
-        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        return hashlib.sha256(content).hexdigest()
+
+    def hash_email_file(self, file_path):
+        """Generate a SHA256 hash of a file's raw bytes, reading it in chunks."""
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as file:
+            while chunk := file.read(HASH_CHUNK_SIZE):
+                digest.update(chunk)
+        return digest.hexdigest()
 
     def process_email(self, file_path):
-        """Process a single .eml file."""
+        """Process a single .eml file, returning whether it succeeded."""
+        return self.submit_parsed(self.parse_email, file_path)
+
+    def process_stored_email(self, sha_hash):
+        """Process a stored email, returning whether it succeeded."""
+        return self.submit_parsed(self.parse_stored_email, sha_hash)
+
+    def submit_parsed(self, parse, source):
+        """Parse an email from its source and submit it, logging failures."""
         try:
-            with open(file_path, "rb") as file:
-                msg = BytesParser(policy=policy.default).parse(file)
-
-            # The sha hash is the name of the file:
-            sha_hash = os.path.basename(file_path).replace(".eml", "")
-
-            # Extract email addresses (from, to, cc, bcc)
-            from_addresses = [msg["From"]]
-            to_addresses = getaddresses(msg.get_all("To", []))
-            cc_addresses = getaddresses(msg.get_all("Cc", []))
-            bcc_addresses = getaddresses(msg.get_all("Bcc", []))
-
-            # Flatten the address lists
-            all_addresses = list(
-                set(
-                    from_addresses
-                    + [addr[1] for addr in to_addresses + cc_addresses + bcc_addresses]
-                )
+            self.submit_email_counts(*parse(source))
+        except Exception as e:
+            logger.error(f"Error processing {source}, skipping it: {e}")
+            return False
+        return True
+
+    def parse_email(self, file_path):
+        """Parse and normalize a single .eml file without touching the database.
+
+        Returns a compact (sha_hash, addresses, subject_word_counts,
+        body_word_counts) tuple that can be submitted later.
+        """
+        with self.metrics.timer("read"), open(file_path, "rb") as file:
+            raw = file.read()
+
+        # The sha hash is the name of the file:
+        return self.parse_email_bytes(self.storage_hash(file_path), raw)
+
+    def parse_stored_email(self, sha_hash):
+        """Parse and normalize an email read from the storage backend."""
+        with self.metrics.timer("read"):
+            raw = self.storage.get(sha_hash)
+        return self.parse_email_bytes(sha_hash, raw)
+
+    def parse_email_bytes(self, sha_hash, raw):
+        """Parse and normalize the raw bytes of an email.
+
+        In lazy parsing mode only the header block is parsed, with the cheap
+        compat32 policy, and the body comes from a separate walk of the MIME
+        tree that decodes text leaves only. Otherwise the whole message is
+        parsed with the modern policy.
+        """
+        if self.lazy_parsing:
+            with self.metrics.timer("parse"):
+                msg = parse_headers(raw)
+                subject = decode_header_value(msg["Subject"] or "")
+            with self.metrics.timer("extract_body"):
+                body = self.extract_body_lazy(raw)
+        else:
+            with self.metrics.timer("parse"):
+                msg = BytesParser(policy=policy.default).parsebytes(raw)
+                subject = msg["Subject"] or ""
+            # Extract the body (assuming the email has both plain text and HTML parts)
+            with self.metrics.timer("extract_body"):
+                body = self.extract_body(msg)
+
+        # Extract email addresses (from, to, cc, bcc)
+        from_addresses = [msg["From"]]
+        to_addresses = getaddresses(msg.get_all("To", []))
+        cc_addresses = getaddresses(msg.get_all("Cc", []))
+        bcc_addresses = getaddresses(msg.get_all("Bcc", []))
+
+        # Flatten the address lists
+        all_addresses = list(
+            set(
+                from_addresses
+                + [addr[1] for addr in to_addresses + cc_addresses + bcc_addresses]
             )
+        )
 
-            # Get the email portion only, not the name
-            all_addresses = [self.normalize_address(addr) for addr in all_addresses]
-            # logger.debug(f"Extracted addresses: {all_addresses}")
+        # Get the email portion only, not the name
+        all_addresses = [self.normalize_address(addr) for addr in all_addresses]
+        # logger.debug(f"Extracted addresses: {all_addresses}")
 
-            # Extract the subject
-            subject = msg["Subject"] or ""
-            norm_subject = self.normalize_content(subject)
-            # logger.debug(f"Extracted to normalized subject: '{subject}' -> {norm_subject}")
+        # Normalize the subject
+        norm_subject = self.normalize_content(subject)
+        # logger.debug(f"Extracted to normalized subject: '{subject}' -> {norm_subject}")
 
-            # Extract the body (assuming the email has both plain text and HTML parts)
-            body = self.extract_body(msg)
-            # logger.debug(f"Extracted body: {body}")
-            norm_body = self.normalize_content(body)
-            # logger.debug(f"Normalized body: {norm_body}")
+        # logger.debug(f"Extracted body: {body}")
+        norm_body = self.normalize_content(body)
+        # logger.debug(f"Normalized body: {norm_body}")
 
-            self.submit_email_parts(sha_hash, all_addresses, norm_subject, norm_body)
-        except Exception as e:
-            logger.error(f"Error processing {file_path}, skipping it:", e)
+        return (
+            sha_hash,
+            all_addresses,
+            self.count_words(norm_subject),
+            self.count_words(norm_body),
+        )
 
     def extract_body(self, msg):
         """Extracts the body from an email message, preferring plain text."""
@@ -471,46 +1856,35 @@ class EmailProcessor:
         # Join all the parts into one long string
         return " ".join(parts)
 
-    def clean_html(self, html_content):
-        """Clean HTML content to extract plain text."""
-        # Remove script and style tags along with their content
-        html_content = re.sub(REGEX_HTML_SCRIPTS, " ", html_content)
-
-        # Remove HTML tags
-        html_content = re.sub(REGEX_HTML_TAGS, " ", html_content)
+    def extract_body_lazy(self, raw):
+        """Extracts the body from raw email bytes, skipping non-text parts."""
+        parts = []
+        for content_type, payload in iter_text_parts(raw):
+            if content_type == "text/html":
+                # Clean HTML content to be safe
+                payload = self.clean_html(payload)
+            parts.append(payload)
 
-        # Remove HTML entities
-        html_content = re.sub(REGEX_HTML_ENTITY, " ", html_content)
+        # Join all the parts into one long string
+        return " ".join(parts)
 
-        return html_content
+    def clean_html(self, html_content):
+        """Clean HTML content to extract plain text."""
+        # Drop tags and script/style contents, decode entities and stop after
+        # max_html_text characters, all in a single pass.
+        return html_to_text(html_content, self.max_html_text)
 
     def normalize_content(self, content):
         """Preprocess the email content (e.g., lowercasing, tokenization)."""
         if content is None:
             logger.warning("Content is None, skipping normalization")
             return []
-        content = re.sub(REGEX_NON_WORDS, " ", content)
-        content = re.sub(REGEX_EXTRA_WHITESPACE, " ", content)
-
-        # Convert to lowercase
-        content = content.lower()
-
-        # Tokenize
-        words = word_tokenize(content)
-
-        # Remove short, or long words
-        words = [word for word in words if len(word) >= 4 and (len(word) <= 16)]
-
-        # Remove stopwords
-        words = [word for word in words if word not in self.stop_words]
-
-        # Make sure it's a valid word (in any language, slang, etc.) or is
-        # word-like.
-        words = [word for word in words if len(wordnet.synsets(word)) > 0]
 
-        # Stemming
-        words = [self.stemmer.stem(word) for word in words]
-        return words
+        # Lowercase, tokenize, drop short/long words and stopwords, make sure
+        # it's a valid word (in any language, slang, etc.) or is word-like,
+        # then stem.
+        with self.metrics.timer("normalize"):
+            return self.normalizer.normalize(content)
 
     def normalize_address(self, address):
         """Normalize an email address."""
@@ -530,41 +1904,312 @@ class EmailProcessor:
 
     def submit_email_parts(self, sha_hash, n_addresses, n_subject, n_body):
         """Process the content of an email."""
-        email_id = self.insert_email(sha_hash)
-
-        # Insert addresses and conversations
-        for address in n_addresses:
-            address_id = self.insert_address(address)
-            self.insert_conversation(email_id, address_id)
-
         # Process words for subjects and body
-        subject_word_counts = self.count_words(n_subject)
-        body_word_counts = self.count_words(n_body)
-
-        all_words = set(subject_word_counts.keys()).union(set(body_word_counts.keys()))
-        word_ids = self.insert_words_batch(list(all_words))
-
-        # Batch insert subject occurrences
-        subject_occurrences = [
-            (email_id, word_ids[word], count)
-            for word, count in subject_word_counts.items()
-        ]
-        self.insert_subject_occurrences_batch(subject_occurrences)
+        self.submit_email_counts(
+            sha_hash, n_addresses, self.count_words(n_subject), self.count_words(n_body)
+        )
 
-        # Batch insert body occurrences
-        body_occurrences = [
-            (email_id, word_ids[word], count)
-            for word, count in body_word_counts.items()
-        ]
-        self.insert_body_occurrences_batch(body_occurrences)
+    def submit_email_counts(
+        self, sha_hash, n_addresses, subject_word_counts, body_word_counts
+    ):
+        """Submit an email whose subject and body words are already counted."""
+        if self.bulk_batch_size:
+            self.queue_bulk_email(
+                sha_hash, n_addresses, subject_word_counts, body_word_counts
+            )
+            return
 
-        logger.info(
-            f"Submitted email ID {email_id} {sha_hash}, {len(n_addresses)} addresses, {len(subject_word_counts)} subject words, {len(body_word_counts)} body words"
+        for attempt in range(DEADLOCK_RETRIES + 1):
+            try:
+                email_id = self.write_email(
+                    sha_hash, n_addresses, subject_word_counts, body_word_counts
+                )
+                break
+            except DeadlockDetected:
+                if attempt == DEADLOCK_RETRIES:
+                    raise
+                logger.warning(f"Deadlock writing {sha_hash}, retrying it")
+                self.metrics.increment("db_deadlock_retries")
+                # The other transaction may wait on rows written by the earlier
+                # emails of the group, committing them breaks the cycle
+                self.commit_group()
+
+        # Lazily formatted, this runs once per email
+        logger.debug(
+            "Submitted email ID %s %s, %s addresses, %s subject words, %s body words",
+            email_id,
+            sha_hash,
+            len(n_addresses),
+            len(subject_word_counts),
+            len(body_word_counts),
         )
 
+    def write_email(self, sha_hash, n_addresses, subject_word_counts, body_word_counts):
+        """Write an email in the thread's transaction, returning its id.
+
+        Within an email, rows are written in sorted order so concurrent
+        transactions lock shared address and word rows in the same order.
+        Across the emails of a group (commit_every > 1) no order holds: a
+        new address or word another open transaction inserted is waited on,
+        so two groups can deadlock. The email that loses is rolled back, and
+        retried by submit_email_counts.
+        """
+        with self.email_transaction(sha_hash):
+            email_id, new_email = self.insert_email(sha_hash)
+
+            # Insert addresses and conversations
+            new_address_ids = []
+            for address in sorted(n_addresses):
+                address_id = self.insert_address(address)
+                if self.insert_conversation(email_id, address_id):
+                    new_address_ids.append(address_id)
+
+            all_words = set(subject_word_counts.keys()).union(
+                set(body_word_counts.keys())
+            )
+            word_ids = self.insert_words_batch(sorted(all_words))
+
+            # Batch insert subject occurrences
+            subject_occurrences = [
+                (email_id, word_ids[word], count)
+                for word, count in subject_word_counts.items()
+            ]
+            new_subject_ids = self.insert_subject_occurrences_batch(subject_occurrences)
+
+            # Batch insert body occurrences
+            body_occurrences = [
+                (email_id, word_ids[word], count)
+                for word, count in body_word_counts.items()
+            ]
+            new_body_ids = self.insert_body_occurrences_batch(body_occurrences)
+
+            # Written when the transaction commits
+            self.add_pending_stats(
+                new_email,
+                new_address_ids,
+                (subject_occurrences, new_subject_ids),
+                (body_occurrences, new_body_ids),
+            )
+        return email_id
+
     def close(self):
-        """Close the database connection."""
-        self.conn.close()
+        """Close the database connections."""
+        if self._storage is not None:
+            self._storage.close()
+            self._storage = None
+        if self.pool is None:
+            return
+        self.flush()
+        self.release_connection()
+        logger.info(f"Connection pool stats: {self.pool_stats()}")
+        self.pool.closeall()
+
+
+# Parse-only processor owned by each worker process of process_storage_parallel
+parse_processor = None
+
+
+def init_parse_worker(
+    storage_dir="storage", lazy_parsing=False, max_html_text=DEFAULT_MAX_TEXT_LENGTH
+):
+    """Initialize the per-process parser for the parse pool."""
+    global parse_processor
+    # Forked from a process logging through queues, whose listeners stay there
+    stop_queue_logging(logging.getLogger(), logger)
+    parse_processor = EmailProcessor(
+        None,
+        storage_dir=storage_dir,
+        lazy_parsing=lazy_parsing,
+        max_html_text=max_html_text,
+    )
+
+
+def parse_email_chunk(sha_hashes):
+    """Parse a chunk of stored emails into word-count payloads.
+
+    Returns the payloads, the number of emails that failed to parse and the
+    metrics recorded while parsing.
+    """
+    payloads = []
+    for sha_hash in sha_hashes:
+        try:
+            payloads.append(parse_processor.parse_stored_email(sha_hash))
+        except Exception as e:
+            logger.error(f"Error processing {sha_hash}, skipping it: {e}")
+    # Send the metrics of the chunk back, to be merged by the writer process
+    metrics = parse_processor.metrics.snapshot(reset=True)
+    return payloads, len(sha_hashes) - len(payloads), metrics
+
+
+def parse_raw_email(sha_hash, raw):
+    """Parse the raw bytes of an email into a word-count payload.
+
+    Returns the payload and the metrics recorded while parsing.
+    """
+    payload = parse_processor.parse_email_bytes(sha_hash, raw)
+    return payload, parse_processor.metrics.snapshot(reset=True)
+
+
+def parse_args():
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(description="Import emails into Postgres.")
+    parser.add_argument(
+        "--workers", type=int, default=16, help="number of worker threads"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BULK_BATCH_SIZE,
+        help="emails per bulk transaction, 0 to submit emails one by one",
+    )
+    parser.add_argument(
+        "--commit-every",
+        type=int,
+        default=1,
+        help="emails per transaction when submitting emails one by one",
+    )
+    parser.add_argument(
+        "--lazy-parsing",
+        action="store_true",
+        help="parse headers only and decode text parts only, skipping other parts",
+    )
+    parser.add_argument(
+        "--max-html-text",
+        type=int,
+        default=DEFAULT_MAX_TEXT_LENGTH,
+        help="characters of text extracted from one HTML part at most",
+    )
+    parser.add_argument(
+        "--storage-dir", default="storage", help="where emails are stored"
+    )
+    parser.add_argument(
+        "--storage-layout",
+        choices=list(LAYOUTS),
+        help="layout of a new storage directory, existing ones keep theirs",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=[name for name in COMPRESSIONS if name],
+        help="per-message compression of a new pack storage",
+    )
+    parser.add_argument(
+        "--bloom-threshold",
+        type=int,
+        default=DEFAULT_BLOOM_THRESHOLD,
+        help="stored emails past which duplicates are found with a Bloom filter",
+    )
+    parser.add_argument(
+        "--progress-interval",
+        type=float,
+        default=DEFAULT_PROGRESS_INTERVAL,
+        help="seconds between progress lines, 0 to disable them",
+    )
+    parser.add_argument(
+        "--metrics-out",
+        help="write the final metrics to this file in Prometheus text format",
+    )
+    parser.add_argument(
+        "--log-level",
+        default="INFO",
+        choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+        help="DEBUG logs every submitted email",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+
+    subparsers.add_parser(
+        "dirty", help="store .eml and .mbox files from the dirty directory"
+    )
+
+    storage = subparsers.add_parser(
+        "storage", help="import stored .eml files into the database"
+    )
+    storage.add_argument(
+        "--force", action="store_true", help="re-ingest already imported emails"
+    )
+    storage.add_argument(
+        "--manifest",
+        help="read and record imported hashes in this file instead of the database",
+    )
+    storage.add_argument(
+        "--processes",
+        type=int,
+        help="parse in this many processes instead of worker threads",
+    )
+
+    stream = subparsers.add_parser(
+        "stream",
+        help="import the dirty directory in one pass, without reading back the storage",
+    )
+    stream.add_argument(
+        "sources",
+        nargs="*",
+        help="directories, Maildirs, .mbox, .eml or .tar files, possibly "
+        "compressed (.gz, .bz2, .xz, .zst), to read instead of the dirty directory",
+    )
+    stream.add_argument(
+        "--no-archive",
+        dest="archive",
+        action="store_false",
+        help="do not store the raw emails, and leave the dirty files in place",
+    )
+    stream.add_argument(
+        "--force", action="store_true", help="re-ingest already imported emails"
+    )
+    stream.add_argument(
+        "--manifest",
+        help="read and record imported hashes in this file instead of the database",
+    )
+    stream.add_argument(
+        "--parse-workers",
+        type=int,
+        help="threads parsing emails, defaults to --processes or --workers",
+    )
+    stream.add_argument(
+        "--processes",
+        type=int,
+        help="parse in this many processes instead of in the parse threads",
+    )
+    stream.add_argument(
+        "--submit-workers",
+        type=int,
+        default=1,
+        help="threads writing to the database, each with its own connection",
+    )
+    stream.add_argument(
+        "--queue-size",
+        type=int,
+        default=DEFAULT_QUEUE_SIZE,
+        help="emails buffered between two stages",
+    )
+    stream.add_argument(
+        "--source-readers",
+        type=int,
+        default=DEFAULT_SOURCE_READERS,
+        help="sources read and decompressed at the same time",
+    )
+
+    subparsers.add_parser(
+        "migrate-database",
+        help="add the tables a database created by an older version misses",
+    )
+    subparsers.add_parser(
+        "rebuild-stats",
+        help="create missing tables and recompute the word and address statistics",
+    )
+
+    migrate = subparsers.add_parser(
+        "migrate-storage", help="copy the storage directory into another layout"
+    )
+    migrate.add_argument("target", help="directory of the new storage")
+    migrate.add_argument(
+        "--layout", choices=list(LAYOUTS), required=True, help="layout of the target"
+    )
+    migrate.add_argument(
+        "--move",
+        action="store_true",
+        help="remove emails from the current storage once migrated",
+    )
+    return parser.parse_args()
 
 
 # Usage
@@ -576,10 +2221,64 @@ db_config = {
     "port": "5432",
 }
 
-processor = EmailProcessor(db_config, max_workers=16)
-# logger.info(processor.get_email_object_by_id(1))
-# logger.info(processor.get_email_object_by_id(3))
-# logger.info(processor.get_email_object_by_id(5000))
-# processor.process_dirty()
-# processor.process_storage()
-processor.close()
+if __name__ == "__main__":
+    args = parse_args()
+    logger.setLevel(args.log_level)
+    # Log records are written by listener threads, off the import hot path
+    log_listeners = start_queue_logging(logging.getLogger(), logger)
+    processor = EmailProcessor(
+        # Migrations only touch the storage
+        db_config if args.command != "migrate-storage" else None,
+        storage_dir=args.storage_dir,
+        storage_layout=args.storage_layout,
+        storage_compression=args.compression,
+        bloom_threshold=args.bloom_threshold,
+        max_workers=args.workers,
+        bulk_batch_size=args.batch_size,
+        commit_every=args.commit_every,
+        lazy_parsing=args.lazy_parsing,
+        max_html_text=args.max_html_text,
+        progress_interval=args.progress_interval,
+    )
+    # logger.info(processor.get_email_object_by_id(1))
+    # logger.info(processor.get_email_object_by_id(3))
+    # logger.info(processor.get_email_object_by_id(5000))
+    try:
+        if args.command == "dirty":
+            processor.process_dirty()
+        elif args.command == "storage" and args.processes:
+            processor.process_storage_parallel(
+                processes=args.processes,
+                force=args.force,
+                manifest_path=args.manifest,
+            )
+        elif args.command == "storage":
+            processor.process_storage(force=args.force, manifest_path=args.manifest)
+        elif args.command == "stream":
+            processor.process_stream(
+                paths=args.sources or None,
+                archive=args.archive,
+                force=args.force,
+                manifest_path=args.manifest,
+                parse_workers=args.parse_workers,
+                submit_workers=args.submit_workers,
+                parse_processes=args.processes,
+                queue_size=args.queue_size,
+                source_readers=args.source_readers,
+            )
+        elif args.command == "migrate-database":
+            processor.migrate_database()
+        elif args.command == "rebuild-stats":
+            processor.create_tables(secondary_indexes=False)
+            processor.rebuild_stats()
+        elif args.command == "migrate-storage":
+            processor.migrate_storage(
+                args.target, args.layout, args.compression, args.move
+            )
+    finally:
+        processor.close()
+        logger.info(f"Metrics:\n{processor.metrics.summary()}")
+        if args.metrics_out:
+            processor.metrics.write_prometheus(args.metrics_out, "sieve_import")
+        for listener in log_listeners:
+            listener.stop()
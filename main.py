@@ -1,34 +1,46 @@
 #!/usr/bin/env python3
 
-import os
-import re
-import pandas as pd
-from sklearn.feature_extraction.text import TfidfVectorizer
+import numpy as np
+from sklearn.feature_extraction.text import CountVectorizer, TfidfTransformer
 from sklearn.cluster import KMeans
-from sklearn.decomposition import PCA, LatentDirichletAllocation
-from sklearn.metrics import silhouette_score
-from nltk.corpus import stopwords
-from nltk.stem import PorterStemmer
-from nltk.tokenize import word_tokenize
-from collections import Counter
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
+from sklearn.decomposition import LatentDirichletAllocation
+from clustering import plot_clusters_3d, plot_sweep, sweep_cluster_counts
+from feature_store import FeatureStore, directory_fingerprint
+from normalizer import Normalizer
+from scipy import sparse
+from sources import iter_sources
+from streaming_tfidf import DEFAULT_N_FEATURES, StreamingTfidfVectorizer
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from itertools import islice
+import argparse
+import hashlib
+import os
 from wordcloud import WordCloud
 
-# Download NLTK data files (stopwords, etc.)
 import nltk
 
-nltk.download("punkt")
-nltk.download("stopwords")
+# Emails sent to a preprocessing process at a time
+PREPROCESS_CHUNK_SIZE = 64
+
+# Chunks queued per preprocessing process. Reading stops while the queue is
+# full, so memory stays bounded whatever the size of the directory.
+PREPROCESS_CHUNKS_PER_PROCESS = 2
+
+# Emails vectorized per batch in hashing mode
+DEFAULT_BATCH_SIZE = 1000
+
+# Filter words of the preprocessing process, set by init_preprocess_worker
+worker_filter_words = ()
 
 
-# Load emails from directory
-def load_emails(directory):
-    emails = []
-    for filename in os.listdir(directory):
-        with open(os.path.join(directory, filename), "r", encoding="latin1") as file:
-            emails.append(file.read())
-    return emails
+# Normalizers are shared between emails, one per set of filter words
+@lru_cache(maxsize=None)
+def get_normalizer(filter_words=()):
+    return Normalizer(
+        max_length=12, filter_words=filter_words, require_vocabulary=False
+    )
 
 
 # Preprocess email text
@@ -37,165 +49,280 @@ def preprocess_email(text, filter_words=None):
     if filter_words is None:
         filter_words = []
 
-    # Remove non-alphabet characters
-    text = re.sub(r"[^a-zA-Z]+", " ", text)
+    # Remove non-alphabet characters, lowercase, tokenize, remove stopwords
+    # and filter words, then stem.
+    normalizer = get_normalizer(tuple(filter_words))
+    result = " ".join(normalizer.normalize(text))
+    # print(result)
+    return result
 
-    # Convert to lowercase
-    text = text.lower()
 
-    # Tokenize
-    words = word_tokenize(text)
+# Split an iterable into lists of up to size items, lazily
+def iter_chunks(items, size):
+    items = iter(items)
+    while chunk := list(islice(items, size)):
+        yield chunk
 
-    # Remove stopwords
-    stop_words = set(stopwords.words("english"))
-    words = [word for word in words if word not in stop_words]
-    words = [
-        word
-        for word in words
-        if (word not in stop_words) and (word not in filter_words) and (len(word) >= 4) and (len(word) <= 12)
-    ]
 
-    # Stemming
-    stemmer = PorterStemmer()
-    words = [stemmer.stem(word) for word in words]
-
-    result = " ".join(words)
-    # print(result)
-    return result
+# Set up a preprocessing process: load its normalizer once, up front
+def init_preprocess_worker(filter_words):
+    global worker_filter_words
+    worker_filter_words = filter_words
+    get_normalizer(filter_words).preload()
 
 
-# Generate and display a word cloud
-def generate_wordcloud(text, cluster_num):
-    wordcloud = WordCloud(width=800, height=400, background_color="white").generate(
-        text
-    )
-    plt.figure(figsize=(10, 5))
-    plt.imshow(wordcloud, interpolation="bilinear")
-    plt.title(f"Word Cloud for Cluster {cluster_num}")
-    plt.axis("off")
-    plt.show()
+# Preprocess a chunk of raw emails, with the SHA-256 hash of each as its id
+def preprocess_chunk(raws):
+    ids = [hashlib.sha256(raw).hexdigest() for raw in raws]
+    texts = [
+        preprocess_email(raw.decode("latin1"), worker_filter_words) for raw in raws
+    ]
+    return ids, texts
+
+
+# Stream the (id, preprocessed text) of every email of a directory tree,
+# archive or mbox, possibly compressed. Emails are read lazily and
+# preprocessed in a pool of processes, in order; raw emails are dropped as
+# soon as their chunk is preprocessed.
+def iter_preprocessed_emails(
+    source, filter_words, processes=None, chunk_size=PREPROCESS_CHUNK_SIZE
+):
+    processes = processes or os.cpu_count()
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        initializer=init_preprocess_worker,
+        initargs=(tuple(filter_words),),
+    ) as executor:
+        pending = deque()
+        for chunk in iter_chunks(iter_sources([source]), chunk_size):
+            pending.append(executor.submit(preprocess_chunk, chunk))
+            if len(pending) >= processes * PREPROCESS_CHUNKS_PER_PROCESS:
+                yield from zip(*pending.popleft().result())
+        while pending:
+            yield from zip(*pending.popleft().result())
+
+
+# Generate a word cloud from word frequencies and save it to an image file
+def generate_wordcloud(frequencies, cluster_num, path=None):
+    path = path or f"wordcloud_{cluster_num}.png"
+    wordcloud = WordCloud(
+        width=800, height=400, background_color="white"
+    ).generate_from_frequencies(frequencies)
+    wordcloud.to_file(path)
+    print(f"Saved word cloud of cluster {cluster_num} to {path}")
 
 
 # Get the top words in each cluster
-def get_top_words(text, num_words=10):
-    words = text.split()
-    counter = Counter(words)
+def get_top_words(frequencies, num_words=10):
+    counter = Counter(frequencies)
     common_words = counter.most_common(num_words)
     return common_words
 
 
+# Sum the counts of every word in a cluster
+def get_cluster_frequencies(counts, vocabulary, labels, cluster_num):
+    sums = np.asarray(counts[labels == cluster_num].sum(axis=0)).ravel()
+    return {vocabulary[i]: int(sums[i]) for i in np.flatnonzero(sums)}
+
+
+# Vectorize the emails into word and bigram counts. The vectorizer consumes
+# the preprocessed emails as they stream in, without keeping their text.
+def vectorize_emails(directory, filter_words, vectorizer_params, processes=None):
+    print("Loading emails ...")
+    email_ids = []
+
+    def preprocessed_emails():
+        for email_id, text in iter_preprocessed_emails(
+            directory, filter_words, processes
+        ):
+            email_ids.append(email_id)
+            yield text
+
+    vectorizer = CountVectorizer(**vectorizer_params)
+    counts = vectorizer.fit_transform(preprocessed_emails())
+    return counts, vectorizer.get_feature_names_out(), email_ids
+
+
+# Vectorize the emails into hashed word and bigram counts, in fixed-size
+# batches. The IDF and the top terms naming the hashed columns accumulate
+# batch by batch, no vocabulary of the whole corpus is ever built. The state
+# of the vectorizer is stored along with the counts.
+def vectorize_emails_hashing(
+    directory, filter_words, vectorizer, processes=None, batch_size=DEFAULT_BATCH_SIZE
+):
+    print("Loading emails ...")
+    email_ids, batches = [], []
+    for batch in iter_chunks(
+        iter_preprocessed_emails(directory, filter_words, processes), batch_size
+    ):
+        batch_ids, texts = zip(*batch)
+        email_ids.extend(batch_ids)
+        batches.append(vectorizer.partial_fit(texts))
+    counts = sparse.vstack(batches, format="csr")
+    attachments = {"vectorizer": vectorizer.state()}
+    return counts, vectorizer.feature_names(), email_ids, attachments
+
+
 # Elbow Method to determine optimal number of clusters
-def elbow_method(X):
-    wcss = []
-    for i in range(1, 15):
-        kmeans = KMeans(
-            n_clusters=i, init="k-means++", max_iter=300, n_init=10, random_state=42
-        )
-        kmeans.fit(X)
-        wcss.append(kmeans.inertia_)
-    plt.plot(range(1, 15), wcss)
-    plt.title("Elbow Method")
-    plt.xlabel("Number of clusters")
-    plt.ylabel("WCSS")
-    plt.show()
+def elbow_method(X, path="elbow.png"):
+    results = sweep_cluster_counts(X, range(1, 15))
+    plot_sweep(results, "inertia", path, "Elbow Method", "WCSS")
+    print(f"Saved elbow method to {path}")
 
 
 # Silhouette Score to evaluate clustering performance
-def silhouette_analysis(X):
-    silhouette_scores = []
-    for i in range(2, 15):
-        kmeans = KMeans(n_clusters=i, random_state=42)
-        kmeans.fit(X)
-        score = silhouette_score(X, kmeans.labels_)
-        silhouette_scores.append(score)
-
-    plt.plot(range(2, 15), silhouette_scores)
-    plt.title("Silhouette Score Analysis")
-    plt.xlabel("Number of clusters")
-    plt.ylabel("Silhouette Score")
-    plt.show()
-
-
-# Topic Modeling using LDA
-def suggest_topics(X, feature_names, num_topics=5):
+def silhouette_analysis(X, path="silhouette.png"):
+    results = sweep_cluster_counts(X, range(2, 15))
+    plot_sweep(
+        results, "silhouette", path, "Silhouette Score Analysis", "Silhouette Score"
+    )
+    print(f"Saved silhouette analysis to {path}")
+
+
+# Topic Modeling using LDA, on word counts
+def suggest_topics(counts, feature_names, num_topics=5):
     lda = LatentDirichletAllocation(n_components=num_topics, random_state=42)
-    lda.fit(X)
+    lda.fit(counts)
     for index, topic in enumerate(lda.components_):
         print(f"Topic {index}:")
-        print([feature_names[i] for i in topic.argsort()[-10:]])
+        print([str(feature_names[i]) for i in topic.argsort()[-10:]])
         print("\n")
 
 
-# 3D Scatter plot of the clusters using PCA
-def plot_clusters_pca_3d(X, labels, num_clusters):
-    pca = PCA(n_components=3)
-    reduced_data = pca.fit_transform(X.toarray())
+# 3D Scatter plot of the clusters, projected with sparse truncated SVD
+def plot_clusters_svd_3d(X, labels, path="clusters_3d.png"):
+    title = "K-Means Clustering of Emails (SVD-reduced, 3D)"
+    plot_clusters_3d(X, labels, path, title)
+    print(f"Saved 3D cluster plot to {path}")
+
+
+# Parse the command line arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description="Cluster the emails of a source.")
+    parser.add_argument(
+        "directory",
+        nargs="?",
+        default="gmail",
+        help="directory, Maildir, archive or mbox to read the emails from",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        help="preprocessing processes, one per CPU by default",
+    )
+    parser.add_argument(
+        "--hashing",
+        action="store_true",
+        help="hash words and bigrams instead of building a vocabulary",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="emails vectorized per batch in hashing mode",
+    )
+    parser.add_argument(
+        "--n-features",
+        type=int,
+        default=DEFAULT_N_FEATURES,
+        help="hashed feature columns in hashing mode",
+    )
+    return parser.parse_args()
 
-    fig = plt.figure(figsize=(12, 8))
-    ax = fig.add_subplot(111, projection="3d")
 
+# Main processing
+def main():
+    args = parse_args()
+
+    # Download NLTK data files (stopwords, etc.)
+    nltk.download("punkt")
+    nltk.download("stopwords")
+
+    directory = args.directory
+    filter_words = [
+        # "enron",
+        # "subject",
+        # "http",
+        # "www",
+        # "net",
+        # "com",
+    ]
+
+    if args.hashing:
+        vectorizer = StreamingTfidfVectorizer(n_features=args.n_features)
+        name = "main_hashing"
+        vectorizer_params = {
+            "n_features": args.n_features,
+            "batch_size": args.batch_size,
+        }
+        vectorize = partial(
+            vectorize_emails_hashing,
+            directory,
+            filter_words,
+            vectorizer,
+            args.processes,
+            args.batch_size,
+        )
+    else:
+        name = "main"
+        vectorizer_params = {"max_features": 1000, "ngram_range": (1, 2)}
+        vectorize = partial(
+            vectorize_emails, directory, filter_words, vectorizer_params, args.processes
+        )
+
+    # Vectorize the text data, only once per state of the directory. Delete
+    # .cache/features after changing the preprocessing to vectorize again.
+    fingerprint = directory_fingerprint(
+        directory, filter_words, sorted(vectorizer_params.items())
+    )
+    store = FeatureStore()
+    counts, vocabulary, email_ids = store.cached(name, fingerprint, vectorize)
+    print(f"Vectorized {counts.shape[0]} emails")
+    if args.hashing:
+        # The streaming IDF of the stored counts, without refitting
+        state = store.load_attachment(name, fingerprint, "vectorizer")
+        if state is None:
+            # Stored before the vectorizer state was
+            store.cached(name, fingerprint, vectorize, refresh=True)
+            state = store.load_attachment(name, fingerprint, "vectorizer")
+        vectorizer = StreamingTfidfVectorizer.from_state(state)
+        X = vectorizer.weight(counts)
+    else:
+        X = TfidfTransformer().fit_transform(counts)
+
+    # Determine the optimal number of clusters
+    elbow_method(X)  # 4 and 13
+    silhouette_analysis(X)  # 5 and 10
+
+    # Suggest possible topics
+    suggest_topics(counts, vocabulary, num_topics=5)
+
+    # Apply K-Means clustering
+    num_clusters = 8
+    kmeans = KMeans(n_clusters=num_clusters, random_state=42)
+    kmeans.fit(X)
+
+    # Assign emails to clusters
+    labels = kmeans.labels_
+
+    # Generate word clouds and top words for each cluster
     for i in range(num_clusters):
-        points = reduced_data[labels == i]
-        ax.scatter(points[:, 0], points[:, 1], points[:, 2], label=f"Cluster {i}")
+        frequencies = get_cluster_frequencies(counts, vocabulary, labels, i)
 
-    ax.set_title("K-Means Clustering of Emails (PCA-reduced, 3D)")
-    ax.set_xlabel("PCA Component 1")
-    ax.set_ylabel("PCA Component 2")
-    ax.set_zlabel("PCA Component 3")
-    # ax.set_zlabel("PCA Component 3")
-    ax.legend()
-    plt.show()
+        # Generate word cloud
+        if frequencies:
+            generate_wordcloud(frequencies, i)
 
+        # Display top words
+        top_words = get_top_words(frequencies, 10)
+        print(f"Top words in Cluster {i}:")
+        for word, freq in top_words:
+            print(f"{word}: {freq}")
+        print("\n")
 
-# Main processing
-directory = "gmail"  # Replace with your directory
-filter_words = [
-    # "enron",
-    # "subject",
-    # "http",
-    # "www",
-    # "net",
-    # "com",
-]
-
-print("
-emails = load_emails(directory)
-preprocessed_emails = [preprocess_email(email, filter_words) for email in emails]
-
-# Vectorize the text data
-vectorizer = TfidfVectorizer(max_features=1000, ngram_range=(1, 2))
-X = vectorizer.fit_transform(preprocessed_emails)
-
-# Determine the optimal number of clusters
-elbow_method(X) # 4 and 13
-silhouette_analysis(X) # 5 and 10
-
-# Suggest possible topics
-suggest_topics(X, vectorizer.get_feature_names_out(), num_topics=5)
-
-# Apply K-Means clustering
-num_clusters = 8
-kmeans = KMeans(n_clusters=num_clusters, random_state=42)
-kmeans.fit(X)
-
-# Assign emails to clusters
-labels = kmeans.labels_
-df = pd.DataFrame({"Email": preprocessed_emails, "Cluster": labels})
-
-
-# Generate word clouds and top words for each cluster
-for i in range(num_clusters):
-    cluster_text = " ".join(df[df["Cluster"] == i]["Email"])
-
-    # Generate word cloud
-    generate_wordcloud(cluster_text, i)
-
-    # Display top words
-    top_words = get_top_words(cluster_text, 10)
-    print(f"Top words in Cluster {i}:")
-    for word, freq in top_words:
-        print(f"{word}: {freq}")
-    print("\n")
-
-# Plot clusters on a scatterplot using PCA
-plot_clusters_pca_3d(X, labels, num_clusters)
+    # Plot clusters on a scatterplot using SVD
+    plot_clusters_svd_3d(X, labels)
+
+
+if __name__ == "__main__":
+    main()
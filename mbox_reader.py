@@ -0,0 +1,111 @@
+import mmap
+import os
+
+# Every message in an mbox starts with a "From " line at the start of a line
+MBOX_SEPARATOR = b"\nFrom "
+
+
+class MboxReader:
+    """Streaming, memory-mapped reader for mbox files.
+
+    Unlike mailbox.mbox, no table of contents is built up front: message
+    boundaries are found lazily by scanning the raw bytes for "From " lines,
+    and messages are returned as their original bytes (without the "From "
+    line) instead of being parsed and re-serialized. Only the message being
+    handled is ever copied out of the map, so memory stays bounded whatever
+    the size of the mbox.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        # Empty files cannot be mapped
+        self.map = (
+            mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if self.size
+            else b""
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return self.iter_messages()
+
+    def close(self):
+        """Unmap and close the mbox file."""
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+
+    def next_message_start(self, offset):
+        """Return the offset of the first message starting at or after offset."""
+        if offset <= 0:
+            return 0 if self.map[:5] == b"From " else self.next_message_start(1)
+        position = self.map.find(MBOX_SEPARATOR, offset - 1)
+        return self.size if position == -1 else position + 1
+
+    def split(self, parts):
+        """Split the mbox into up to `parts` byte ranges on message boundaries.
+
+        Each (start, end) range can be handed to a separate worker, which
+        iterates it with iter_messages(start, end).
+        """
+        starts = sorted(
+            {self.next_message_start(self.size * i // parts) for i in range(parts)}
+        )
+        ends = starts[1:] + [self.size]
+        return [(start, end) for start, end in zip(starts, ends) if start < end]
+
+    def iter_messages(self, start=0, end=None):
+        """Yield the raw bytes of every message starting within [start, end)."""
+        end = self.size if end is None else end
+        position = self.next_message_start(start)
+        while position < end:
+            next_position = self.next_message_start(position + 1)
+
+            # Skip the "From " line itself
+            body_start = self.map.find(b"\n", position, next_position)
+            body_start = next_position if body_start == -1 else body_start + 1
+
+            # Drop the blank line that separates the message from the next one
+            body_end = next_position
+            if self.map[body_end - 4 : body_end] == b"\r\n\r\n":
+                body_end -= 2
+            elif self.map[body_end - 2 : body_end] == b"\n\n":
+                body_end -= 1
+
+            yield self.map[body_start:body_end]
+            position = next_position
+
+
+def iter_mbox_stream(file):
+    """Yield the raw bytes of every message of an mbox read sequentially.
+
+    For mbox files that cannot be memory-mapped, such as compressed ones
+    read through a decompressing stream. Messages are split and trimmed
+    exactly like MboxReader.iter_messages does.
+    """
+    lines = None
+    for line in file:
+        if line.startswith(b"From "):
+            if lines is not None:
+                yield trim_separator(b"".join(lines))
+            lines = []
+        elif lines is not None:
+            lines.append(line)
+    if lines is not None:
+        yield trim_separator(b"".join(lines))
+
+
+def trim_separator(message):
+    """Drop the blank line that separates a message from the next one."""
+    if message.endswith(b"\r\n\r\n"):
+        return message[:-2]
+    if message.endswith(b"\n\n"):
+        return message[:-1]
+    return message
@@ -0,0 +1,310 @@
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from threading import Event, Lock, Thread
+import bisect
+import datetime
+import functools
+import os
+import time
+
+# Upper bounds, in seconds, of the latency histogram buckets
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# Seconds between two progress lines
+DEFAULT_PROGRESS_INTERVAL = 10.0
+
+
+class Histogram:
+    """Latency histogram with fixed buckets, like a Prometheus histogram."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # One count per bucket, plus one for values above the last bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of the bucket it falls in."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    """Thread-safe counters and latency histograms of a pipeline.
+
+    Snapshots are plain dicts, so metrics collected in worker processes can
+    be sent back and merged into the metrics of the main process.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.monotonic()
+
+    def increment(self, name, value=1):
+        """Add value to a counter."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        """Record a latency in a histogram."""
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        """Record the duration of the with block in a histogram."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def counter(self, name):
+        """Return the current value of a counter."""
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    def snapshot(self, reset=False):
+        """Return the metrics as a picklable dict, optionally resetting them."""
+        with self.lock:
+            snapshot = {
+                "counters": dict(self.counters),
+                "histograms": {
+                    name: (histogram.counts, histogram.count, histogram.sum)
+                    for name, histogram in self.histograms.items()
+                },
+            }
+            if reset:
+                self.counters = {}
+                self.histograms = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        """Add the metrics of a snapshot, e.g. from a worker process."""
+        with self.lock:
+            for name, value in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, (counts, count, total) in snapshot["histograms"].items():
+                other = Histogram(self.buckets)
+                other.counts, other.count, other.sum = list(counts), count, total
+                histogram = self.histograms.get(name)
+                if histogram is None:
+                    histogram = self.histograms[name] = Histogram(self.buckets)
+                histogram.merge(other)
+
+    def summary(self):
+        """Return a human readable summary of every metric."""
+        elapsed = time.monotonic() - self.started
+        with self.lock:
+            lines = [f"Elapsed: {datetime.timedelta(seconds=round(elapsed))}"]
+            for name in sorted(self.counters):
+                lines.append(f"{name}: {self.counters[name]}")
+            for name in sorted(self.histograms):
+                histogram = self.histograms[name]
+                mean = histogram.sum / histogram.count if histogram.count else 0.0
+                lines.append(
+                    f"{name}: count={histogram.count} total={histogram.sum:.3f}s "
+                    f"mean={mean * 1000:.3f}ms "
+                    f"p50<={histogram.quantile(0.5) * 1000:g}ms "
+                    f"p95<={histogram.quantile(0.95) * 1000:g}ms "
+                    f"p99<={histogram.quantile(0.99) * 1000:g}ms"
+                )
+        return "\n".join(lines)
+
+    def prometheus(self, prefix):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for name in sorted(self.counters):
+                metric = f"{prefix}_{name}_total"
+                lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric} {self.counters[name]}")
+            for name in sorted(self.histograms):
+                histogram = self.histograms[name]
+                metric = f"{prefix}_{name}_seconds"
+                lines.append(f"# TYPE {metric} histogram")
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{le="{bound:g}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram.count}')
+                lines.append(f"{metric}_sum {histogram.sum}")
+                lines.append(f"{metric}_count {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, prefix):
+        """Write the metrics to a Prometheus text file, atomically.
+
+        The file can be picked up by the node exporter textfile collector.
+        """
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as file:
+            file.write(self.prometheus(prefix))
+        os.replace(temp_path, path)
+
+
+class ProgressReporter:
+    """Background thread logging progress, throughput and ETA periodically."""
+
+    def __init__(
+        self,
+        metrics,
+        counters,
+        total,
+        logger,
+        interval=DEFAULT_PROGRESS_INTERVAL,
+    ):
+        self.metrics = metrics
+        # Counters whose sum is the number of messages done
+        self.counters = counters
+        self.total = total
+        self.logger = logger
+        self.interval = interval
+        self.stopped = Event()
+        self.thread = Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def count(self):
+        return sum(self.metrics.counter(name) for name in self.counters)
+
+    def done(self):
+        """Number of messages done since the reporter started."""
+        return self.count() - self.offset
+
+    def start(self):
+        # Metrics accumulate over runs, progress only counts this one
+        self.offset = self.count()
+        self.started = time.monotonic()
+        if self.interval > 0:
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def run(self):
+        last_done, last_time = self.done(), self.started
+        while not self.stopped.wait(self.interval):
+            done, now = self.done(), time.monotonic()
+            rate = (done - last_done) / (now - last_time)
+            average = done / (now - self.started)
+            self.logger.info(self.format(done, rate, average))
+            last_done, last_time = done, now
+
+    def format(self, done, rate, average):
+        """Format a progress line, the ETA is based on the average rate."""
+        if self.total:
+            line = f"Progress: {done}/{self.total} messages ({done / self.total:.1%})"
+        else:
+            line = f"Progress: {done} messages"
+        line += f", {rate:.1f} msgs/s"
+        if average > 0 and self.total:
+            remaining = max(self.total - done, 0) / average
+            line += f", ETA {datetime.timedelta(seconds=round(remaining))}"
+        return line
+
+
+def start_queue_logging(*loggers):
+    """Move the handlers of loggers behind queues, off the calling threads.
+
+    Callers only put records on an in-memory queue, a listener thread per
+    logger formats them and writes them to the original handlers. Returns
+    the listeners, to be stopped at exit so pending records are flushed.
+    """
+    listeners = []
+    for logger in loggers:
+        handlers = list(logger.handlers)
+        if not handlers:
+            continue
+        for handler in handlers:
+            logger.removeHandler(handler)
+        queue = SimpleQueue()
+        queue_handler = QueueHandler(queue)
+        listener = QueueListener(queue, *handlers, respect_handler_level=True)
+        # Kept to undo the queueing, see stop_queue_logging
+        queue_handler.listener = listener
+        logger.addHandler(queue_handler)
+        listener.start()
+        listeners.append(listener)
+    return listeners
+
+
+def stop_queue_logging(*loggers):
+    """Give loggers back the handlers start_queue_logging moved behind queues.
+
+    Forked processes inherit the queue handlers but not the listener
+    threads, so their records would sit in a queue nobody reads. Calling
+    this in the child makes it write to the original handlers directly.
+    """
+    for logger in loggers:
+        for handler in list(logger.handlers):
+            listener = getattr(handler, "listener", None)
+            if listener is None:
+                continue
+            logger.removeHandler(handler)
+            for original in listener.handlers:
+                logger.addHandler(original)
+
+
+def timed(name):
+    """Decorate a method to record its duration in self.metrics."""
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.timer(name):
+                return method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,141 @@
+from email import policy
+from email.header import decode_header, make_header
+from email.parser import BytesHeaderParser
+import binascii
+import re
+
+# Regex to find the blank line that ends a header block
+REGEX_HEADER_END = re.compile(rb"\r?\n\r?\n")
+
+# Regex to unfold header lines
+REGEX_HEADER_FOLDING = re.compile(r"\r?\n[ \t]")
+
+# Regex to find the characters outside of the base64 alphabet, padding included
+REGEX_NOT_BASE64 = re.compile(rb"[^A-Za-z0-9+/]")
+
+# Content types whose text is extracted from a message
+TEXT_CONTENT_TYPES = ("text/plain", "text/html")
+
+# Nesting limit for multipart and message/rfc822 entities
+MAX_MIME_DEPTH = 16
+
+
+def split_entity(raw):
+    """Split a MIME entity into its header block and its body."""
+    if raw.startswith(b"\n") or raw.startswith(b"\r\n"):
+        return b"", raw[raw.index(b"\n") + 1 :]
+    match = REGEX_HEADER_END.search(raw)
+    if match is None:
+        return raw, b""
+    return raw[: match.start()], raw[match.end() :]
+
+
+def parse_header_block(header_bytes):
+    """Parse a header block with the cheap compat32 policy."""
+    return BytesHeaderParser(policy=policy.compat32).parsebytes(header_bytes)
+
+
+def parse_headers(raw):
+    """Parse only the top-level headers of a raw message."""
+    return parse_header_block(split_entity(raw)[0])
+
+
+def decode_header_value(value):
+    """Unfold and decode RFC 2047 encoded words of a raw header value."""
+    value = REGEX_HEADER_FOLDING.sub(" ", str(value))
+    try:
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return value
+
+
+def split_multipart(body, boundary):
+    """Split a multipart body into the raw bytes of its parts.
+
+    Only the boundary delimiters are searched for, the parts themselves are
+    not scanned.
+    """
+    delimiter = b"--" + boundary
+    if body.startswith(delimiter):
+        position = 0
+    else:
+        position = body.find(b"\n" + delimiter)
+        if position == -1:
+            return []
+        position += 1
+
+    parts = []
+    while True:
+        after = position + len(delimiter)
+        if body[after : after + 2] == b"--":
+            break  # Closing delimiter
+        start = body.find(b"\n", after)
+        if start == -1:
+            break
+        start += 1
+        end = body.find(b"\n" + delimiter, start)
+        if end == -1:
+            parts.append(body[start:])
+            break
+        part_end = end - 1 if body[end - 1 : end] == b"\r" else end
+        parts.append(body[start:part_end])
+        position = end + 1
+    return parts
+
+
+def decode_base64(body):
+    """Decode a base64 body as leniently as the email package does.
+
+    Missing padding, e.g. of a truncated body, is added back. A body that
+    still cannot be decoded is returned as is, like Message.get_payload.
+    """
+    try:
+        return binascii.a2b_base64(body)
+    except binascii.Error:
+        pass
+    data = REGEX_NOT_BASE64.sub(b"", body)
+    try:
+        return binascii.a2b_base64(data + b"=" * (-len(data) % 4))
+    except binascii.Error:
+        return body
+
+
+def decode_payload(body, encoding):
+    """Undo the Content-Transfer-Encoding of a leaf body."""
+    encoding = (encoding or "").strip().lower()
+    if encoding == "base64":
+        return decode_base64(body)
+    if encoding == "quoted-printable":
+        return binascii.a2b_qp(body)
+    return body
+
+
+def iter_text_parts(raw, depth=0):
+    """Yield (content_type, text) for every text leaf of a MIME entity.
+
+    The MIME tree is walked by boundary search on the raw bytes. Only the
+    small header block of each part is parsed, and only text/plain and
+    text/html leaves are decoded, other leaves are skipped untouched. Text
+    attachments are decoded too, as Message-based extraction does.
+    """
+    header_bytes, body = split_entity(raw)
+    headers = parse_header_block(header_bytes)
+    content_type = headers.get_content_type()
+
+    if headers.get_content_maintype() == "multipart":
+        boundary = headers.get_param("boundary")
+        if not boundary or depth >= MAX_MIME_DEPTH:
+            return
+        for part in split_multipart(body, str(boundary).encode("utf-8", "replace")):
+            yield from iter_text_parts(part, depth + 1)
+    elif content_type == "message/rfc822":
+        if depth < MAX_MIME_DEPTH:
+            yield from iter_text_parts(body, depth + 1)
+    elif content_type in TEXT_CONTENT_TYPES:
+        payload = decode_payload(body, headers.get("Content-Transfer-Encoding"))
+        charset = headers.get_content_charset() or "utf-8"
+        try:
+            text = payload.decode(charset, errors="replace")
+        except LookupError:
+            text = payload.decode("utf-8", errors="replace")
+        yield content_type, text
@@ -0,0 +1,128 @@
+from functools import lru_cache
+from nltk.corpus import stopwords
+from nltk.corpus import wordnet
+from nltk.stem import PorterStemmer
+from nltk.tokenize import word_tokenize
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+# Regex to remove non-alphabet characters
+REGEX_NON_WORDS = re.compile(r"[^a-zA-Z]+")
+
+# Where the WordNet vocabulary is cached between runs
+DEFAULT_VOCABULARY_CACHE = os.path.join(
+    os.path.expanduser("~"), ".cache", "sieve-library", "wordnet_vocabulary.txt"
+)
+
+# Number of distinct surface tokens whose normalized form is memoized
+DEFAULT_TOKEN_CACHE_SIZE = 1 << 18
+
+
+def load_vocabulary(cache_path=DEFAULT_VOCABULARY_CACHE):
+    """Load the set of WordNet lemma names, building the on-disk cache once."""
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, "r", encoding="utf-8") as file:
+            return frozenset(file.read().split())
+
+    logger.info("Building WordNet vocabulary ...")
+    vocabulary = frozenset(name.lower() for name in wordnet.all_lemma_names())
+
+    if cache_path:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # Write to a temporary file first so concurrent builders never read a
+        # partial cache.
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            file.write("\n".join(sorted(vocabulary)))
+        os.replace(temp_path, cache_path)
+    logger.info(f"WordNet vocabulary built with {len(vocabulary)} lemmas")
+    return vocabulary
+
+
+class Normalizer:
+    """Reusable tokenizer, filter and stemmer for email text.
+
+    Text only ever contains letters and spaces once non-words are stripped, so
+    tokenizing, filtering and stemming each whitespace separated token depends
+    on nothing but the token itself. The whole per-token pipeline is therefore
+    memoized in a bounded LRU cache, and repeated words cost a dict lookup.
+    """
+
+    def __init__(
+        self,
+        min_length=4,
+        max_length=16,
+        filter_words=(),
+        require_vocabulary=True,
+        vocabulary_cache=DEFAULT_VOCABULARY_CACHE,
+        token_cache_size=DEFAULT_TOKEN_CACHE_SIZE,
+    ):
+        self.min_length = min_length
+        self.max_length = max_length
+        self.filter_words = frozenset(filter_words)
+        self.require_vocabulary = require_vocabulary
+        self.vocabulary_cache = vocabulary_cache
+        self.stemmer = PorterStemmer()
+        self._stop_words = None
+        self._vocabulary = None
+        self.normalize_token = lru_cache(maxsize=token_cache_size)(
+            self._normalize_token
+        )
+
+    @property
+    def stop_words(self):
+        """English stop words, loaded on first use."""
+        if self._stop_words is None:
+            self._stop_words = frozenset(stopwords.words("english"))
+        return self._stop_words
+
+    @property
+    def vocabulary(self):
+        """Frozen set of WordNet lemma names, loaded on first use."""
+        if self._vocabulary is None:
+            self._vocabulary = load_vocabulary(self.vocabulary_cache)
+        return self._vocabulary
+
+    def preload(self):
+        """Load the stop words and vocabulary up front."""
+        _ = self.stop_words
+        if self.require_vocabulary:
+            _ = self.vocabulary
+
+    def is_word(self, word):
+        """Check that the word (or an inflection of it) is known to WordNet."""
+        # Lemma names are the fast path; synsets() also resolves inflected
+        # forms such as plurals through morphy.
+        return word in self.vocabulary or len(wordnet.synsets(word)) > 0
+
+    def _normalize_token(self, token):
+        # word_tokenize still splits a few letter-only contractions, such as
+        # "cannot" into "can" and "not".
+        words = [
+            word
+            for word in word_tokenize(token)
+            if self.min_length <= len(word) <= self.max_length
+            and word not in self.stop_words
+            and word not in self.filter_words
+        ]
+        if self.require_vocabulary:
+            words = [word for word in words if self.is_word(word)]
+        return tuple(self.stemmer.stem(word) for word in words)
+
+    def normalize(self, content):
+        """Normalize text into a list of stemmed words."""
+        words = []
+        for token in REGEX_NON_WORDS.sub(" ", content).lower().split():
+            words.extend(self.normalize_token(token))
+        return words
+
+    def normalize_many(self, contents):
+        """Normalize a batch of texts, sharing the token cache between them."""
+        return [self.normalize(content) for content in contents]
+
+    def cache_info(self):
+        """Return hit/miss statistics of the token cache."""
+        return self.normalize_token.cache_info()
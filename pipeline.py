@@ -0,0 +1,106 @@
+from queue import Queue
+from threading import Lock, Thread
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Items buffered between two stages by default. A full queue blocks the stage
+# feeding it, so fast stages wait for slow ones instead of filling memory.
+DEFAULT_QUEUE_SIZE = 256
+
+# Marks the end of the items on a queue
+STOP = object()
+
+
+class Stage:
+    """A step of a pipeline, run by its own pool of worker threads."""
+
+    def __init__(self, name, function, workers=1, on_exit=None):
+        self.name = name
+        # Called with each item; returns the item for the next stage, or None
+        # to drop it.
+        self.function = function
+        self.workers = workers
+        # Called by each worker thread before it exits, e.g. to commit
+        self.on_exit = on_exit
+
+
+class Pipeline:
+    """Stream items through stages connected by bounded queues.
+
+    Each stage has its own number of worker threads, so the concurrency of
+    I/O, CPU and database stages can be tuned separately. Items are
+    processed in no particular order. An exception raised for an item is
+    logged and the item dropped; stage functions handle their own failures
+    when they need to count them.
+    """
+
+    def __init__(self, stages, metrics=None, queue_size=DEFAULT_QUEUE_SIZE):
+        self.stages = stages
+        self.metrics = metrics
+        self.queues = [Queue(maxsize=queue_size) for _ in stages]
+        self.lock = Lock()
+
+    def run(self, items):
+        """Feed items to the first stage and wait for every stage to finish."""
+        running = [stage.workers for stage in self.stages]
+        threads = [
+            Thread(
+                target=self.work,
+                args=(index, running),
+                name=f"{stage.name}-{worker}",
+            )
+            for index, stage in enumerate(self.stages)
+            for worker in range(stage.workers)
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            for item in items:
+                self.put(self.queues[0], item, "source")
+        finally:
+            for _ in range(self.stages[0].workers):
+                self.queues[0].put(STOP)
+            for thread in threads:
+                thread.join()
+
+    def work(self, index, running):
+        """Worker thread of a stage: process items until the stage is stopped."""
+        stage = self.stages[index]
+        queue = self.queues[index]
+        output = self.queues[index + 1] if index + 1 < len(self.queues) else None
+        try:
+            while True:
+                item = self.timed(f"stage_{stage.name}_wait", queue.get)
+                if item is STOP:
+                    break
+                try:
+                    result = self.timed(f"stage_{stage.name}", stage.function, item)
+                except Exception as e:
+                    logger.error(f"Error in the {stage.name} stage, dropping item: {e}")
+                    if self.metrics:
+                        self.metrics.increment(f"stage_{stage.name}_errors")
+                    continue
+                if result is not None and output is not None:
+                    self.put(output, result, stage.name)
+        finally:
+            if stage.on_exit:
+                stage.on_exit()
+            # The last worker of a stage stops the workers of the next one
+            with self.lock:
+                running[index] -= 1
+                last = running[index] == 0
+            if last and output is not None:
+                for _ in range(self.stages[index + 1].workers):
+                    output.put(STOP)
+
+    def put(self, queue, item, name):
+        """Hand an item to the next stage, recording time blocked on it."""
+        self.timed(f"stage_{name}_blocked", queue.put, item)
+
+    def timed(self, name, function, *args):
+        if self.metrics is None:
+            return function(*args)
+        with self.metrics.timer(name):
+            return function(*args)
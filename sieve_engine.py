@@ -0,0 +1,741 @@
+#!/usr/bin/env python3
+
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from email import policy
+from email.header import decode_header, make_header
+from email.parser import BytesHeaderParser
+from email.utils import getaddresses
+from storage import open_storage
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+# Tokens of the Sieve grammar (RFC 5228 section 8.1)
+REGEX_SIEVE_TOKEN = re.compile(
+    r"""
+    (?P<whitespace>\s+)
+    | (?P<comment>\#[^\n]*|/\*.*?\*/)
+    | (?P<multiline>text:[ \t]*(?:\#[^\n]*)?\r?\n(?P<text>.*?)^\.\r?$\n?)
+    | (?P<string>"(?:[^"\\]|\\.)*")
+    | (?P<number>\d+[KMG]?)
+    | (?P<tag>:[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<identifier>[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<special>[\[\](){},;])
+    """,
+    re.VERBOSE | re.DOTALL | re.MULTILINE,
+)
+
+# Regex to find ${name} variable references in strings
+REGEX_SIEVE_VARIABLE = re.compile(r"\$\{([A-Za-z0-9_.]+)\}")
+
+# Regex to unfold header lines
+REGEX_HEADER_FOLDING = re.compile(r"\r?\n[ \t]")
+
+NUMBER_SUFFIXES = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+ADDRESS_PARTS = (":all", ":localpart", ":domain")
+MATCH_TYPES = (":is", ":contains", ":matches")
+DEFAULT_COMPARATOR = "i;ascii-casemap"
+
+# Number of messages handed to a worker process per work unit
+DEFAULT_CHUNK_SIZE = 256
+
+
+class SieveError(Exception):
+    """Raised when a Sieve script cannot be parsed or compiled."""
+
+
+class StopScript(Exception):
+    """Raised by the stop command to end evaluation of a script."""
+
+
+class Node:
+    """A command or test of a parsed Sieve script."""
+
+    def __init__(self, name, arguments, tests, block, line):
+        self.name = name
+        self.arguments = arguments
+        self.tests = tests
+        self.block = block
+        self.line = line
+
+
+class Parser:
+    """Recursive descent parser for the Sieve grammar."""
+
+    def __init__(self, text):
+        self.tokens = list(self.tokenize(text))
+        self.position = 0
+
+    def tokenize(self, text):
+        line = 1
+        position = 0
+        while position < len(text):
+            match = REGEX_SIEVE_TOKEN.match(text, position)
+            if match is None:
+                raise SieveError(f"line {line}: unexpected {text[position]!r}")
+            kind = match.lastgroup
+            value = match.group(kind)
+            if kind == "string":
+                yield "string", re.sub(r"\\(.)", r"\1", value[1:-1]), line
+            elif kind == "multiline":
+                text_value = re.sub(r"^\.\.", ".", match.group("text"), flags=re.M)
+                yield "string", text_value, line
+            elif kind == "number":
+                multiplier = NUMBER_SUFFIXES.get(value[-1], 1)
+                yield "number", int(value.rstrip("KMG")) * multiplier, line
+            elif kind in ("tag", "special"):
+                yield kind, value, line
+            elif kind == "identifier":
+                yield kind, value.lower(), line
+            line += value.count("\n")
+            position = match.end()
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None, None, self.tokens[-1][2] if self.tokens else 1
+
+    def take(self, kind=None, value=None):
+        token_kind, token_value, line = self.peek()
+        if (kind and token_kind != kind) or (value and token_value != value):
+            expected = value or kind
+            raise SieveError(f"line {line}: expected {expected}, got {token_value!r}")
+        self.position += 1
+        return token_value
+
+    def parse(self):
+        commands = self.parse_commands()
+        if self.peek()[0] is not None:
+            raise SieveError(f"line {self.peek()[2]}: unexpected {self.peek()[1]!r}")
+        return commands
+
+    def parse_commands(self):
+        commands = []
+        while self.peek()[0] == "identifier":
+            commands.append(self.parse_command())
+        return commands
+
+    def parse_command(self):
+        line = self.peek()[2]
+        name = self.take("identifier")
+        arguments, tests = self.parse_arguments()
+        block = None
+        if self.peek()[1] == "{":
+            self.take(value="{")
+            block = self.parse_commands()
+            self.take(value="}")
+        else:
+            self.take(value=";")
+        return Node(name, arguments, tests, block, line)
+
+    def parse_test(self):
+        line = self.peek()[2]
+        name = self.take("identifier")
+        arguments, tests = self.parse_arguments()
+        return Node(name, arguments, tests, None, line)
+
+    def parse_arguments(self):
+        arguments = []
+        while True:
+            kind, value, _ = self.peek()
+            if kind in ("tag", "number"):
+                arguments.append(self.take())
+            elif kind == "string":
+                arguments.append([self.take()])
+            elif value == "[":
+                arguments.append(self.parse_string_list())
+            else:
+                break
+
+        tests = []
+        kind, value, _ = self.peek()
+        if value == "(":
+            self.take(value="(")
+            tests.append(self.parse_test())
+            while self.peek()[1] == ",":
+                self.take(value=",")
+                tests.append(self.parse_test())
+            self.take(value=")")
+        elif kind == "identifier":
+            tests.append(self.parse_test())
+        return arguments, tests
+
+    def parse_string_list(self):
+        self.take(value="[")
+        strings = [self.take("string")]
+        while self.peek()[1] == ",":
+            self.take(value=",")
+            strings.append(self.take("string"))
+        self.take(value="]")
+        return strings
+
+
+class SieveMessage:
+    """Headers of a message, decoded lazily and cached for the tests."""
+
+    def __init__(self, headers, size=0):
+        self.raw_headers = {}
+        for name, value in headers:
+            self.raw_headers.setdefault(name.lower(), []).append(value)
+        self.size = size
+        self.decoded = {}
+        self.addresses = {}
+
+    @classmethod
+    def from_bytes(cls, raw):
+        """Parse only the header block of a raw message."""
+        parsed = BytesHeaderParser(policy=policy.compat32).parsebytes(raw)
+        return cls(parsed.items(), len(raw))
+
+    @classmethod
+    def from_file(cls, file_path):
+        """Read and parse only the header block of a message file."""
+        lines = []
+        with open(file_path, "rb") as file:
+            for line in file:
+                if line in (b"\n", b"\r\n"):
+                    break
+                lines.append(line)
+            size = os.fstat(file.fileno()).st_size
+        parsed = BytesHeaderParser(policy=policy.compat32).parsebytes(b"".join(lines))
+        return cls(parsed.items(), size)
+
+    def header(self, name):
+        """Return the decoded values of a header."""
+        values = self.decoded.get(name)
+        if values is None:
+            values = self.decoded[name] = [
+                self.decode(value) for value in self.raw_headers.get(name, [])
+            ]
+        return values
+
+    def decode(self, value):
+        value = REGEX_HEADER_FOLDING.sub(" ", str(value))
+        try:
+            return str(make_header(decode_header(value)))
+        except Exception:
+            return value
+
+    def address(self, name, part):
+        """Return one part (:all, :localpart, :domain) of a header's addresses."""
+        key = (name, part)
+        values = self.addresses.get(key)
+        if values is None:
+            values = []
+            for _, address in getaddresses(self.header(name)):
+                if not address:
+                    continue
+                localpart, _, domain = address.rpartition("@")
+                if part == ":localpart":
+                    values.append(localpart if localpart else domain)
+                elif part == ":domain":
+                    values.append(domain if localpart else "")
+                else:
+                    values.append(address)
+            self.addresses[key] = values
+        return values
+
+
+class SieveState:
+    """Actions and variables accumulated while evaluating a script."""
+
+    def __init__(self, message):
+        self.message = message
+        self.variables = {}
+        self.folders = []
+        self.flags = []
+        self.redirects = []
+        self.expire = None
+        self.keep = False
+        self.implicit_keep = True
+
+    def expand(self, value):
+        """Substitute ${name} variable references in a string."""
+        if "${" not in value:
+            return value
+        return REGEX_SIEVE_VARIABLE.sub(
+            lambda match: self.variables.get(match.group(1).lower(), ""), value
+        )
+
+    def result(self):
+        folders = list(self.folders)
+        if self.keep or (self.implicit_keep and "INBOX" not in folders):
+            folders.insert(0, "INBOX")
+        return {
+            "folders": folders,
+            "flags": self.flags,
+            "expire": self.expire,
+            "redirects": self.redirects,
+        }
+
+
+def has_variables(strings):
+    return any("${" in string for string in strings)
+
+
+def build_matcher(match_type, comparator, keys):
+    """Compile a key list into a single value -> bool function.
+
+    :is becomes a hash-set lookup and :contains/:matches a single regex, so
+    long key lists cost the same as one key.
+    """
+    fold = comparator == DEFAULT_COMPARATOR
+    if match_type == ":is":
+        keyset = frozenset(key.lower() if fold else key for key in keys)
+        if fold:
+            return lambda value: value.lower() in keyset
+        return keyset.__contains__
+
+    if match_type == ":contains":
+        patterns = [re.escape(key) for key in keys]
+    else:
+        patterns = [
+            "".join(
+                ".*" if part == "*" else "." if part == "?" else re.escape(part[-1])
+                for part in re.findall(r"\\.|\*|\?|[^*?\\]", key)
+            )
+            + r"\Z"
+            for key in keys
+        ]
+    regex = re.compile(
+        "|".join(f"(?:{pattern})" for pattern in patterns),
+        re.DOTALL | (re.IGNORECASE if fold else 0),
+    )
+    if match_type == ":contains":
+        return lambda value: regex.search(value) is not None
+    return lambda value: regex.match(value) is not None
+
+
+class KeyTest:
+    """Base class of tests that match values against a key list."""
+
+    def __init__(self, match_type, comparator, keys):
+        self.match_type = match_type
+        self.comparator = comparator
+        self.keys = keys
+        self.dynamic = has_variables(keys)
+        if not self.dynamic:
+            self.matcher = build_matcher(match_type, comparator, keys)
+
+    def merge_key(self):
+        """Tests with equal merge keys can share one matcher inside anyof."""
+        if self.dynamic:
+            return None
+        return (type(self), self.match_type, self.comparator) + self.source_key()
+
+    def source_key(self):
+        raise NotImplementedError
+
+    def values(self, state):
+        raise NotImplementedError
+
+    def merged(self, others):
+        keys = [key for test in (self,) + tuple(others) for key in test.keys]
+        return self.with_keys(keys)
+
+    def __call__(self, state):
+        matcher = self.matcher
+        if self.dynamic:
+            keys = [state.expand(key) for key in self.keys]
+            matcher = build_matcher(self.match_type, self.comparator, keys)
+        return any(matcher(value) for value in self.values(state))
+
+
+class AddressTest(KeyTest):
+    def __init__(self, part, match_type, comparator, headers, keys):
+        self.part = part
+        self.headers = tuple(header.lower() for header in headers)
+        super().__init__(match_type, comparator, keys)
+
+    def source_key(self):
+        return (self.part, self.headers)
+
+    def with_keys(self, keys):
+        return AddressTest(
+            self.part, self.match_type, self.comparator, self.headers, keys
+        )
+
+    def values(self, state):
+        for header in self.headers:
+            yield from state.message.address(header, self.part)
+
+
+class HeaderTest(KeyTest):
+    def __init__(self, match_type, comparator, headers, keys):
+        self.headers = tuple(header.lower() for header in headers)
+        super().__init__(match_type, comparator, keys)
+
+    def source_key(self):
+        return (self.headers,)
+
+    def with_keys(self, keys):
+        return HeaderTest(self.match_type, self.comparator, self.headers, keys)
+
+    def values(self, state):
+        for header in self.headers:
+            yield from state.message.header(header)
+
+
+class StringTest(KeyTest):
+    def __init__(self, match_type, comparator, sources, keys):
+        self.sources = tuple(sources)
+        super().__init__(match_type, comparator, keys)
+
+    def source_key(self):
+        # Sources may reference variables, never merge them
+        return (id(self),)
+
+    def with_keys(self, keys):
+        return StringTest(self.match_type, self.comparator, self.sources, keys)
+
+    def values(self, state):
+        return [state.expand(source) for source in self.sources]
+
+
+def merge_tests(tests):
+    """Merge the anyof children that test the same values into one test."""
+    groups = {}
+    merged = []
+    for test in tests:
+        key = test.merge_key() if isinstance(test, KeyTest) else None
+        if key is None:
+            merged.append([test])
+        elif key in groups:
+            groups[key].append(test)
+        else:
+            groups[key] = [test]
+            merged.append(groups[key])
+    return [
+        group[0].merged(group[1:]) if len(group) > 1 else group[0] for group in merged
+    ]
+
+
+def split_arguments(node, valued_tags=(":comparator",)):
+    """Split a node's arguments into a tag dict and positional arguments."""
+    tags = {}
+    positional = []
+    arguments = iter(node.arguments)
+    for argument in arguments:
+        if isinstance(argument, str) and argument.startswith(":"):
+            tags[argument] = next(arguments, None) if argument in valued_tags else True
+        else:
+            positional.append(argument)
+    return tags, positional
+
+
+def pick_tag(tags, choices, default):
+    chosen = [tag for tag in choices if tag in tags]
+    return chosen[0] if chosen else default
+
+
+def comparator_of(tags):
+    comparator = tags.get(":comparator")
+    return comparator[0] if comparator else DEFAULT_COMPARATOR
+
+
+def compile_test(node):
+    """Compile a test node into a state -> bool function."""
+    tags, positional = split_arguments(node)
+    match_type = pick_tag(tags, MATCH_TYPES, ":is")
+
+    if node.name == "address":
+        part = pick_tag(tags, ADDRESS_PARTS, ":all")
+        return AddressTest(part, match_type, comparator_of(tags), *positional)
+    if node.name == "header":
+        return HeaderTest(match_type, comparator_of(tags), *positional)
+    if node.name == "string":
+        return StringTest(match_type, comparator_of(tags), *positional)
+    if node.name == "exists":
+        headers = [header.lower() for header in positional[0]]
+        return lambda state: all(
+            header in state.message.raw_headers for header in headers
+        )
+    if node.name == "size":
+        limit = positional[0]
+        if ":over" in tags:
+            return lambda state: state.message.size > limit
+        return lambda state: state.message.size < limit
+    if node.name in ("anyof", "allof"):
+        tests = [compile_test(test) for test in node.tests]
+        if node.name == "anyof":
+            tests = merge_tests(tests)
+            return lambda state: any(test(state) for test in tests)
+        return lambda state: all(test(state) for test in tests)
+    if node.name == "not":
+        test = compile_test(node.tests[0])
+        return lambda state: not test(state)
+    if node.name == "true":
+        return lambda state: True
+    if node.name == "false":
+        return lambda state: False
+    raise SieveError(f"line {node.line}: unsupported test {node.name!r}")
+
+
+def compile_block(nodes):
+    """Compile a list of command nodes into a state -> None function."""
+    steps = []
+    nodes = list(nodes)
+    index = 0
+    while index < len(nodes):
+        node = nodes[index]
+        index += 1
+        if node.name in ("elsif", "else"):
+            raise SieveError(f"line {node.line}: {node.name} without if")
+        if node.name != "if":
+            steps.append(compile_command(node))
+            continue
+
+        # Gather the whole if/elsif/else chain
+        branches = [(compile_test(node.tests[0]), compile_block(node.block))]
+        while index < len(nodes) and nodes[index].name in ("elsif", "else"):
+            branch = nodes[index]
+            index += 1
+            test = compile_test(branch.tests[0]) if branch.name == "elsif" else None
+            branches.append((test, compile_block(branch.block)))
+            if branch.name == "else":
+                break
+        steps.append(make_if(branches))
+
+    def run(state):
+        for step in steps:
+            step(state)
+
+    return run
+
+
+def make_if(branches):
+    def run(state):
+        for test, block in branches:
+            if test is None or test(state):
+                block(state)
+                return
+
+    return run
+
+
+def compile_command(node):
+    """Compile an action or control command into a state -> None function."""
+    tags, positional = split_arguments(node)
+
+    if node.name == "require":
+        return lambda state: None
+    if node.name == "stop":
+
+        def stop(state):
+            raise StopScript()
+
+        return stop
+    if node.name == "keep":
+
+        def keep(state):
+            state.keep = True
+
+        return keep
+    if node.name == "discard":
+
+        def discard(state):
+            state.implicit_keep = False
+
+        return discard
+    if node.name in ("fileinto", "redirect"):
+        target = positional[0][0]
+        copy = ":copy" in tags
+
+        def file_or_redirect(state):
+            value = state.expand(target)
+            if node.name == "fileinto":
+                if value not in state.folders:
+                    state.folders.append(value)
+            else:
+                state.redirects.append(value)
+            if not copy:
+                state.implicit_keep = False
+
+        return file_or_redirect
+    if node.name in ("addflag", "setflag", "removeflag"):
+        variable = positional[0][0].lower() if len(positional) > 1 else None
+        flag_list = positional[-1]
+
+        def flag(state):
+            flags = [
+                flag
+                for value in flag_list
+                for flag in state.expand(value).split()
+                if flag
+            ]
+            current = (
+                state.variables.get(variable, "").split() if variable else state.flags
+            )
+            if node.name == "setflag":
+                current = []
+            if node.name == "removeflag":
+                current = [flag for flag in current if flag not in flags]
+            else:
+                current = current + [flag for flag in flags if flag not in current]
+            if variable:
+                state.variables[variable] = " ".join(current)
+            else:
+                state.flags = current
+
+        return flag
+    if node.name == "set":
+        name, value = positional[0][0].lower(), positional[1][0]
+
+        def set_variable(state):
+            expanded = state.expand(value)
+            if ":lower" in tags:
+                expanded = expanded.lower()
+            if ":upper" in tags:
+                expanded = expanded.upper()
+            if ":length" in tags:
+                expanded = str(len(expanded))
+            state.variables[name] = expanded
+
+        return set_variable
+    if node.name == "expire":
+        unit, amount = positional[0][0], positional[1][0]
+
+        def expire(state):
+            state.expire = {"unit": unit, "value": int(state.expand(amount))}
+
+        return expire
+    raise SieveError(f"line {node.line}: unsupported command {node.name!r}")
+
+
+class SieveScript:
+    """A Sieve script compiled once into nested Python closures."""
+
+    def __init__(self, text, name="script"):
+        self.name = name
+        self.run = compile_block(Parser(text).parse())
+
+    def evaluate(self, message):
+        """Run the script against a SieveMessage and return its actions."""
+        state = SieveState(message)
+        try:
+            self.run(state)
+        except StopScript:
+            pass
+        return state.result()
+
+
+def load_script(path):
+    """Compile a Sieve script file."""
+    with open(path, "r", encoding="utf-8") as file:
+        return SieveScript(file.read(), os.path.basename(path))
+
+
+# Scripts compiled, and storage opened, once per worker process of evaluate_corpus
+worker_scripts = None
+worker_storage = None
+
+
+def init_worker(script_paths, storage_dir):
+    global worker_scripts, worker_storage
+    worker_scripts = [load_script(path) for path in script_paths]
+    worker_storage = open_storage(storage_dir)
+
+
+def load_message(sha_hash):
+    """Read a stored message, only reading its headers when it has a file."""
+    file_path = worker_storage.path(sha_hash)
+    if file_path:
+        return SieveMessage.from_file(file_path)
+    return SieveMessage.from_bytes(worker_storage.get(sha_hash))
+
+
+def evaluate_messages(sha_hashes):
+    """Evaluate every worker script against a chunk of stored messages."""
+    results = []
+    for sha_hash in sha_hashes:
+        try:
+            message = load_message(sha_hash)
+        except Exception as e:
+            results.append({"sha_hash": sha_hash, "error": str(e)})
+            continue
+        for script in worker_scripts:
+            result = script.evaluate(message)
+            result.update(sha_hash=sha_hash, script=script.name)
+            results.append(result)
+    return results
+
+
+def evaluate_corpus(
+    script_paths,
+    storage_dir,
+    sha_hashes,
+    processes=None,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+):
+    """Evaluate Sieve scripts against many stored messages in parallel.
+
+    Yields one result dict per message and script.
+    """
+    # Compile in this process first so syntax errors surface immediately
+    for path in script_paths:
+        load_script(path)
+
+    chunks = [
+        sha_hashes[i : i + chunk_size] for i in range(0, len(sha_hashes), chunk_size)
+    ]
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        initializer=init_worker,
+        initargs=(script_paths, storage_dir),
+    ) as executor:
+        for results in executor.map(evaluate_messages, chunks):
+            yield from results
+
+
+def parse_args():
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Run Sieve scripts against the stored email corpus."
+    )
+    parser.add_argument("scripts", nargs="+", help="Sieve scripts to evaluate")
+    parser.add_argument(
+        "--storage-dir", default="storage", help="where emails are stored"
+    )
+    parser.add_argument("--processes", type=int, help="number of worker processes")
+    parser.add_argument(
+        "--output", help="write JSON lines results here instead of stdout"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with open_storage(args.storage_dir) as storage:
+        sha_hashes = sorted(storage)
+
+    start = time.perf_counter()
+    folders = Counter()
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        for result in evaluate_corpus(
+            args.scripts, args.storage_dir, sha_hashes, args.processes
+        ):
+            output.write(json.dumps(result) + "\n")
+            for folder in result.get("folders", []):
+                folders[(result["script"], folder)] += 1
+    finally:
+        if args.output:
+            output.close()
+    elapsed = time.perf_counter() - start
+
+    print(
+        f"Evaluated {len(sha_hashes)} messages in {elapsed:.2f}s "
+        f"({len(sha_hashes) / max(elapsed, 1e-9):.0f} messages/s)",
+        file=sys.stderr,
+    )
+    for (script, folder), count in sorted(folders.items()):
+        print(f"  {script}: {folder}: {count}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
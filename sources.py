@@ -0,0 +1,212 @@
+from mbox_reader import MboxReader, iter_mbox_stream
+from queue import Queue
+from threading import Event, Thread
+import bz2
+import gzip
+import lzma
+import os
+import tarfile
+
+# Compression of each file suffix, and the suffix the file has once
+# decompressed (e.g. "enron.tgz" is a gzip compressed "enron.tar")
+COMPRESSION_SUFFIXES = {
+    ".gz": ("gzip", ""),
+    ".tgz": ("gzip", ".tar"),
+    ".bz2": ("bz2", ""),
+    ".tbz2": ("bz2", ".tar"),
+    ".xz": ("xz", ""),
+    ".txz": ("xz", ".tar"),
+    ".zst": ("zstd", ""),
+    ".tzst": ("zstd", ".tar"),
+}
+
+# Sources read at the same time by iter_sources, each in its own thread
+DEFAULT_SOURCE_READERS = 2
+
+# Messages buffered between the source readers and their consumer
+DEFAULT_SOURCE_QUEUE_SIZE = 256
+
+# Marks the end of a source reader's messages
+DONE = object()
+
+
+def split_compression(path):
+    """Return the compression of a file and its name once decompressed."""
+    root, suffix = os.path.splitext(path)
+    if suffix.lower() not in COMPRESSION_SUFFIXES:
+        return None, path
+    compression, inner_suffix = COMPRESSION_SUFFIXES[suffix.lower()]
+    return compression, root + inner_suffix
+
+
+def open_compressed(path):
+    """Open a file for reading, decompressing it on the fly from its suffix."""
+    compression, _ = split_compression(path)
+    if compression == "gzip":
+        return gzip.open(path, "rb")
+    if compression == "bz2":
+        return bz2.open(path, "rb")
+    if compression == "xz":
+        return lzma.open(path, "rb")
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError(f"reading {path} needs the zstandard package") from None
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+    return open(path, "rb")
+
+
+def source_kind(path):
+    """Return the kind of email source a path is, None if it is not one.
+
+    Directories are read as Maildir-like trees, .tar archives and .mbox
+    files message by message, and .eml files as a single message, all of
+    them possibly compressed.
+    """
+    if os.path.isdir(path):
+        return "directory"
+    _, name = split_compression(path)
+    name = name.lower()
+    if name.endswith(".tar"):
+        return "tar"
+    if name.endswith(".mbox"):
+        return "mbox"
+    if name.endswith(".eml"):
+        return "message"
+    return None
+
+
+def iter_directory(path):
+    """Yield every message of a directory tree, e.g. a Maildir or Enron's.
+
+    Files are read according to their kind, files of unknown kinds as one
+    message each, since Maildir messages have no extension. Hidden files
+    and the tmp folders of Maildirs, holding partial deliveries, are skipped.
+    """
+    for directory, subdirectories, filenames in os.walk(path):
+        if "tmp" in subdirectories and {"cur", "new"} <= set(subdirectories):
+            subdirectories.remove("tmp")
+        subdirectories[:] = sorted(
+            name for name in subdirectories if not name.startswith(".")
+        )
+        for filename in sorted(filenames):
+            if filename.startswith("."):
+                continue
+            file_path = os.path.join(directory, filename)
+            yield from SOURCE_READERS[source_kind(file_path) or "message"](file_path)
+
+
+def iter_tar(path):
+    """Yield every message of a tar archive, streaming it without extracting.
+
+    Members are read in archive order, so compressed archives are only
+    decompressed once, sequentially.
+    """
+    with open_compressed(path) as file, tarfile.open(fileobj=file, mode="r|") as tar:
+        for member in tar:
+            name = os.path.basename(member.name)
+            if not member.isfile() or name.startswith("."):
+                continue
+            content = tar.extractfile(member)
+            if name.lower().endswith(".mbox"):
+                yield from iter_mbox_stream(content)
+            else:
+                yield content.read()
+
+
+def iter_mbox(path):
+    """Yield every message of an mbox file, memory-mapped unless compressed."""
+    compression, _ = split_compression(path)
+    if compression:
+        with open_compressed(path) as file:
+            yield from iter_mbox_stream(file)
+        return
+    with MboxReader(path) as mbox:
+        yield from mbox.iter_messages()
+
+
+def iter_message(path):
+    """Yield the single message of a file."""
+    with open_compressed(path) as file:
+        yield file.read()
+
+
+# Reader of each kind of source
+SOURCE_READERS = {
+    "directory": iter_directory,
+    "tar": iter_tar,
+    "mbox": iter_mbox,
+    "message": iter_message,
+}
+
+
+def iter_source(path):
+    """Yield the raw bytes of every message of a source."""
+    kind = source_kind(path)
+    if kind is None:
+        raise ValueError(f"{path} is not a directory, archive, mbox or .eml file")
+    return SOURCE_READERS[kind](path)
+
+
+def iter_sources(
+    paths,
+    readers=DEFAULT_SOURCE_READERS,
+    queue_size=DEFAULT_SOURCE_QUEUE_SIZE,
+    on_error=None,
+):
+    """Yield the raw bytes of every message of many sources.
+
+    Sources are read and decompressed by background threads, so reading
+    overlaps with whatever the consumer does with the messages; gzip, bz2,
+    xz and zstd all release the GIL while decompressing. Messages come in no
+    particular order. An error reading a source, e.g. a corrupt archive, is
+    raised to the consumer, unless on_error is set: it is then called with
+    the path and the error from the reader thread, and the other sources are
+    still read. The messages read before the error are yielded either way.
+    """
+    queue = Queue(maxsize=queue_size)
+    pending = list(reversed(paths))
+    stopped = Event()
+
+    def read():
+        try:
+            while pending and not stopped.is_set():
+                try:
+                    path = pending.pop()
+                except IndexError:
+                    break
+                try:
+                    for raw in iter_source(path):
+                        if stopped.is_set():
+                            break
+                        queue.put(raw)
+                except Exception as e:
+                    if on_error is None:
+                        raise
+                    on_error(path, e)
+        except Exception as e:
+            queue.put(e)
+        finally:
+            queue.put(DONE)
+
+    threads = [Thread(target=read, daemon=True) for _ in range(max(readers, 1))]
+    for thread in threads:
+        thread.start()
+
+    running = len(threads)
+    try:
+        while running:
+            item = queue.get()
+            if item is DONE:
+                running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        # Unblock the readers if the consumer stopped early
+        stopped.set()
+        while running:
+            if queue.get() is DONE:
+                running -= 1
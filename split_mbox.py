@@ -1,28 +1,40 @@
 #!/usr/bin/env python3
 
-import mailbox
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from mbox_reader import MboxReader
 import os
 
 
-def split_mbox_to_eml(mbox_file, output_dir):
-    # Create the output directory if it doesn't exist
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    # Open the MBOX file
-    mbox = mailbox.mbox(mbox_file)
-
-    # Iterate through the emails in the MBOX file
-    for idx, message in enumerate(mbox):
+def split_mbox_range(mbox, part, start, end, output_dir):
+    # Iterate through the emails starting within this byte range
+    for idx, message in enumerate(mbox.iter_messages(start, end)):
         # Construct the output file path
-        eml_file = os.path.join(output_dir, f"email_{idx+1:05d}.eml")
+        eml_file = os.path.join(output_dir, f"email_{part:03d}_{idx+1:05d}.eml")
 
-        # Write the message to an EML file
-        with open(eml_file, "w") as f:
-            f.write(message.as_string())
+        # Write the original message bytes to an EML file
+        with open(eml_file, "wb") as f:
+            f.write(message)
 
         print(f"Saved: {eml_file}")
 
 
+def split_mbox_to_eml(mbox_file, output_dir, workers=None):
+    # Create the output directory if it doesn't exist
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    workers = workers or os.cpu_count()
+
+    # Map the MBOX file and split it into byte ranges on message boundaries
+    with MboxReader(mbox_file) as mbox:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(split_mbox_range, mbox, part, start, end, output_dir)
+                for part, (start, end) in enumerate(mbox.split(workers))
+            ]
+            for future in as_completed(futures):
+                future.result()
+
+
 # Split the MBOX into individual EML files
 split_mbox_to_eml("./gmail_takeout.mbox", "./gmail/")
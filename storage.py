@@ -0,0 +1,421 @@
+from threading import Lock, get_ident
+import errno
+import json
+import math
+import os
+import struct
+import zlib
+
+# File describing the layout of a storage directory. Directories without one
+# use the original flat layout.
+LAYOUT_FILE = ".storage.json"
+
+# Names of the files of a pack storage
+PACK_DATA_FILE = "pack.dat"
+PACK_INDEX_FILE = "pack.idx"
+
+# Pack index record: raw sha256, offset and length of the data, compression
+PACK_INDEX_RECORD = struct.Struct("<32sQQB")
+
+# Compression codes stored in the pack index
+COMPRESSIONS = {None: 0, "zlib": 1, "zstd": 2}
+
+# Number of stored hashes past which a HashIndex uses a Bloom filter instead
+# of a set. A set of hex digests takes ~150 bytes per hash, the filter ~10 bits.
+DEFAULT_BLOOM_THRESHOLD = 5_000_000
+
+# False positive rate of the Bloom filter of a HashIndex
+DEFAULT_BLOOM_ERROR_RATE = 0.01
+
+
+class Storage:
+    """Content-addressed store of raw email bytes, keyed by sha256 hex digest."""
+
+    layout = None
+    # Whether the storage keeps the hashes it holds in memory
+    indexed = False
+
+    def __init__(self, root):
+        self.root = root
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __contains__(self, sha_hash):
+        raise NotImplementedError
+
+    def __iter__(self):
+        """Iterate over the hashes of every stored email."""
+        raise NotImplementedError
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def get(self, sha_hash):
+        """Return the raw bytes of a stored email."""
+        raise NotImplementedError
+
+    def put(self, sha_hash, content):
+        """Store raw email bytes, returning False if they were already stored."""
+        raise NotImplementedError
+
+    def put_file(self, sha_hash, file_path):
+        """Store the content of a file, returning False if already stored.
+
+        The file is left in place, callers remove it once stored.
+        """
+        with open(file_path, "rb") as file:
+            return self.put(sha_hash, file.read())
+
+    def delete(self, sha_hash):
+        raise NotImplementedError(f"{self.layout} storage does not support deletes")
+
+    def path(self, sha_hash):
+        """Return the file a stored email can be read from, if it has its own."""
+        return None
+
+    def items(self):
+        """Iterate over (sha_hash, raw bytes) of every stored email."""
+        for sha_hash in self:
+            yield sha_hash, self.get(sha_hash)
+
+    def settings(self):
+        """Settings written to the layout file."""
+        return {"layout": self.layout}
+
+    def close(self):
+        pass
+
+
+class FlatStorage(Storage):
+    """One <sha256>.eml file per email, all in one directory."""
+
+    layout = "flat"
+
+    def __init__(self, root):
+        super().__init__(root)
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, sha_hash):
+        return os.path.join(self.root, f"{sha_hash}.eml")
+
+    def __contains__(self, sha_hash):
+        return os.path.exists(self.path(sha_hash))
+
+    def __iter__(self):
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if entry.name.endswith(".eml"):
+                    yield entry.name[: -len(".eml")]
+
+    def get(self, sha_hash):
+        with open(self.path(sha_hash), "rb") as file:
+            return file.read()
+
+    def put(self, sha_hash, content):
+        path = self.path(sha_hash)
+        if os.path.exists(path):
+            return False
+        # Write under a temporary name first so readers never see a partial file
+        temp_path = f"{path}.{os.getpid()}.{get_ident()}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(content)
+        os.replace(temp_path, path)
+        return True
+
+    def put_file(self, sha_hash, file_path):
+        # Hard link the file into place rather than copying it. Linking never
+        # replaces an existing file, so concurrent stores of the same email
+        # cannot both succeed.
+        try:
+            os.link(file_path, self.path(sha_hash))
+        except FileExistsError:
+            return False
+        except OSError as e:
+            # Other filesystem, or one without hard links
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            return super().put_file(sha_hash, file_path)
+        return True
+
+    def delete(self, sha_hash):
+        os.remove(self.path(sha_hash))
+
+
+class FanoutStorage(FlatStorage):
+    """Git-style layout, <sha[:2]>/<sha256>.eml, to keep directories small."""
+
+    layout = "fanout"
+
+    def path(self, sha_hash):
+        return os.path.join(self.root, sha_hash[:2], f"{sha_hash}.eml")
+
+    def __iter__(self):
+        with os.scandir(self.root) as directories:
+            prefixes = sorted(
+                entry.name
+                for entry in directories
+                if entry.is_dir() and len(entry.name) == 2
+            )
+        for prefix in prefixes:
+            with os.scandir(os.path.join(self.root, prefix)) as entries:
+                for entry in entries:
+                    if entry.name.endswith(".eml"):
+                        yield entry.name[: -len(".eml")]
+
+    def put(self, sha_hash, content):
+        os.makedirs(os.path.dirname(self.path(sha_hash)), exist_ok=True)
+        return super().put(sha_hash, content)
+
+    def put_file(self, sha_hash, file_path):
+        os.makedirs(os.path.dirname(self.path(sha_hash)), exist_ok=True)
+        return super().put_file(sha_hash, file_path)
+
+
+class PackStorage(Storage):
+    """Append-only pack file plus a hash -> (offset, length) index.
+
+    Emails are appended to pack.dat, optionally compressed one by one, and
+    an index record is appended to pack.idx once the data is written. The
+    index is loaded in memory on open; records pointing past the end of the
+    data, left by an interrupted write, are ignored. A pack has one writer
+    at a time, any number of processes can read it.
+    """
+
+    layout = "pack"
+    indexed = True
+
+    def __init__(self, root, compression=None, level=None):
+        super().__init__(root)
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"unknown compression: {compression}")
+        os.makedirs(root, exist_ok=True)
+        self.compression = compression
+        self.level = level
+        self.lock = Lock()
+        self.data = open(os.path.join(root, PACK_DATA_FILE), "a+b")
+        self.data_size = os.fstat(self.data.fileno()).st_size
+        self.index_file = open(os.path.join(root, PACK_INDEX_FILE), "a+b")
+        self.index = self.load_index()
+        self._compressors = {}
+
+    def load_index(self):
+        """Read the index records whose data was fully written."""
+        index = {}
+        self.index_file.seek(0)
+        content = self.index_file.read()
+        size = PACK_INDEX_RECORD.size
+        for start in range(0, len(content) - size + 1, size):
+            digest, offset, length, code = PACK_INDEX_RECORD.unpack_from(content, start)
+            if offset + length <= self.data_size:
+                index[digest.hex()] = (offset, length, code)
+        return index
+
+    def __contains__(self, sha_hash):
+        return sha_hash in self.index
+
+    def __iter__(self):
+        return iter(list(self.index))
+
+    def __len__(self):
+        return len(self.index)
+
+    def items(self):
+        # Read in pack order, which is sequential on disk
+        entries = sorted(self.index.items(), key=lambda item: item[1][0])
+        for sha_hash, entry in entries:
+            yield sha_hash, self.read(entry)
+
+    def get(self, sha_hash):
+        try:
+            entry = self.index[sha_hash]
+        except KeyError:
+            raise FileNotFoundError(f"{sha_hash} is not in {self.root}") from None
+        return self.read(entry)
+
+    def read(self, entry):
+        offset, length, code = entry
+        # pread does not move the shared file position, so threads can read
+        # concurrently with each other and with appends.
+        content = os.pread(self.data.fileno(), length, offset)
+        if code == COMPRESSIONS["zlib"]:
+            return zlib.decompress(content)
+        if code == COMPRESSIONS["zstd"]:
+            return self.zstd().ZstdDecompressor().decompress(content)
+        return content
+
+    def put(self, sha_hash, content):
+        if sha_hash in self.index:
+            return False
+        code = COMPRESSIONS[self.compression]
+        if code == COMPRESSIONS["zlib"]:
+            content = zlib.compress(content, -1 if self.level is None else self.level)
+        elif code == COMPRESSIONS["zstd"]:
+            content = self.zstd_compressor().compress(content)
+
+        with self.lock:
+            if sha_hash in self.index:
+                return False
+            offset = self.data_size
+            self.data.write(content)
+            self.data.flush()
+            self.data_size += len(content)
+            self.index_file.write(
+                PACK_INDEX_RECORD.pack(
+                    bytes.fromhex(sha_hash), offset, len(content), code
+                )
+            )
+            self.index_file.flush()
+            self.index[sha_hash] = (offset, len(content), code)
+        return True
+
+    def zstd(self):
+        """Import zstandard, an optional dependency only zstd packs need."""
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError(
+                "zstd compressed packs need the zstandard package"
+            ) from None
+        return zstandard
+
+    def zstd_compressor(self):
+        # Compressors are not thread-safe, keep one per thread
+        compressor = self._compressors.get(get_ident())
+        if compressor is None:
+            compressor = self._compressors[get_ident()] = self.zstd().ZstdCompressor(
+                level=3 if self.level is None else self.level
+            )
+        return compressor
+
+    def settings(self):
+        return {"layout": self.layout, "compression": self.compression}
+
+    def close(self):
+        self.data.close()
+        self.index_file.close()
+
+
+class BloomFilter:
+    """Set of sha256 hex digests with false positives, in a few bits per hash.
+
+    The digests are already uniformly distributed, so the bit positions are
+    derived from them directly instead of hashing them again.
+    """
+
+    def __init__(self, capacity, error_rate=DEFAULT_BLOOM_ERROR_RATE):
+        capacity = max(capacity, 1)
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, sha_hash):
+        # Double hashing from two independent 64-bit slices of the digest
+        first, second = int(sha_hash[:16], 16), int(sha_hash[16:32], 16) | 1
+        for i in range(self.hash_count):
+            yield (first + i * second) % self.size
+
+    def add(self, sha_hash):
+        for position in self.positions(sha_hash):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, sha_hash):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self.positions(sha_hash)
+        )
+
+
+class HashIndex:
+    """In-memory index of the hashes of a storage, to skip duplicates on ingest.
+
+    Hashes are loaded in a set, or in a Bloom filter past bloom_threshold
+    hashes. Only the filter's positives are checked against the storage, so
+    emails that were never stored are recognized without touching the disk.
+    Storages that keep their own index in memory are used directly.
+    """
+
+    def __init__(
+        self,
+        storage,
+        bloom_threshold=DEFAULT_BLOOM_THRESHOLD,
+        error_rate=DEFAULT_BLOOM_ERROR_RATE,
+    ):
+        self.storage = storage
+        self.exact = True
+        if storage.indexed:
+            self.hashes = storage
+            return
+
+        count = len(storage)
+        if count > bloom_threshold:
+            # Leave room for the store to double before the error rate degrades
+            self.hashes = BloomFilter(2 * count, error_rate)
+            self.exact = False
+        else:
+            self.hashes = set()
+        for sha_hash in storage:
+            self.hashes.add(sha_hash)
+
+    def __contains__(self, sha_hash):
+        if sha_hash not in self.hashes:
+            return False
+        return self.exact or sha_hash in self.storage
+
+    def add(self, sha_hash):
+        """Record a hash that was just stored."""
+        if self.hashes is not self.storage:
+            self.hashes.add(sha_hash)
+
+
+# Storage class of each layout
+LAYOUTS = {
+    "flat": FlatStorage,
+    "fanout": FanoutStorage,
+    "pack": PackStorage,
+}
+
+
+def read_settings(root):
+    """Return the settings of a storage directory, flat when it has none."""
+    path = os.path.join(root, LAYOUT_FILE)
+    if not os.path.exists(path):
+        return {"layout": "flat"}
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def open_storage(root, layout=None, compression=None):
+    """Open a storage directory with the layout it was created with.
+
+    layout and compression only apply to new directories; opening an
+    existing directory with a different layout is an error.
+    """
+    exists = False
+    if os.path.isdir(root):
+        with os.scandir(root) as entries:
+            exists = any(True for _ in entries)
+    if exists:
+        settings = read_settings(root)
+        if layout and layout != settings["layout"]:
+            raise ValueError(
+                f"{root} uses the {settings['layout']} layout, not {layout}; "
+                "migrate it with `import.py migrate-storage`"
+            )
+    else:
+        settings = {"layout": layout or "flat"}
+        if settings["layout"] == "pack":
+            settings["compression"] = compression
+
+    if settings["layout"] == "pack":
+        storage = PackStorage(root, settings.get("compression"))
+    else:
+        storage = LAYOUTS[settings["layout"]](root)
+
+    if not exists and storage.layout != "flat":
+        with open(os.path.join(root, LAYOUT_FILE), "w") as file:
+            json.dump(storage.settings(), file)
+    return storage
@@ -0,0 +1,136 @@
+from collections import Counter
+from sklearn.feature_extraction import FeatureHasher
+from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.preprocessing import normalize
+from scipy import sparse
+import numpy as np
+
+# Hashed feature columns by default
+DEFAULT_N_FEATURES = 1 << 18
+
+# Most frequent terms whose columns are named by default
+DEFAULT_TOP_TERMS = 1000
+
+# Candidate terms tracked per named term. Rarer candidates are dropped after
+# every batch, so tracking stays bounded whatever the corpus size.
+TERM_CANDIDATES_PER_TOP_TERM = 10
+
+
+class StreamingTfidfVectorizer:
+    """TF-IDF over hashed terms, fitted batch by batch.
+
+    Terms are hashed to columns like HashingVectorizer does, so counting
+    them needs no vocabulary and new emails can be vectorized at any time.
+    partial_fit accumulates the document frequency of every column, the
+    IDF weighting matching TfidfTransformer(smooth_idf=True) fitted on all
+    the batches so far.
+
+    Hashing loses the terms, so the most frequent ones are tracked on the
+    side to name their columns. Their counts are approximate: candidates
+    dropped from the tracking restart from zero if they come back.
+    """
+
+    def __init__(
+        self,
+        n_features=DEFAULT_N_FEATURES,
+        ngram_range=(1, 2),
+        top_terms=DEFAULT_TOP_TERMS,
+    ):
+        self.n_features = n_features
+        self.top_terms = top_terms
+        # Same tokens and n-grams as a CountVectorizer would produce
+        self.analyzer = CountVectorizer(ngram_range=ngram_range).build_analyzer()
+        self.ngram_range = tuple(ngram_range)
+        self.hasher = FeatureHasher(
+            n_features=n_features, input_type="string", alternate_sign=False
+        )
+        self.df = np.zeros(n_features, dtype=np.int64)
+        self.n_documents = 0
+        self.term_counts = Counter()
+
+    def state(self):
+        """Return the parameters and fitted statistics as a dict of arrays.
+
+        Enough to rebuild the vectorizer with from_state, e.g. to transform
+        new emails without refitting.
+        """
+        return {
+            "n_features": np.int64(self.n_features),
+            "ngram_range": np.array(self.ngram_range, dtype=np.int64),
+            "top_terms": np.int64(self.top_terms),
+            "df": self.df,
+            "n_documents": np.int64(self.n_documents),
+            "terms": np.array(list(self.term_counts), dtype=str),
+            "term_counts": np.array(list(self.term_counts.values()), dtype=np.int64),
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        """Rebuild a vectorizer from the arrays returned by state."""
+        vectorizer = cls(
+            int(state["n_features"]),
+            tuple(int(n) for n in state["ngram_range"]),
+            int(state["top_terms"]),
+        )
+        vectorizer.df = np.array(state["df"], dtype=np.int64)
+        vectorizer.n_documents = int(state["n_documents"])
+        vectorizer.term_counts = Counter(
+            dict(zip(state["terms"].tolist(), state["term_counts"].tolist()))
+        )
+        return vectorizer
+
+    def count(self, documents):
+        """Return the hashed term counts of documents, without fitting."""
+        return self.hasher.transform(
+            self.analyzer(document) for document in documents
+        ).tocsr()
+
+    def partial_fit(self, documents):
+        """Add a batch of documents to the IDF and term statistics.
+
+        Returns the hashed term counts of the batch.
+        """
+        terms = [self.analyzer(document) for document in documents]
+        counts = self.hasher.transform(terms).tocsr()
+        self.df += np.bincount(counts.indices, minlength=self.n_features)
+        self.n_documents += counts.shape[0]
+
+        for document_terms in terms:
+            self.term_counts.update(document_terms)
+        candidates = self.top_terms * TERM_CANDIDATES_PER_TOP_TERM
+        if len(self.term_counts) > candidates:
+            self.term_counts = Counter(dict(self.term_counts.most_common(candidates)))
+        return counts
+
+    @property
+    def idf(self):
+        return np.log((1 + self.n_documents) / (1 + self.df)) + 1
+
+    def weight(self, counts):
+        """Apply the IDF weighting and L2 row normalization to hashed counts."""
+        return normalize(sparse.csr_matrix(counts.multiply(self.idf)), norm="l2")
+
+    def transform(self, documents):
+        """Return the TF-IDF matrix of documents, e.g. newly received emails."""
+        return self.weight(self.count(documents))
+
+    def feature_names(self):
+        """Return the name of every column.
+
+        Columns are named after the most frequent term hashed to them, the
+        others after their index, e.g. "#1234".
+        """
+        names = np.array(
+            [f"#{column}" for column in range(self.n_features)], dtype=object
+        )
+        terms = [term for term, _ in self.term_counts.most_common(self.top_terms)]
+        if not terms:
+            return names
+        columns = self.hasher.transform([term] for term in terms).tocsr().indices
+        named = set()
+        # Most frequent first, so a colliding rarer term never renames a column
+        for term, column in zip(terms, columns):
+            if column not in named:
+                names[column] = term
+                named.add(column)
+        return names
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+from analyze import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_EMAILS_PER_CHUNK,
+    OCCURRENCE_TABLES,
+    count_emails,
+    count_words_table,
+    db_config,
+    document_frequency,
+    iter_dtm_chunks,
+    load_vocabulary,
+    load_words,
+)
+from sklearn.decomposition import LatentDirichletAllocation
+import argparse
+import joblib
+import numpy as np
+import pandas as pd
+import psycopg2
+
+# Where the topic model of each source is saved
+DEFAULT_MODEL_PATH = "lda_{source}.joblib"
+
+# Number of topics of a new model
+DEFAULT_TOPICS = 10
+
+# Emails per online LDA update
+DEFAULT_BATCH_SIZE = 256
+
+# Document frequency bounds of the modeled words. Words in very few emails
+# carry no topic, and words in most emails carry all of them.
+DEFAULT_MIN_DF = 5
+DEFAULT_MAX_DF = 0.5
+
+# Words shown per topic
+DEFAULT_TOP_WORDS = 10
+
+
+def train_topics(
+    source="subject",
+    n_topics=DEFAULT_TOPICS,
+    min_df=DEFAULT_MIN_DF,
+    max_df=DEFAULT_MAX_DF,
+    epochs=1,
+    batch_size=DEFAULT_BATCH_SIZE,
+    n_jobs=-1,
+    emails_per_chunk=DEFAULT_EMAILS_PER_CHUNK,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+):
+    """Fit an online LDA model on the word counts of the imported emails.
+
+    The occurrence table is streamed in chunks of whole emails (see
+    analyze.iter_dtm_chunks), and each chunk is passed to partial_fit, which
+    updates the model in mini-batches of batch_size emails, spread over
+    n_jobs processes. Only the columns of the words within the min_df/max_df
+    bounds are modeled.
+
+    Returns the model as a dict, with the word id and word of each of its
+    columns and the last email id it was trained on.
+    """
+    conn = psycopg2.connect(**db_config)
+    n_words = count_words_table(conn)
+    word_ids = load_vocabulary(conn, source, min_df, max_df)
+    if not len(word_ids):
+        raise RuntimeError(f"No {source} words within the document frequency bounds")
+    lda = LatentDirichletAllocation(
+        n_components=n_topics,
+        learning_method="online",
+        batch_size=batch_size,
+        total_samples=count_emails(conn, source),
+        n_jobs=n_jobs,
+        random_state=42,
+    )
+
+    last_email_id = 0
+    for epoch in range(epochs):
+        for email_ids, chunk in iter_dtm_chunks(
+            conn, source, n_words, emails_per_chunk, chunk_size
+        ):
+            lda.partial_fit(chunk[:, word_ids])
+            last_email_id = max(last_email_id, int(email_ids[-1]))
+        print(f"Finished epoch {epoch + 1} of {epochs}")
+
+    words = load_words(conn, word_ids)
+    conn.close()
+    return {
+        "lda": lda,
+        "source": source,
+        "word_ids": word_ids,
+        "words": words,
+        "last_email_id": last_email_id,
+    }
+
+
+def infer_topics(
+    model,
+    after_email_id=None,
+    emails_per_chunk=DEFAULT_EMAILS_PER_CHUNK,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+):
+    """Stream the topic distributions of emails, without retraining.
+
+    By default only the emails imported since the model was trained are
+    read. Words the model was not trained on are ignored.
+
+    Yields (email_ids, distributions) pairs, where distributions is a
+    len(email_ids) x topics array whose rows sum to 1.
+    """
+    if after_email_id is None:
+        after_email_id = model["last_email_id"]
+    conn = psycopg2.connect(**db_config)
+    n_words = count_words_table(conn)
+    for email_ids, chunk in iter_dtm_chunks(
+        conn, model["source"], n_words, emails_per_chunk, chunk_size, after_email_id
+    ):
+        yield email_ids, model["lda"].transform(chunk[:, model["word_ids"]])
+    conn.close()
+
+
+def print_topics(model, n_words=DEFAULT_TOP_WORDS):
+    """Print the most weighted words of every topic."""
+    for index, topic in enumerate(model["lda"].components_):
+        top_words = [str(model["words"][i]) for i in topic.argsort()[::-1][:n_words]]
+        print(f"Topic {index}: {' '.join(top_words)}")
+
+
+def save_model(model, path):
+    joblib.dump(model, path)
+    print(f"Saved the topic model to {path}")
+
+
+def load_model(path):
+    return joblib.load(path)
+
+
+def parse_args():
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Model the topics of the imported emails with online LDA."
+    )
+    parser.add_argument(
+        "--source",
+        choices=sorted(OCCURRENCE_TABLES),
+        default="subject",
+        help="which word occurrences to model",
+    )
+    parser.add_argument(
+        "--model-path",
+        help=f"where the model is saved, {DEFAULT_MODEL_PATH} by default",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help="occurrence rows fetched from the database at a time",
+    )
+    parser.add_argument(
+        "--emails-per-chunk",
+        type=int,
+        default=DEFAULT_EMAILS_PER_CHUNK,
+        help="emails read from the database at a time",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    train = subparsers.add_parser("train", help="train and save a new model")
+    train.add_argument(
+        "--topics", type=int, default=DEFAULT_TOPICS, help="number of topics"
+    )
+    train.add_argument(
+        "--min-df",
+        type=document_frequency,
+        default=DEFAULT_MIN_DF,
+        help="leave out words in fewer emails, a count or a proportion",
+    )
+    train.add_argument(
+        "--max-df",
+        type=document_frequency,
+        default=DEFAULT_MAX_DF,
+        help="leave out words in more emails, a count or a proportion",
+    )
+    train.add_argument(
+        "--epochs",
+        type=int,
+        default=1,
+        help="streaming passes over the emails",
+    )
+    train.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="emails per online update",
+    )
+    train.add_argument(
+        "--n-jobs",
+        type=int,
+        default=-1,
+        help="processes of each update, -1 for one per CPU",
+    )
+
+    infer = subparsers.add_parser(
+        "infer", help="infer the topics of the emails imported since training"
+    )
+    infer.add_argument(
+        "--after-id",
+        type=int,
+        help="infer the emails with a greater id instead, 0 for every email",
+    )
+    infer.add_argument(
+        "--output",
+        help="write the topic distribution of every email to this CSV",
+    )
+
+    show = subparsers.add_parser("show", help="print the words of every topic")
+    show.add_argument(
+        "--words",
+        type=int,
+        default=DEFAULT_TOP_WORDS,
+        help="words shown per topic",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    model_path = args.model_path or DEFAULT_MODEL_PATH.format(source=args.source)
+
+    if args.command == "train":
+        model = train_topics(
+            args.source,
+            args.topics,
+            args.min_df,
+            args.max_df,
+            args.epochs,
+            args.batch_size,
+            args.n_jobs,
+            args.emails_per_chunk,
+            args.chunk_size,
+        )
+        save_model(model, model_path)
+        print_topics(model)
+        return
+
+    model = load_model(model_path)
+    if args.command == "show":
+        print_topics(model, args.words)
+        return
+
+    n_topics = model["lda"].n_components
+    counts = np.zeros(n_topics, dtype=np.int64)
+    header = True
+    for email_ids, distributions in infer_topics(
+        model, args.after_id, args.emails_per_chunk, args.chunk_size
+    ):
+        counts += np.bincount(distributions.argmax(axis=1), minlength=n_topics)
+        if args.output:
+            frame = pd.DataFrame(
+                distributions, columns=[f"topic_{i}" for i in range(n_topics)]
+            )
+            frame.insert(0, "email_id", email_ids)
+            frame.to_csv(
+                args.output, mode="w" if header else "a", header=header, index=False
+            )
+            header = False
+    print(f"Inferred the topics of {counts.sum()} emails")
+    print(f"Emails per main topic: {counts.tolist()}")
+
+
+if __name__ == "__main__":
+    main()